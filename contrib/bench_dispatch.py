@@ -0,0 +1,88 @@
+# coding=utf8
+"""
+bench_dispatch.py - Compare Willie's indexed dispatch to a full regexp scan
+
+Loads a number of synthetic command callables (and a few free-form rules)
+into a Willie instance which is never connected, then measures how many lines
+per second can be matched with the indexed lookup that ``dispatch`` uses,
+and with the old loop over every regexp in ``bot.commands``.
+
+Usage: python contrib/bench_dispatch.py [number of commands]
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from willie.bot import Willie
+import willie.module
+from willie.config import Config
+from willie.tools import ExpiringDict, Identifier
+
+
+class NullScheduler(object):
+    def clear_jobs(self):
+        pass
+
+    def add_job(self, job):
+        pass
+
+
+def make_callable(name, rule=None):
+    def func(bot, trigger):
+        pass
+    func.__name__ = str(name)
+    if rule:
+        willie.module.rule(rule)(func)
+    else:
+        willie.module.commands(name)(func)
+    return func
+
+
+def make_bot(count):
+    bot = Willie.__new__(Willie)
+    bot.config = Config('')
+    bot.nick = Identifier('Willie')
+    bot.doc = {}
+    bot.scheduler = NullScheduler()
+    bot.times = ExpiringDict(0)
+    bot.networks = [bot]
+    bot.callables = set(make_callable('command%d' % i) for i in range(count))
+    bot.callables.add(make_callable('url', r'.*https?://\S+'))
+    bot.callables.add(make_callable('greet', r'$nickname[:,]? hello'))
+    bot.bind_commands()
+    return bot
+
+
+def scan(bot, text):
+    for priority in ('high', 'medium', 'low'):
+        for regexp in bot.commands[priority]:
+            regexp.match(text)
+
+
+def indexed(bot, text):
+    for priority in ('high', 'medium', 'low'):
+        for regexp, funcs in bot._candidates('PRIVMSG', priority, text):
+            regexp.match(text)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    bot = make_bot(count)
+    lines = ['.command%d some arguments here' % (count // 2),
+             'just chatting in the channel, nothing to see',
+             'Willie: hello']
+    number = 2000
+    print('%d commands, %d lines per run' % (count, len(lines)))
+    for name, method in (('full scan', scan), ('indexed', indexed)):
+        elapsed = timeit.timeit(
+            lambda: [method(bot, line) for line in lines], number=number)
+        print('%-10s %12.0f lines/sec' % (name, number * len(lines) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
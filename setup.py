@@ -5,13 +5,10 @@ from __future__ import unicode_literals
 from distutils.core import setup
 from willie import __version__
 import tempfile
-import sys
 import os
 import shutil
 
 requires = ['feedparser', 'pytz', 'lxml', 'praw', 'enchant', 'pygeoip']
-if sys.version_info.major < 3:
-    requires.append('backports.ssl_match_hostname')
 
 
 def do_setup():
@@ -0,0 +1,57 @@
+# coding=utf8
+"""Tests for the configuration"""
+from __future__ import unicode_literals
+
+import pytest
+
+from willie.config import Config, NetworkConfig, shard_configs
+
+
+@pytest.fixture
+def config(tmpdir):
+    filename = tmpdir.join('default.cfg')
+    filename.write('\n'.join([
+        '[core]',
+        'nick = Willie',
+        'host = irc.example.net',
+        'channels = #a,#b',
+        '[network:other]',
+        'host = irc.example.org',
+        'channels = #c',
+    ]))
+    return Config(str(filename))
+
+
+def test_networks(config):
+    assert config.networks == ['other']
+
+
+def test_network_config(config):
+    network = NetworkConfig(config, 'other')
+    assert network.network == 'other'
+    assert network.core.host == 'irc.example.org'
+    assert network.host == 'irc.example.org'
+    assert network.core.nick == 'Willie'
+    assert network.core.get_list('channels') == ['#c']
+    assert config.core.get_list('channels') == ['#a', '#b']
+
+
+def test_network_config_writes(config):
+    network = NetworkConfig(config, 'other')
+    network.core.host = 'irc.example.com'
+    network.core.owner = 'Someone'
+    assert config.core.host == 'irc.example.net'
+    assert config.core.owner == 'Someone'
+    network._cache = 'private'
+    assert not hasattr(config, '_cache')
+
+
+def test_shard_configs(config):
+    assert len(shard_configs(config)) == 1
+    config.core.shard_nicks = 'Willie,Willie2'
+    first, second = shard_configs(config)
+    assert (first.core.nick, second.core.nick) == ('Willie', 'Willie2')
+    assert (first.shard, second.shard) == ('Willie', 'Willie2')
+    assert first.core.get_list('channels') == ['#a']
+    assert second.core.get_list('channels') == ['#b']
+    assert first.network is None
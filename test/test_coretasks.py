@@ -0,0 +1,93 @@
+# coding=utf8
+"""Tests for the core state tracking"""
+from __future__ import unicode_literals
+
+import re
+
+# willie.module can only be imported once the bot has been
+import willie.bot
+from willie import coretasks
+from willie.config import Config
+from willie.tools import Identifier
+from willie.trigger import Batch, PreTrigger, Trigger
+
+
+class FakeBot(object):
+    nick = Identifier('Willie')
+
+    def __init__(self):
+        self.privileges = {
+            Identifier('#a'): {Identifier('Foo'): 4, Identifier('Bar'): 0},
+            Identifier('#b'): {Identifier('Foo'): 0},
+        }
+
+
+def batch_trigger(bot, lines):
+    start = PreTrigger(bot.nick, ':irc.example.net BATCH +x net x y')
+    batch = Batch(start)
+    batch.lines = [PreTrigger(bot.nick, line) for line in lines]
+    end = PreTrigger(bot.nick, ':irc.example.net BATCH -x')
+    end.batch = batch
+    return Trigger(Config(''), end, re.match('.*', end.args[-1]))
+
+
+def test_track_batch():
+    bot = FakeBot()
+    trigger = batch_trigger(bot, [
+        ':foo!f@h QUIT :x y',
+        ':Baz!b@h JOIN #a',
+        ':Baz!b@h JOIN :#b',
+        ':Qux!q@h JOIN #elsewhere',
+    ])
+    coretasks.track_batch(bot, trigger)
+    assert sorted(bot.privileges) == ['#a', '#b']
+    assert bot.privileges['#a'] == {Identifier('Bar'): 0, Identifier('Baz'): 0}
+    assert bot.privileges['#b'] == {Identifier('Baz'): 0}
+
+
+def test_track_isupport():
+    bot = FakeBot()
+    bot.isupport = {'EXCEPTS': None}
+    line = (':irc.example.net 005 Willie CHANTYPES=# -EXCEPTS '
+            'TARGMAX=JOIN:,PRIVMSG:4 LINELEN=1024 :are supported')
+    pretrigger = PreTrigger(bot.nick, line)
+    trigger = Trigger(Config(''), pretrigger, re.match('.*', 'x'))
+    coretasks.track_isupport(bot, trigger)
+    assert bot.isupport == {
+        'CHANTYPES': '#',
+        'TARGMAX': {'JOIN': None, 'PRIVMSG': 4},
+        'LINELEN': '1024',
+    }
+
+
+def test_setup_survives_reload():
+    bot = willie.bot.Willie.__new__(willie.bot.Willie)
+    bot._cap_reqs = {}
+    bot.connection_registered = False
+    coretasks.setup(bot)
+    assert bot._cap_reqs['batch'] == [('', 'coretasks', None)]
+    # Reloading after the server didn't enable it must not raise.
+    bot.connection_registered = True
+    bot.enabled_capabilities = set()
+    coretasks.setup(bot)
+    assert bot._cap_reqs['batch'] == [('', 'coretasks', None)]
+
+
+def test_retry_join_runs_on_loop():
+    calls = []
+
+    class Loop(object):
+        def call_soon_threadsafe(self, func, *args):
+            calls.append((func, args))
+
+    bot = FakeBot()
+    bot.loop = Loop()
+    bot.retry_join = lambda channel: calls.append(channel) or True
+    line = ':irc.example.net 477 Willie #r :Identify first'
+    pretrigger = PreTrigger(bot.nick, line)
+    trigger = Trigger(Config(''), pretrigger, re.match('.*', line))
+    coretasks.retry_join(bot, trigger)
+    assert calls == [(coretasks._retry_join, (bot, '#r'))]
+    func, args = calls.pop()
+    func(*args)
+    assert calls == ['#r']
@@ -0,0 +1,177 @@
+# coding=utf8
+"""Tests for the lookup tables used to dispatch lines to callables"""
+from __future__ import unicode_literals
+
+import pytest
+
+from willie.bot import Willie
+from willie.config import Config, NetworkConfig
+from willie.tools import ExpiringDict, Identifier
+from willie.trigger import PreTrigger
+import willie.module
+
+
+class NullScheduler(object):
+    def clear_jobs(self):
+        pass
+
+    def add_job(self, job):
+        pass
+
+
+def make_callable(name, commands=(), rules=(), priority=None, events=()):
+    def func(bot, trigger):
+        pass
+    func.__name__ = str(name)
+    if commands:
+        willie.module.commands(*commands)(func)
+    for rule in rules:
+        willie.module.rule(rule)(func)
+    if priority:
+        willie.module.priority(priority)(func)
+    if events:
+        willie.module.event(*events)(func)
+    return func
+
+
+@pytest.fixture
+def bot():
+    bot = Willie.__new__(Willie)
+    bot.config = Config('')
+    bot.nick = Identifier('Willie')
+    bot.doc = {}
+    bot.scheduler = NullScheduler()
+    bot.times = ExpiringDict(0)
+    bot.networks = [bot]
+    bot.callables = set([
+        make_callable('hello', commands=['hello', 'hi']),
+        make_callable('regex', commands=['t(ime)?']),
+        make_callable('urls', rules=[r'.*https?://']),
+        make_callable('early', commands=['hello'], priority='high'),
+        make_callable('joins', rules=['.*'], events=['JOIN']),
+        make_callable('everything', rules=['.*'], events=['*'],
+                      priority='low'),
+        willie.module.rate(30)(make_callable('slow', commands=['slow'])),
+    ])
+    bot.bind_commands()
+    return bot
+
+
+def matching(bot, text, event='PRIVMSG'):
+    names = []
+    for priority in ('high', 'medium', 'low'):
+        for regexp, funcs in bot._candidates(event, priority, text):
+            if regexp.match(text):
+                names.extend(f.__name__ for f in funcs)
+    return [name for name in names if name != 'everything']
+
+
+def test_literal_command_words():
+    assert Willie._literal_command_words('hello') == set(['hello'])
+    assert Willie._literal_command_words('J|Join') == set(['j', 'join'])
+    assert Willie._literal_command_words('t(ime)?') is None
+    assert Willie._literal_command_words(None) is None
+
+
+def test_indexed_command(bot):
+    assert matching(bot, '.HELLO there') == ['early', 'hello']
+    assert matching(bot, '.hi') == ['hello']
+    assert matching(bot, '.hellothere') == []
+
+
+def test_unindexed_patterns(bot):
+    assert matching(bot, '.time') == ['regex']
+    assert sorted(matching(bot, '.hi http://example.com')) == ['hello', 'urls']
+    assert matching(bot, 'see http://example.com') == ['urls']
+
+
+def test_index_agrees_with_scan(bot):
+    for text in ('.hello', '.hi x', '.t', '.time y', 'http://a', '.nope'):
+        scanned = []
+        for priority in ('high', 'medium', 'low'):
+            for regexp, funcs in bot.commands[priority].items():
+                if regexp.match(text):
+                    scanned.extend(f.__name__ for f in funcs
+                                   if 'PRIVMSG' in f.event and
+                                   f.__name__ != 'everything')
+        assert sorted(matching(bot, text)) == sorted(scanned)
+
+
+def test_event_buckets(bot):
+    assert matching(bot, '#channel', 'JOIN') == ['joins']
+    assert matching(bot, '.hello', 'NOTICE') == []
+    assert 'joins' not in matching(bot, 'anything')
+
+
+def test_wildcard_event(bot):
+    for event in ('PRIVMSG', 'JOIN', 'MODE', '353'):
+        table = bot._candidates(event, 'low', 'some text')
+        assert [f.__name__ for _, funcs in table for f in funcs] == [
+            'everything']
+
+
+def test_rate_limit_history_follows_longest_rate(bot):
+    assert bot.times.max_age == 30
+
+
+def test_shard_routing():
+    config = Config('')
+    shards = []
+    for nick, channels in (('Willie', '#a'), ('Willie2', '#b,#c')):
+        shard = Willie.__new__(Willie)
+        shard.config = NetworkConfig(config, nick=nick, channels=channels)
+        shard.channels = []
+        shard.shards = shards
+        shards.append(shard)
+    first, second = shards
+    first.channels.append(Identifier('#c'))
+    assert first.route('#A') is first
+    assert first.route('#b') is second
+    assert second.route('#c') is first
+    assert second.route('Someone') is second
+    assert first.route('#elsewhere') is first
+
+
+def test_shards_handle_their_own_lines():
+    config = Config('')
+    shards = []
+    for nick in ('Willie', 'Willie2'):
+        shard = Willie.__new__(Willie)
+        shard.config = NetworkConfig(config, shard=nick, nick=nick,
+                                     channels='')
+        shard.nick = Identifier(nick)
+        shard.channels = [Identifier('#c')]
+        shard.shards = shards
+        shards.append(shard)
+    first, second = shards
+
+    def handled(line):
+        pretrigger = PreTrigger(second.nick, line)
+        return [shard.handles(pretrigger) for shard in shards]
+    assert handled(':Foo!f@h PRIVMSG #c :hi') == [True, False]
+    assert handled(':Willie2!w@h PRIVMSG #c :hi') == [True, True]
+    assert handled(':Foo!f@h PRIVMSG Willie2 :hi') == [True, True]
+    assert handled(':Willie2!w@h JOIN #c') == [True, True]
+    assert handled(':Foo!f@h QUIT :#c is boring') == [True, True]
+    assert handled(':Foo!f@h KICK #c Willie2 :bye') == [True, True]
+
+
+def test_blocklist_rebuilt_for_every_network():
+    config = Config('')
+    networks = []
+    for nick in ('Willie', 'Willie2'):
+        network = Willie.__new__(Willie)
+        network.config = NetworkConfig(config, shard=nick, nick=nick)
+        network.networks = networks
+        networks.append(network)
+    first, second = networks
+    first.rebuild_blocklist()
+    assert not second._blocklist.nick_blocked(Identifier('Spammer'))
+    first.config.core.nick_blocks = ['spam.*']
+    first.rebuild_blocklist()
+    assert second._blocklist.nick_blocked(Identifier('Spammer'))
+
+
+def test_stats_name_cached_when_bound(bot):
+    for func in bot.callables:
+        assert func.stats_name == 'test_dispatch.' + func.__name__
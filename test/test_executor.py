@@ -0,0 +1,105 @@
+# coding=utf8
+"""Tests for the callable worker pool"""
+from __future__ import unicode_literals
+
+import threading
+
+import pytest
+
+from willie.executor import WorkerPool
+
+
+def noop():
+    pass
+
+
+def queued(pool):
+    return [item.priority for priority in ('high', 'medium', 'low')
+            for item in pool._queues[priority]]
+
+
+def test_runs_work():
+    pool = WorkerPool(size=2)
+    done = threading.Event()
+    assert pool.submit(done.set)
+    assert done.wait(5)
+    pool.shutdown()
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        WorkerPool(size=0, overflow='explode')
+
+
+def test_reject():
+    pool = WorkerPool(size=0, max_queue=2, overflow='reject')
+    assert pool.submit(noop, priority='low')
+    assert pool.submit(noop, priority='low')
+    assert not pool.submit(noop, priority='high')
+    assert pool.qsize() == 2
+    assert pool.dropped == 1
+
+
+def test_drop_lowest_priority():
+    pool = WorkerPool(size=0, max_queue=2, overflow='drop')
+    pool.submit(noop, priority='medium')
+    pool.submit(noop, priority='low')
+    assert pool.submit(noop, priority='high')
+    assert queued(pool) == ['high', 'medium']
+    assert not pool.submit(noop, priority='low')
+    assert queued(pool) == ['high', 'medium']
+    assert pool.dropped == 2
+
+
+def test_high_priority_first():
+    pool = WorkerPool(size=0)
+    order = []
+    for priority in ('low', 'medium', 'high', 'low', 'high'):
+        pool.submit(order.append, (priority,), priority)
+    for _ in range(5):
+        item = pool._next()
+        item.func(*item.args)
+    assert order == ['high', 'high', 'medium', 'low', 'low']
+
+
+def test_defer_low_priority():
+    pool = WorkerPool(size=0, low_threshold=2, low_policy='defer')
+    pool.submit(noop, priority='medium')
+    pool.submit(noop, priority='medium')
+    assert pool.submit(noop, priority='low')
+    assert pool.depths() == {'high': 0, 'medium': 2, 'low': 0, 'deferred': 1}
+    pool._next()
+    assert pool.depths() == {'high': 0, 'medium': 1, 'low': 1, 'deferred': 0}
+
+
+def test_drop_low_priority():
+    pool = WorkerPool(size=0, low_threshold=1, low_policy='drop')
+    pool.submit(noop, priority='high')
+    assert not pool.submit(noop, priority='low')
+    assert pool.qsize() == 1
+    assert pool.dropped == 1
+
+
+def test_loop_never_blocks():
+    pool = WorkerPool(size=0, max_queue=1, overflow='block')
+    pool.submit(noop, priority='low')
+    # The caller can't wait, so the lower priority item makes room.
+    assert pool.submit(noop, priority='high', block=False)
+    assert pool.depths()['high'] == 1
+    assert pool.dropped == 1
+
+
+def test_low_threshold_at_least_one():
+    with pytest.raises(ValueError):
+        WorkerPool(size=0, low_threshold=0)
+
+
+def test_deferred_released_when_idle():
+    pool = WorkerPool(size=0, low_threshold=1, low_policy='defer')
+    pool.submit(noop, priority='medium')
+    pool.submit(noop, priority='low')
+    pool._queues['medium'].clear()
+    # Nothing was popped to bring it back, but the queues are now empty.
+    item = pool._next()
+    assert item.priority == 'low'
+    assert pool.depths()['deferred'] == 0
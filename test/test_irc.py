@@ -0,0 +1,292 @@
+# coding=utf8
+"""Tests for the IRC connection core"""
+from __future__ import unicode_literals
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from willie.config import Config
+from willie.tools import Identifier
+import willie.irc
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def is_closing(self):
+        return False
+
+
+@pytest.fixture
+def bot():
+    config = Config('')
+    config.core.nick = 'Willie'
+    config.core.log_raw = False
+    config.core.host = 'irc.example.net'
+    bot = willie.irc.Bot(config.core)
+    bot.config = config
+    bot.loop = asyncio.new_event_loop()
+    bot._loop_thread = threading.current_thread()
+    bot.transport = FakeTransport()
+    yield bot
+    bot.loop.close()
+
+
+def test_writes_are_coalesced(bot):
+    def burst():
+        for channel in ('#a', '#b', '#c'):
+            bot.write(('JOIN', channel))
+
+    bot.loop.call_soon(burst)
+    bot.loop.run_until_complete(asyncio.sleep(0.01))
+    assert bot.transport.writes == [b'JOIN #a\r\nJOIN #b\r\nJOIN #c\r\n']
+
+
+def test_paused_writing_holds_output(bot):
+    bot.pause_writing()
+    bot.write(('PING', 'x'))
+    bot.loop.run_until_complete(asyncio.sleep(0.01))
+    assert bot.transport.writes == []
+    bot.resume_writing()
+    assert bot.transport.writes == [b'PING x\r\n']
+
+
+@pytest.fixture
+def lines(bot):
+    lines = []
+    bot.handle_lines = lines.extend
+    return lines
+
+
+def receive(bot, data):
+    buf = bot.get_buffer()
+    buf[:len(data)] = data
+    bot.buffer_updated(len(data))
+
+
+def test_framing(bot, lines):
+    receive(bot, b':a PRIVMSG #c :one\r\n:a PRIVMSG #c :t')
+    assert lines == [':a PRIVMSG #c :one']
+    receive(bot, b'wo\r\n\r\nPING :x\n')
+    assert lines == [':a PRIVMSG #c :one', ':a PRIVMSG #c :two', 'PING :x']
+
+
+def test_split_multibyte_character(bot, lines):
+    data = ':a PRIVMSG #c :caf\u00e9\r\n'.encode('utf-8')
+    receive(bot, data[:-3])
+    receive(bot, data[-3:])
+    assert lines == [':a PRIVMSG #c :caf\u00e9']
+
+
+def test_fallback_encoding(bot, lines):
+    bot.handle_read(b':a PRIVMSG #c :caf\xe9\r\n')
+    assert lines == [':a PRIVMSG #c :caf\u00e9']
+
+
+def test_overlong_line_discarded(bot, lines):
+    bot.handle_read(b'x' * (bot.recv_buffer_size + 10) + b'\r\nPING :y\r\n')
+    assert lines == ['PING :y']
+
+
+def test_ping_timeout_adapts_to_lag(bot):
+    assert bot.ping_interval == 60
+    assert bot.ping_timeout == 120
+    bot._ping_sent = time.monotonic() - 10
+    bot._ping_token = 'willie-1'
+    bot._handle_pong('other')
+    assert bot.lag is None
+    bot._handle_pong('willie-1')
+    assert bot.lag == pytest.approx(10, abs=0.1)
+    assert bot.ping_timeout == pytest.approx(150, abs=0.5)
+    bot.lag_average = 100
+    assert bot.ping_timeout == 240
+
+
+def test_keepalive(bot):
+    closed = []
+    bot.handle_close = lambda: closed.append(True)
+    bot.connected = True
+    now = time.monotonic()
+    bot._last_received = now
+    bot._last_ping = now - 61
+    bot._keepalive()
+    bot.loop.run_until_complete(asyncio.sleep(0.01))
+    assert bot.transport.writes == [b'PING willie-1\r\n']
+    assert not closed
+    # The PONG never came; another PING goes out.
+    bot._last_ping = bot._ping_sent = now - 61
+    bot._keepalive()
+    bot.loop.run_until_complete(asyncio.sleep(0.01))
+    assert bot.transport.writes[-1] == b'PING willie-2\r\n'
+    assert bot._keepalive_timer is not None
+    bot._last_received = now - 121
+    bot._keepalive()
+    assert closed
+    bot._stop_keepalive()
+
+
+def test_netsplit_batch(bot):
+    dispatched = []
+    bot.dispatch = dispatched.append
+    bot.handle_line(':irc.example.net BATCH +x netsplit a.net b.net')
+    bot.handle_line('@batch=x :Foo!f@h QUIT :a.net b.net')
+    bot.handle_line('@batch=x :Bar!b@h QUIT :a.net b.net')
+    bot.handle_line(':Baz!b@h PRIVMSG #c :not in the batch')
+    assert [p.event for p in dispatched] == ['PRIVMSG']
+    bot.handle_line(':irc.example.net BATCH -x')
+    assert [p.event for p in dispatched] == ['PRIVMSG', 'BATCH']
+    batch = dispatched[1].batch
+    assert batch.type == 'netsplit'
+    assert batch.params == ['a.net', 'b.net']
+    assert batch.nicks('QUIT') == ['Foo', 'Bar']
+
+
+def test_other_batches_not_held(bot):
+    dispatched = []
+    bot.dispatch = dispatched.append
+    bot.handle_line(':irc.example.net BATCH +y chathistory #c')
+    bot.handle_line('@batch=y :Foo!f@h PRIVMSG #c :hi')
+    bot.handle_line(':irc.example.net BATCH -y')
+    assert [p.event for p in dispatched] == ['BATCH', 'PRIVMSG', 'BATCH']
+    assert all(p.batch is None for p in dispatched)
+
+
+def test_reset_connection_state(bot):
+    bot.nick = Identifier('Willie_')
+    bot.channels.append(Identifier('#c'))
+    bot.connection_registered = True
+    bot.handle_disconnect()
+    assert bot._was_registered
+    bot.write(('PING', 'stale'))
+    bot.reset_connection_state()
+    assert bot.nick == 'Willie'
+    assert bot.channels == []
+    assert not bot.connection_registered
+    assert bot._output == []
+
+
+def test_pack_joins():
+    lines = willie.irc.pack_joins(['#a', '#b secret', '#c', '#d'],
+                                  max_targets=3)
+    assert lines == [(['#b', '#a', '#c'], ['secret']), (['#d'], [])]
+    lines = willie.irc.pack_joins(['#%03d' % i for i in range(200)],
+                                  max_length=100)
+    assert all(len('JOIN ' + ','.join(names)) <= 100 for names, _ in lines)
+    assert sum(len(names) for names, _ in lines) == 200
+
+
+def test_throttled_joins(bot):
+    bot.isupport['TARGMAX'] = {'JOIN': 4}
+    bot.config.core.throttle_join = '6'
+    start = time.monotonic()
+    bot.join_channels(['#%d' % i for i in range(10)])
+    bot.loop.run_until_complete(asyncio.sleep(0.01))
+    assert bot.transport.writes == [b'JOIN #0,#1,#2,#3\r\n']
+    assert bot.join_progress.sent == 4
+    bot.loop.run_until_complete(asyncio.sleep(2.1))
+    assert b''.join(bot.transport.writes).count(b'JOIN') == 3
+    assert time.monotonic() - start >= 2
+    progress = bot.join_progress
+    assert progress.sent == progress.total == 10
+    for i in range(9):
+        assert not progress.answered('#%d' % i)
+    assert progress.answered('#9', joined=False)
+    assert str(progress).startswith('9/10 joined, 1 failed in ')
+
+
+def test_join_progress_normalises_channels(bot):
+    bot.config.core.channels = '#a, #b,#c,'
+    channels = bot.config.core.get_list('channels')
+    assert willie.irc.split_channels(channels) == [
+        ('#a', ''), ('#b', ''), ('#c', '')]
+    bot.join_channels(channels)
+    progress = bot.join_progress
+    assert progress.total == 3
+    for channel in ('#a', '#b'):
+        assert not progress.answered(channel)
+    assert progress.answered('#C')
+    assert str(progress).startswith('3/3 joined')
+
+
+def test_join_fallback_cancelled(bot):
+    bot.join_channels_later(10)
+    fallback = bot._join_fallback
+    bot.handle_disconnect()
+    assert fallback.cancelled()
+    bot.join_channels_later(10)
+    fallback = bot._join_fallback
+    bot.join_channels(['#a'])
+    assert fallback.cancelled()
+    assert bot._join_fallback is None
+
+
+def test_join_retry_backoff(bot, monkeypatch):
+    monkeypatch.setattr(willie.irc.random, 'uniform', lambda low, high: high)
+    delays = []
+    for attempt in range(bot.join_retry_attempts):
+        assert bot.retry_join('#r')
+        attempts, key, timer = bot.join_retries['#r']
+        assert attempts == attempt + 1
+        delays.append(round(timer.when() - bot.loop.time()))
+    assert delays[:4] == [6, 12, 24, 48]
+    assert max(delays) == bot.join_retry_max_delay
+    assert not bot.retry_join('#r')
+    assert '#r' not in bot.join_retries
+    assert timer.cancelled()
+
+
+def test_join_retry_cancelled(bot):
+    bot.retry_join('#r')
+    _, _, timer = bot.join_retries['#r']
+    bot.cancel_join_retry('#R')
+    assert timer.cancelled()
+    assert len(bot.join_retries) == 0
+
+
+def test_join_retry_keeps_key(bot):
+    bot.config.core.channels = ['#a', '#Keyed secret']
+    bot.retry_join('#keyed')
+    assert bot.join_retries['#keyed'][1] == 'secret'
+    bot.retry_join('#keyed')
+    assert bot.join_retries['#keyed'][1] == 'secret'
+    bot.retry_join('#a')
+    assert bot.join_retries['#a'][1] is None
+    bot.retry_join('#b', 'other')
+    bot.retry_join('#b')
+    assert bot.join_retries['#b'][1] == 'other'
+
+
+def test_join_retry_eviction_cancels_timer(bot):
+    bot.join_retries.max_size = 1
+    bot.retry_join('#r')
+    _, _, timer = bot.join_retries['#r']
+    bot.retry_join('#s')
+    assert '#r' not in bot.join_retries
+    assert timer.cancelled()
+
+
+def test_coroutine_tasks_kept(bot, caplog):
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError('boom')
+
+    task = bot.run_coroutine(fail())
+    assert bot._tasks == {task}
+    bot.loop.run_until_complete(asyncio.sleep(0.01))
+    assert bot._tasks == set()
+    assert 'Unhandled exception in coroutine' in caplog.text
+
+
+def test_connection_name(bot):
+    assert bot.connection_name is None
+    bot.network = 'example'
+    assert bot.connection_name == 'example'
+    bot.shard = 'Willie2'
+    assert bot.connection_name == 'example.Willie2'
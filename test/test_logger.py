@@ -0,0 +1,56 @@
+# coding=utf8
+"""Tests for the raw log writer"""
+from __future__ import unicode_literals
+
+import gzip
+import os
+
+import pytest
+
+from willie.logger import RawLogWriter
+
+
+def test_raw_log_written(tmpdir):
+    filename = str(tmpdir.join('raw.log'))
+    writer = RawLogWriter(filename)
+    writer.write('>>', 'PING :abc\r\n')
+    writer.write('<<', ':server PONG :abc')
+    writer.close()
+    with open(filename, 'rb') as f:
+        lines = f.read().split(b'\n')[:-1]
+    assert len(lines) == 2
+    assert lines[0].startswith(b'>>')
+    assert lines[0].endswith(b'\tPING :abc\r')
+    assert lines[1].endswith(b'\t:server PONG :abc')
+
+
+def test_raw_log_rotation(tmpdir):
+    filename = str(tmpdir.join('raw.log'))
+    writer = RawLogWriter(filename, max_bytes=100, backups=2)
+    for batch in range(4):
+        writer.write('>>', 'x' * 100)
+        # Close and reopen so that each line gets a batch of its own.
+        writer.close()
+        writer = RawLogWriter(filename, max_bytes=100, backups=2)
+    writer.close()
+    segments = sorted(fn for fn in os.listdir(str(tmpdir)) if fn != 'raw.log')
+    assert len(segments) == 2
+    assert all(fn.endswith('.gz') for fn in segments)
+    with gzip.open(str(tmpdir.join(segments[0]))) as f:
+        assert b'x' * 100 in f.read()
+
+
+def test_raw_log_policy():
+    with pytest.raises(ValueError):
+        RawLogWriter('raw.log', policy='sometimes')
+
+
+def test_raw_log_close_without_waiting(tmpdir):
+    filename = str(tmpdir.join('raw.log'))
+    writer = RawLogWriter(filename)
+    writer.write('>>', 'PING :abc\r\n')
+    writer.close(wait=False)
+    writer.join()
+    assert not writer.alive()
+    with open(filename, 'rb') as f:
+        assert f.read().endswith(b'\tPING :abc\r\n')
@@ -0,0 +1,100 @@
+# coding=utf8
+"""Tests for the outbound message queues"""
+from __future__ import unicode_literals
+
+import asyncio
+
+import pytest
+
+from willie.outbound import OutboundQueue, TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(capacity=2, rate=1)
+    now = bucket.updated
+    assert bucket.delay(1, now) == 0
+    bucket.consume(1, now)
+    bucket.consume(1, now)
+    assert bucket.delay(1, now) == pytest.approx(1)
+    assert bucket.delay(1, now + 1) == 0
+    assert not bucket.full(now + 1)
+    assert bucket.full(now + 2)
+
+
+def test_token_bucket_default_pacing():
+    bucket = TokenBucket(capacity=1, rate=1)
+    now = bucket.updated
+    assert bucket.delay(0.7, now) == 0
+    bucket.consume(0.7, now)
+    # Each line waits its whole cost after the one before, as msg used to.
+    assert bucket.delay(0.7, now) == pytest.approx(0.7)
+    assert bucket.delay(2.5, now) == pytest.approx(2.5)
+    bucket.consume(2.5, now + 2.5)
+    assert bucket.delay(0.7, now + 2.5) == pytest.approx(0.7)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def test_queues_are_independent(loop):
+    sent = []
+    queue = OutboundQueue(lambda args, text: sent.append((args[1], text)),
+                          lambda func: None, burst=1, rate=10)
+
+    async def run():
+        first = [queue.put('#a', ('PRIVMSG', '#a'), str(i)) for i in range(3)]
+        other = queue.put('#b', ('PRIVMSG', '#b'), 'hello')
+        queue.drain()
+        # One line each goes straight out; #a's other lines have to wait
+        assert sent == [('#a', '0'), ('#b', 'hello')]
+        assert other.result() is True
+        assert not first[1].done()
+        await asyncio.sleep(0.35)
+        return first
+
+    first = loop.run_until_complete(run())
+    assert [text for target, text in sent if target == '#a'] == ['0', '1', '2']
+    assert all(future.result() for future in first)
+    assert len(queue) == 0
+
+
+def test_default_spacing(loop):
+    sent = []
+    queue = OutboundQueue(lambda args, text: sent.append(loop.time()),
+                          lambda func: None)
+
+    async def run():
+        for i in range(2):
+            queue.put('#a', ('PRIVMSG', '#a'), str(i), 0.7)
+        queue.drain()
+        await asyncio.sleep(0.8)
+
+    loop.run_until_complete(run())
+    assert len(sent) == 2
+    assert sent[1] - sent[0] >= 0.7 - 0.01
+
+
+def test_cancel_and_clear(loop):
+    sent = []
+    queue = OutboundQueue(lambda args, text: sent.append(text),
+                          lambda func: None, burst=1, rate=1)
+
+    async def run():
+        queue.put('#a', ('PRIVMSG', '#a'), 'first')
+        cancelled = queue.put('#a', ('PRIVMSG', '#a'), 'second')
+        waiting = queue.put('#a', ('PRIVMSG', '#a'), 'third')
+        cancelled.cancel()
+        queue.drain()
+        queue.clear()
+        return waiting
+
+    waiting = loop.run_until_complete(run())
+    assert sent == ['first']
+    assert waiting.cancelled()
+    assert len(queue) == 0
@@ -0,0 +1,133 @@
+# coding=utf8
+"""Tests for running callables in worker processes"""
+from __future__ import unicode_literals
+
+import os
+import re
+
+import pytest
+
+# willie.module can only be imported once the bot has been
+import willie.bot
+from willie.config import Config
+import willie.module
+import willie.process
+from willie.process import ProcessError, ProcessPool, ProcessTrigger, \
+    snapshot_trigger
+from willie.tools import Identifier
+from willie.trigger import PreTrigger, Trigger
+
+MODULE = '''
+def double(bot, trigger):
+    bot.say(trigger.group(2) * 2)
+    bot.reply('done', notice=True)
+    return 1
+
+def fail(bot, trigger):
+    raise ValueError(trigger.nick)
+
+def spin(bot, trigger):
+    while True:
+        pass
+
+def sleep(bot, trigger):
+    import time
+    time.sleep(30)
+'''
+
+
+class FakeBot(object):
+    nick = Identifier('Willie')
+
+    def __init__(self):
+        self.calls = []
+
+    def say(self, *args, **kwargs):
+        self.calls.append(('say', args, kwargs))
+
+    def reply(self, *args, **kwargs):
+        self.calls.append(('reply', args, kwargs))
+
+
+@pytest.fixture
+def module(tmpdir):
+    path = tmpdir.join('processtest.py')
+    path.write(MODULE)
+    return willie.process._load_module('processtest', str(path))
+
+
+@pytest.fixture
+def trigger():
+    line = ':Foo!foo@example.com PRIVMSG #c :.double ab'
+    pretrigger = PreTrigger(Identifier('Willie'), line)
+    match = re.match(r'\.(\w+) (\w+)', pretrigger.args[-1])
+    return Trigger(Config(''), pretrigger, match)
+
+
+@pytest.fixture
+def pool():
+    pool = ProcessPool(size=1, cpu_limit=1, time_limit=3)
+    yield pool
+    pool.shutdown()
+
+
+def test_process_trigger(trigger):
+    copy = ProcessTrigger(snapshot_trigger(trigger))
+    assert copy == trigger
+    assert copy.nick == trigger.nick
+    assert copy.group(0) == '.double ab'
+    assert copy.group(1, 2) == ('double', 'ab')
+    assert copy.groups() == ('double', 'ab')
+    assert copy.admin is False
+
+
+def test_messages_proxied(pool, module, trigger):
+    bot = FakeBot()
+    assert pool.call(module.double, bot, trigger) == 1
+    assert bot.calls == [('say', ('abab',), {}),
+                         ('reply', ('done',), {'notice': True})]
+    assert len(pool) == 1
+
+
+def test_error_keeps_worker(pool, module, trigger):
+    with pytest.raises(ProcessError) as excinfo:
+        pool.call(module.fail, FakeBot(), trigger)
+    assert 'ValueError: Foo' in str(excinfo.value)
+    assert pool.killed == 0
+    assert pool.call(module.double, FakeBot(), trigger) == 1
+
+
+def test_cpu_limit(pool, module, trigger):
+    with pytest.raises(ProcessError):
+        pool.call(module.spin, FakeBot(), trigger)
+    assert pool.killed == 1
+    assert len(pool) == 0
+    # A new worker takes its place
+    assert pool.call(module.double, FakeBot(), trigger) == 1
+
+
+def test_time_limit(pool, module, trigger):
+    with pytest.raises(ProcessError) as excinfo:
+        pool.call(module.sleep, FakeBot(), trigger)
+    assert 'ran out of time' in str(excinfo.value)
+    assert pool.killed == 1
+    assert pool.call(module.double, FakeBot(), trigger) == 1
+
+
+def test_changed_module_reloaded(pool, module, trigger):
+    bot = FakeBot()
+    pool.call(module.double, bot, trigger)
+    with open(module.__file__, 'w') as f:
+        f.write(MODULE.replace('* 2', '* 3'))
+    mtime = os.path.getmtime(module.__file__) + 10
+    os.utime(module.__file__, (mtime, mtime))
+    pool.call(module.double, bot, trigger)
+    assert bot.calls[-2] == ('say', ('ababab',), {})
+
+
+def test_bare_decorator():
+    @willie.module.process
+    def func(bot, trigger):
+        pass
+    assert func.process is True
+    assert willie.module.process(False)(func).process is False
@@ -0,0 +1,265 @@
+# coding=utf8
+"""Tests for the job scheduler"""
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import pytest
+
+from willie.bot import Willie
+from willie.config import Config
+from willie.db import WillieDB
+from willie.stats import StatsRegistry
+import willie.module
+
+
+class InlineExecutor(object):
+    def submit(self, func, args, priority='medium', name=None):
+        func(*args)
+
+
+class FakeBot(object):
+    def __init__(self):
+        self.executor = InlineExecutor()
+        self.stats = StatsRegistry()
+
+    def error(self, trigger=None):
+        raise
+
+
+@pytest.fixture
+def db(tmpdir):
+    config = Config('')
+    config.core.db_filename = str(tmpdir.join('jobs.db'))
+    return WillieDB(config)
+
+
+@pytest.fixture
+def scheduler(db):
+    bot = FakeBot()
+    bot.db = db
+    scheduler = Willie.JobScheduler(bot)
+    scheduler.daemon = True
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+    scheduler.join(1)
+
+
+def test_call_later(scheduler):
+    called = threading.Event()
+    start = time.monotonic()
+    scheduler.call_later(0.05, called.set)
+    assert called.wait(1)
+    assert time.monotonic() - start >= 0.05
+    assert len(scheduler) == 0
+
+
+def test_add_job_wakes_scheduler(scheduler):
+    # The scheduler is asleep with nothing to do, until a job comes along.
+    time.sleep(0.05)
+    calls = []
+    done = threading.Event()
+
+    def job(bot):
+        calls.append(bot)
+        if len(calls) == 3:
+            done.set()
+    start = time.monotonic()
+    scheduler.add_job(Willie.Job(0.02, job))
+    assert done.wait(1)
+    assert time.monotonic() - start < 0.5
+    assert calls[0] is scheduler.bot
+
+
+def test_cancel(scheduler):
+    called = []
+    job = scheduler.call_later(0.05, called.append, 'x')
+    job.cancel()
+    time.sleep(0.1)
+    assert called == []
+    assert len(scheduler) == 0
+
+
+def test_clear_jobs_keeps_timers(scheduler):
+    called = threading.Event()
+    scheduler.add_job(Willie.Job(60, lambda bot: None))
+    scheduler.call_later(60, called.set)
+    scheduler.call_later(0.05, called.set)
+    assert len(scheduler) == 3
+    scheduler.clear_jobs()
+    assert len(scheduler) == 2
+    assert called.wait(1)
+
+
+def test_job_skips_runs_when_behind(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    job = Willie.Job(10, lambda bot: None)
+    assert job.next_time == 110
+    now[0] = 200
+    job.next()
+    # Due at 120, 130 ... 200; only the last max_catchup and the current
+    # one are still run.
+    assert job.skipped == 3
+    assert job.next_time == 150
+
+
+class ThreadExecutor(object):
+    def submit(self, func, args, priority='medium', name=None):
+        threading.Thread(target=func, args=args).start()
+
+
+def test_job_accounting(scheduler):
+    scheduler.bot.executor = ThreadExecutor()
+    done = threading.Event()
+
+    @willie.module.overlap('allow')
+    def slow(bot):
+        time.sleep(0.08)
+        done.set()
+    job = Willie.Job(0.05, slow)
+    scheduler.add_job(job)
+    assert done.wait(1)
+    time.sleep(0.1)
+    job.cancel()
+    stats = scheduler.bot.stats.jobs[job.name]
+    assert job.name.endswith('.slow every 0.05s')
+    assert stats.drift.count >= 2
+    assert stats.overlapping >= 1 and job.overlaps >= 1
+    assert job.duration >= 0.08
+    assert stats.run.max >= 0.08
+
+
+def run_slow_job(scheduler, policy):
+    scheduler.bot.executor = ThreadExecutor()
+    calls = []
+
+    @willie.module.overlap(policy)
+    def slow(bot):
+        calls.append(time.monotonic())
+        time.sleep(0.12)
+    job = Willie.Job(0.05, slow)
+    scheduler.add_job(job)
+    time.sleep(0.3)
+    job.cancel()
+    time.sleep(0.15)
+    return job, calls
+
+
+def test_overlap_skip(scheduler):
+    job, calls = run_slow_job(scheduler, 'skip')
+    assert job.overlaps == 0 and job.running == 0
+    # The first run ends at 0.17s, so the next one is the tick at 0.2s.
+    assert calls[1] - calls[0] == pytest.approx(0.15, abs=0.03)
+    assert job.skipped >= 2
+    assert scheduler.bot.stats.jobs[job.name].skipped == job.skipped
+
+
+def test_overlap_queue(scheduler):
+    job, calls = run_slow_job(scheduler, 'queue')
+    assert job.overlaps == 0 and job.running == 0
+    # Each queued run starts as soon as the one before it finishes.
+    assert len(calls) >= 2
+    assert calls[1] - calls[0] == pytest.approx(0.12, abs=0.03)
+
+
+def test_timeout_disables_job(scheduler):
+    calls = []
+
+    @willie.module.timeout(0.01, disable_after=2)
+    def slow(bot):
+        calls.append(bot)
+        time.sleep(0.02)
+    job = Willie.Job(0.03, slow)
+    scheduler.add_job(job)
+    time.sleep(0.3)
+    assert len(calls) == 2
+    assert job.cancelled
+    assert job.overruns == 2
+    assert scheduler.bot.stats.jobs[job.name].timeouts == 2
+
+
+stored_calls = []
+
+
+def stored(bot, *args):
+    stored_calls.append(args)
+
+
+def test_stored_jobs(scheduler, db):
+    del stored_calls[:]
+    now = time.time()
+    soon = scheduler.store_job(now + 0.5, stored, ['soon', 1])
+    later = scheduler.store_job(now + 3600, stored, ['later'])
+    assert [job.stored_id for job in scheduler.jobs()] == [soon]
+    time.sleep(0.7)
+    assert stored_calls == [('soon', 1)]
+    assert [row[0] for row in db.get_due_jobs(now + 7200)] == [later]
+    scheduler.remove_stored_job(later)
+    assert db.get_due_jobs(now + 7200) == []
+
+
+def test_stored_jobs_survive_restart(db):
+    del stored_calls[:]
+    now = time.time()
+    db.add_job('test_scheduler.stored', now - 25, 10, ['missed'])
+    db.add_job('test_scheduler.stored', now + 3600, None, ['later'])
+    bot = FakeBot()
+    bot.db = db
+    scheduler = Willie.JobScheduler(bot)
+    scheduler.load_stored_jobs()
+    assert len(scheduler._stored) == 1
+    scheduler.daemon = True
+    scheduler.start()
+    try:
+        time.sleep(0.1)
+    finally:
+        scheduler.stop()
+    # The missed runs are made up with one call, and the job moves on.
+    assert stored_calls == [('missed',)]
+    next_time = db.get_due_jobs(now + 60)[0][2]
+    assert next_time == pytest.approx(now + 5)
+    stats = bot.stats.jobs['test_scheduler.stored every 10.0s']
+    assert stats.skipped == 2
+
+
+def test_stored_job_kept_until_run_ends(scheduler, db):
+    scheduler.bot.executor = ThreadExecutor()
+    started = threading.Event()
+    finish = threading.Event()
+
+    def slow(bot):
+        started.set()
+        finish.wait(1)
+    slow.__module__ = __name__
+    globals()['slow'] = slow
+    now = time.time()
+    job_id = scheduler.store_job(now, slow)
+    assert started.wait(1)
+    # A crash now would leave the job to run again on the next start.
+    assert [row[0] for row in db.get_due_jobs(now)] == [job_id]
+    finish.set()
+    time.sleep(0.1)
+    assert db.get_due_jobs(now) == []
+
+
+@willie.module.overlap('queue')
+@willie.module.timeout(5, disable_after=2)
+def stored_policy(bot):
+    pass
+
+
+def test_stored_job_policies(db):
+    bot = FakeBot()
+    bot.db = db
+    scheduler = Willie.JobScheduler(bot)
+    job_id = scheduler.store_job(time.time() + 60, stored_policy,
+                                 interval=30)
+    # As loaded again after a restart
+    scheduler = Willie.JobScheduler(bot)
+    scheduler.load_stored_jobs()
+    job = scheduler._stored[job_id]
+    assert job.name.endswith('.stored_policy every 30.0s')
+    assert (job.overlap, job.timeout, job.disable_after) == ('queue', 5, 2)
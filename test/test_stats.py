@@ -0,0 +1,51 @@
+# coding=utf8
+"""Tests for callable instrumentation"""
+from __future__ import unicode_literals
+
+from willie.stats import Histogram, StatsRegistry, callable_name
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.percentile(50) == 0
+    for value in (0.001, 0.002, 0.003, 0.004, 2):
+        histogram.add(value)
+    assert histogram.count == 5
+    assert histogram.max == 2
+    assert histogram.percentile(40) == 0.0025
+    assert histogram.percentile(50) == 0.005
+    assert histogram.percentile(100) == 2
+    assert len(histogram.buckets) == len(Histogram.bounds)
+
+
+def test_registry():
+    stats = StatsRegistry()
+    stats.record_run('mod.slow', 1.0)
+    stats.record_run('mod.slow', 1.0, error=True)
+    stats.record_run('mod.fast', 0.001)
+    stats.record_wait('mod.fast', 0.5)
+    assert [s.name for s in stats.top()] == ['mod.slow', 'mod.fast']
+    assert [s.name for s in stats.top(key='wait')][0] == 'mod.fast'
+    assert stats['mod.slow'].errors == 1
+    assert stats['mod.slow'].report()[0] == 'mod.slow: 2 calls, 1 errors'
+    stats.record_matches([('mod.slow', 0.001), ('mod.new', 0.002)])
+    assert stats['mod.slow'].match.count == 1
+    assert stats['mod.new'].match.total == 0.002
+
+
+def test_callable_name():
+    assert callable_name(test_callable_name) == 'test_stats.test_callable_name'
+
+
+def test_job_stats():
+    stats = StatsRegistry()
+    stats.record_job_start('mod.tick every 5s', 0.5)
+    stats.record_job_start('mod.tick every 5s', 2.0, overlapping=True)
+    stats.record_job_run('mod.tick every 5s', 1.0, error=True)
+    stats.record_job_skipped('mod.tick every 5s', 3)
+    stats.record_job_timeout('mod.tick every 5s')
+    job = stats.jobs['mod.tick every 5s']
+    assert job.drift.count == 2 and job.drift.max == 2.0
+    assert job.report()[0] == ('mod.tick every 5s: 2 runs, 1 errors, '
+                               '3 skipped, 1 overlapping, 1 timed out')
+    assert 'Job stats' in stats.report()
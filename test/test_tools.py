@@ -0,0 +1,121 @@
+# coding=utf8
+"""Tests for the data structures in willie.tools"""
+from __future__ import unicode_literals
+
+import time
+
+from willie.tools import BlockList, ExpiringDict, Identifier, LRUCache
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_expiring_dict(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    store = ExpiringDict(60)
+    store['a'] = 1
+    now[0] += 30
+    store.setdefault('b', 2)
+    assert store['a'] == 1 and 'b' in store
+    now[0] += 40
+    store['c'] = 3
+    assert 'a' not in store
+    assert store['b'] == 2
+    assert store.expired == 1
+    # Setting a key again keeps it alive
+    store['b'] = 4
+    now[0] += 50
+    store['c'] = 5
+    assert sorted(store) == ['b', 'c']
+
+
+def test_expiring_dict_max_age_changed(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    store = ExpiringDict(0)
+    store['a'] = 1
+    store.max_age = 30
+    for i in range(100):
+        now[0] += 1
+        store[i] = i
+    assert 'a' not in store
+    assert len(store) <= 34
+    store.max_age = 5
+    assert len(store) <= 7
+    now[0] += 10
+    store['b'] = 2
+    assert sorted(store, key=str) == ['b']
+
+
+def test_expiring_dict_size_limit():
+    store = ExpiringDict(60, max_size=3)
+    for key in 'abcde':
+        store[key] = key
+    assert len(store) == 3
+    assert store.evicted == 2
+    del store['e']
+    assert len(store) == 2
+    assert store.pop('d') == 'd'
+    assert store.pop('d', None) is None
+    assert len(store) == 1
+
+
+def test_expiring_dict_on_expire():
+    thrown_away = []
+    store = ExpiringDict(60, max_size=2,
+                         on_expire=lambda key, value: thrown_away.append(
+                             (key, value)))
+    store['a'] = 1
+    store['b'] = 2
+    store.pop('b')
+    store['c'] = 3
+    store['d'] = 4
+    assert thrown_away == [('a', 1)]
+
+
+def test_blocklist_nicks():
+    blocks = BlockList(['Spammer', 'bot[0-9]+', ' '], [])
+    assert blocks
+    assert blocks.nick_blocked(Identifier('spammer'))
+    assert blocks.nick_blocked(Identifier('BOT42'))
+    assert not blocks.nick_blocked(Identifier('bot42x'))
+    assert not blocks.nick_blocked(Identifier('Willie'))
+
+
+def test_blocklist_hosts():
+    blocks = BlockList([], ['.*\\.example\\.com', 'evil.host', '[bad'])
+    assert blocks.host_blocked('spam.example.com')
+    assert not blocks.host_blocked('example.com.au')
+    assert blocks.host_blocked('EVIL.HOST')
+    # Invalid expressions still block exact matches
+    assert blocks.host_blocked('[bad')
+    assert not blocks.host_blocked('bad')
+
+
+def test_empty_blocklist():
+    blocks = BlockList()
+    assert not blocks
+    assert not blocks.nick_blocked(Identifier('anyone'))
+    assert not blocks.host_blocked('')
+
+
+def test_blocklist_patterns_kept_apart():
+    blocks = BlockList(['(?i)spam.*', '(a)\\1x', 'bot[0-9]+'],
+                       ['(?P<h>x)(?P=h)', '(?P<h>y)'])
+    assert blocks.nick_blocked(Identifier('SPAMMER'))
+    assert blocks.nick_blocked(Identifier('aax'))
+    assert not blocks.nick_blocked(Identifier('ax'))
+    assert blocks.nick_blocked(Identifier('bot7'))
+    assert blocks.host_blocked('xx')
+    assert not blocks.host_blocked('x')
+    assert blocks.host_blocked('Y')
@@ -2,9 +2,12 @@
 """Tests for message parsing"""
 from __future__ import unicode_literals
 
+import re
+
 import pytest
 
-from willie.trigger import PreTrigger, Trigger
+from willie.config import Config
+from willie.trigger import AccessMatcher, PreTrigger, Trigger
 from willie.tools import Identifier
 
 
@@ -27,4 +30,50 @@ def test_basic_pretrigger(nick):
     assert pretrigger.sender == '#octothorpe'
 
 # TODO tags, PRIVMSG to bot, intents
-# TODO Trigger tests, for what little actual logic is in there
+
+
+@pytest.fixture
+def config():
+    config = Config('')
+    config.core.owner = 'Owner'
+    config.core.admins = 'Admin,*@admin.example.com'
+    return config
+
+
+def make_trigger(config, nick, line):
+    pretrigger = PreTrigger(nick, line)
+    match = re.match('.*', pretrigger.args[-1])
+    return Trigger(config, pretrigger, match)
+
+
+def test_trigger_access(nick, config):
+    owner = make_trigger(config, nick, ':Owner!o@example.com PRIVMSG #c :hi')
+    assert owner.owner and owner.admin
+    admin = make_trigger(config, nick, ':Admin!a@example.com PRIVMSG #c :hi')
+    assert admin.admin and not admin.owner
+    by_host = make_trigger(config, nick, ':Foo!f@admin.example.com PRIVMSG #c :hi')
+    assert by_host.admin and not by_host.owner
+    user = make_trigger(config, nick, ':Foo!f@example.com PRIVMSG #c :hi')
+    assert not user.admin and not user.owner
+
+
+def test_access_follows_config(nick, config):
+    line = ':Foo!f@example.com PRIVMSG #c :hi'
+    assert not make_trigger(config, nick, line).admin
+    matcher = AccessMatcher.for_config(config)
+    assert AccessMatcher.for_config(config) is matcher
+    config.core.admins = ['Foo']
+    assert make_trigger(config, nick, line).admin
+    assert AccessMatcher.for_config(config) is not matcher
+
+
+def test_access_matcher_rebuilt_only_on_change(config):
+    matcher = AccessMatcher.for_config(config)
+    version = config.version
+    assert AccessMatcher.for_config(config) is matcher
+    assert config.version == version
+    config.core.nick_blocks = ['Spammer']
+    assert config.version > version
+    assert AccessMatcher.for_config(config) is matcher
+    config.core.owner = 'Someone'
+    assert AccessMatcher.for_config(config).owner_mask == 'Someone'
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 # coding=utf8
 """
 Willie - An IRC Bot
@@ -14,11 +14,8 @@ from __future__ import print_function
 import sys
 from willie.tools import stderr
 
-if sys.version_info < (2, 7):
-    stderr('Error: Requires Python 2.7 or later. Try python2.7 willie')
-    sys.exit(1)
-elif sys.version_info.major == 3 and sys.version_info.minor < 3:
-    stderr('Error: When running on Python 3, Python 3.3 is required.')
+if sys.version_info < (3, 5):
+    stderr('Error: Requires Python 3.5 or later. Try python3 willie')
     sys.exit(1)
 
 import os
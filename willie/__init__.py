@@ -14,7 +14,6 @@ from __future__ import absolute_import
 
 import sys
 import os
-import time
 import threading
 import traceback
 import signal
@@ -24,7 +23,9 @@ __version__ = '5.0.0-gamma'
 
 def run(config):
     import willie.bot as bot
+    import willie.irc as irc
     import willie.web as web
+    from willie.config import shard_configs
     import willie.logger
     from willie.tools import stderr
     if config.core.delay is not None:
@@ -41,40 +42,75 @@ def run(config):
         stderr('Could not open CA certificates file. SSL will not '
                'work properly.')
 
+    bots = []
+
     def signal_handler(sig, frame):
         if sig == signal.SIGUSR1 or sig == signal.SIGTERM:
             stderr('Got quit signal, shutting down.')
-            p.quit('Closing')
-    while True:
+            for p in bots:
+                p.quit('Closing')
+        elif sig == signal.SIGUSR2:
+            # This runs on the event loop's thread, which may be holding the
+            # locks the report needs, so it is written from another thread.
+            dumper = threading.Thread(target=dump_stats, name='stats dump')
+            dumper.daemon = True
+            dumper.start()
+
+    def dump_stats():
+        if not config.core.logdir:
+            config.core.logdir = os.path.join(config.core.homedir, 'logs')
+        filename = os.path.join(config.core.logdir, 'stats.log')
+        stderr('Got stats signal, writing stats to %s.' % filename)
+        try:
+            bots[0].stats.dump(filename)
+        except (IOError, OSError) as e:
+            stderr('Could not write stats to %s: %s' % (filename, e))
+
+    def set_signal_handlers():
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, signal_handler)
+        if hasattr(signal, 'SIGTERM'):
+            signal.signal(signal.SIGTERM, signal_handler)
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, signal_handler)
+
+    def log_critical_exception():
+        trace = traceback.format_exc()
         try:
-            p = bot.Willie(config)
-            if hasattr(signal, 'SIGUSR1'):
-                signal.signal(signal.SIGUSR1, signal_handler)
-            if hasattr(signal, 'SIGTERM'):
-                signal.signal(signal.SIGTERM, signal_handler)
-            willie.logger.setup_logging(p)
-            p.run(config.core.host, int(config.core.port))
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            trace = traceback.format_exc()
-            try:
-                stderr(trace)
-            except:
-                pass
-            logfile = open(os.path.join(config.logdir, 'exceptions.log'), 'a')
-            logfile.write('Critical exception in core')
-            logfile.write(trace)
-            logfile.write('----------------------------------------\n\n')
-            logfile.close()
-            os.unlink(config.pid_file_path)
-            os._exit(1)
+            stderr(trace)
+        except:
+            pass
+        logfile = open(os.path.join(config.logdir, 'exceptions.log'), 'a')
+        logfile.write('Critical exception in core')
+        logfile.write(trace)
+        logfile.write('----------------------------------------\n\n')
+        logfile.close()
+        os.unlink(config.pid_file_path)
+        os._exit(1)
 
-        if not isinstance(delay, int):
-            break
-        if p.hasquit or config.exit_on_error:
-            break
-        stderr('Warning: Disconnected. Reconnecting in %s seconds...' % delay)
-        time.sleep(delay)
+    try:
+        if config.networks or len(config.core.get_list('shard_nicks')) > 1:
+            # Several connections: one bot each, all sharing the modules,
+            # database and worker threads of the first, on one event loop.
+            for network in config.networks or [None]:
+                shards = []
+                for shard_config in shard_configs(config, network):
+                    primary = bots[0] if bots else None
+                    shards.append(bot.Willie(shard_config, primary))
+                for shard in shards:
+                    shard.shards = shards
+                bots.extend(shards)
+        else:
+            bots.append(bot.Willie(config))
+        set_signal_handlers()
+        willie.logger.setup_logging(bots[0])
+        # The bots are built once, and reconnect as they need to; modules
+        # are only shut down once they're all done.
+        irc.run_networks(bots, delay)
+        bots[0]._shutdown()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        log_critical_exception()
     os.unlink(config.pid_file_path)
     os._exit(0)
@@ -13,6 +13,9 @@ from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
 
+import asyncio
+import heapq
+import itertools
 import time
 import imp
 import os
@@ -25,9 +28,13 @@ from datetime import datetime
 from willie import tools
 import willie.irc as irc
 from willie.db import WillieDB
-from willie.tools import (stderr, PriorityQueue, Identifier, released, get_command_regexp,
-                          iteritems, itervalues, deprecated_5)
-from willie.trigger import Trigger
+from willie.executor import WorkerPool
+from willie.process import ProcessPool
+from willie.stats import StatsRegistry, callable_name, format_seconds
+from willie.tools import (stderr, Identifier, get_command_regexp,
+                          get_command_prefix_regexp, iteritems, itervalues,
+                          deprecated_5)
+from willie.trigger import AccessMatcher, Trigger
 import willie.module as module
 from willie.logger import get_logger
 
@@ -45,26 +52,43 @@ else:
 class Willie(irc.Bot):
     NOLIMIT = module.NOLIMIT
 
-    def __init__(self, config):
+    def __init__(self, config, primary=None):
         irc.Bot.__init__(self, config.core)
         self.config = config
         """The ``Config`` for the current Willie instance."""
-        self.doc = {}
+        self.network = getattr(config, 'network', None)
         """
-        A dictionary of command names to their docstring and example, if
-        declared. The first item in a callable's commands list is used as the
-        key in version *3.2* onward. Prior to *3.2*, the name of the function
-        as declared in the source code was used.
+        The name of the network this bot is connected to, when several are
+        configured with ``[network:NAME]`` sections, or None.
         """
-        self.stats = {}
+        self.shard = getattr(config, 'shard', None)
+        """The nick of this connection, when ``shard_nicks`` is set."""
+        if primary is not None:
+            self._primary_bot = primary
+        else:
+            self.doc = {}
+            """
+            A dictionary of command names to their docstring and example, if
+            declared. The first item in a callable's commands list is used as
+            the key in version *3.2* onward. Prior to *3.2*, the name of the
+            function as declared in the source code was used.
+            """
+            self.networks = []
+            """The bots for every network, when there are several."""
+        self.networks.append(self)
+        self.shards = [self]
         """
-        A dictionary which maps a tuple of a function name and where it was
-        used to the nuber of times it was used there.
+        The bots connected to this bot's network, when its channels are shared
+        out between several connections with ``shard_nicks``.
         """
-        self.times = {}
+
+        self.times = tools.ExpiringDict(
+            0, int(config.core.rate_limit_cache_size or 10000))
         """
-        A dictionary mapping lower-case'd nicks to dictionaries which map
-        funtion names to the time which they were last used by that nick.
+        An ``ExpiringDict`` mapping nicks to dictionaries which map functions
+        to the time which they were last used by that nick. Nicks are
+        forgotten once they have not used anything for longer than the
+        longest rate limit, since none of their limits can apply any more.
         """
         self.acivity = {}
 
@@ -74,12 +98,14 @@ class Willie(irc.Bot):
         For servers that do not support IRCv3, this will be an empty set."""
         self.enabled_capabilities = set()
         """A set containing the IRCv3 capabilities that the bot has enabled."""
-        self._cap_reqs = dict()
-        """A dictionary of capability requests
+        if primary is None:
+            self._process_pools = {}
+            self._cap_reqs = dict()
+            """A dictionary of capability requests
 
-        Maps the capability name to a list of tuples of the prefix ('-', '=',
-        or ''), the name of the requesting module, and the function to call if
-        the request is rejected."""
+            Maps the capability name to a list of tuples of the prefix ('-',
+            '=', or ''), the name of the requesting module, and the function
+            to call if the request is rejected."""
 
         self.privileges = dict()
         """A dictionary of channels to their users and privilege levels
@@ -88,17 +114,50 @@ class Willie(irc.Bot):
         bitwise integer value, determined by combining the appropriate constants
         from `module`."""
 
-        self.db = WillieDB(config)
-        """The bot's database."""
-
-        self.memory = tools.WillieMemory()
+        if self.network not in self._process_pools:
+            self._process_pools[self.network] = ProcessPool.from_config(config)
+        self.processes = self._process_pools[self.network]
         """
-        A thread-safe dict for storage of runtime data to be shared between
-        modules. See `WillieMemory <#tools.Willie.WillieMemory>`_
+        The ``ProcessPool`` which runs callables marked ``process``. Each
+        network has its own, since the workers read its config.
         """
 
-        self.scheduler = Willie.JobScheduler(self)
-        self.scheduler.start()
+        if primary is not None:
+            # Everything but the connection is shared with the bot which
+            # loaded the modules.
+            self.stats = primary.stats
+            self.db = primary.db
+            self.memory = primary.memory
+            self.executor = primary.executor
+            self.scheduler = primary.scheduler
+            self.times.max_age = primary.times.max_age
+        else:
+            self.stats = StatsRegistry()
+            """
+            A ``StatsRegistry``, mapping the ``module.function`` name of each
+            callable to the time spent matching, queueing and running it.
+            """
+
+            self.db = WillieDB(config)
+            """The bot's database."""
+
+            self.memory = tools.WillieMemory()
+            """
+            A thread-safe dict for storage of runtime data to be shared between
+            modules. See `WillieMemory <#tools.Willie.WillieMemory>`_
+            """
+
+            self.executor = WorkerPool.from_config(config.core, self.stats)
+            """The ``WorkerPool`` which runs threaded callables and jobs."""
+
+            self.stats.add_gauge('worker processes', lambda: sum(
+                len(pool) for pool in self._process_pools.values()))
+            self.stats.add_gauge('worker processes killed', lambda: sum(
+                pool.killed for pool in self._process_pools.values()))
+
+            self.scheduler = Willie.JobScheduler(self)
+            self.scheduler.start()
+        self._add_gauges()
 
         #Set up block lists
         #Default to empty
@@ -114,55 +173,325 @@ class Willie(irc.Bot):
             self.config.core.nick_blocks = nicks
             self.config.core.other_bots = False
             self.config.save()
+        self.rebuild_blocklist()
 
-        self.setup()
+        if primary is None:
+            self.setup()
+            self.scheduler.load_stored_jobs()
+
+    def _shared(name):
+        """Make a property for state shared by the bots for every network.
+
+        The value is kept on the primary bot, the one which loaded the
+        modules, so that every network sees the same modules and commands
+        whichever bot changes them.
+
+        """
+        key = '_shared_' + name
+
+        def get(self):
+            try:
+                return self._primary.__dict__[key]
+            except KeyError:
+                raise AttributeError(name)
+
+        def set(self, value):
+            self._primary.__dict__[key] = value
+        return property(get, set)
+
+    callables = _shared('callables')
+    shutdown_methods = _shared('shutdown_methods')
+    commands = _shared('commands')
+    doc = _shared('doc')
+    networks = _shared('networks')
+    _regexp_words = _shared('_regexp_words')
+    _command_prefix = _shared('_command_prefix')
+    _regexp_order = _shared('_regexp_order')
+    _dispatch_table = _shared('_dispatch_table')
+    _unblockable_table = _shared('_unblockable_table')
+    _cap_reqs = _shared('_cap_reqs')
+    _process_pools = _shared('_process_pools')
+    del _shared
+
+    @property
+    def _primary(self):
+        return self.__dict__.get('_primary_bot', self)
+
+    def _add_gauges(self):
+        def add_gauge(name, func):
+            if self.connection_name:
+                name = '%s %s' % (self.connection_name, name)
+            self.stats.add_gauge(name, func)
+        add_gauge('rate limit nicks', lambda: len(self.times))
+        add_gauge('rate limit nicks expired',
+                  lambda: self.times.expired + self.times.evicted)
+        add_gauge('flood history targets', lambda: len(self.stack))
+        add_gauge('flood history expired',
+                  lambda: self.stack.expired + self.stack.evicted)
+        add_gauge('outbound queue', lambda: len(self.outbound))
+        add_gauge('channel joins', lambda: self.join_progress or 'not started')
+        add_gauge(
+            'server lag',
+            lambda: 'unknown' if self.lag is None else format_seconds(self.lag))
 
     class JobScheduler(threading.Thread):
 
-        """Calls jobs assigned to it in steady intervals.
+        """Calls jobs assigned to it at the right time.
 
-        JobScheduler is a thread that keeps track of Jobs and calls them every
-        X seconds, where X is a property of the Job. It maintains jobs in a
-        priority queue, where the next job to be called is always the first
-        item.
-        Thread safety is maintained with a mutex that is released during long
-        operations, so methods add_job and clear_jobs can be safely called from
-        the main thread.
+        JobScheduler is a thread that keeps track of Jobs and calls them when
+        they are due: every X seconds for jobs with an interval, and once for
+        those added with ``call_later`` or ``call_at``. The jobs are kept in
+        a heap ordered by the time they are next due, on the
+        ``time.monotonic`` clock, so changes to the system clock don't
+        affect them.
+
+        The thread sleeps on a condition variable until the first job is due,
+        and ``add_job`` wakes it up, so a new job is never late because the
+        scheduler was asleep. All methods can be called from any thread.
 
         """
 
-        min_reaction_time = 30.0  # seconds
-        """How often should scheduler checks for changes in the job list."""
+        load_horizon = 300
+        """
+        Stored jobs are loaded from the database when they are due within
+        this many seconds; the rest stay on disk until then.
+        """
 
         def __init__(self, bot):
             """Requires bot as argument for logging."""
             threading.Thread.__init__(self)
             self.bot = bot
-            self._jobs = PriorityQueue()
-            # While PriorityQueue it self is thread safe, this mutex is needed
-            # to stop old jobs being put into new queue after clearing the
-            # queue.
-            self._mutex = threading.Lock()
-            # self.cleared is used for more fine grained locking.
-            self._cleared = False
+            # Stored jobs loaded into memory, by their ID in the database
+            self._stored = {}
+            self._unresolved = set()
+            self._loader = None
+            # Entries are (next_time, sequence, job); the sequence number
+            # keeps jobs due at the same time in the order they were added.
+            self._heap = []
+            self._sequence = itertools.count()
+            self._cancelled = 0
+            self._condition = threading.Condition()
+            # Bumped by clear_jobs, so that a job which was running while the
+            # jobs were cleared isn't put back afterwards.
+            self._generation = 0
+            self._running = True
+
+        def __len__(self):
+            """Return the number of jobs waiting to be called."""
+            with self._condition:
+                return len(self._heap) - self._cancelled
 
         def add_job(self, job):
             """Add a Job to the current job queue."""
-            self._jobs.put(job)
+            with self._condition:
+                self._push(job)
+                self._condition.notify()
 
-        def clear_jobs(self):
-            """Clear current Job queue and start fresh."""
-            if self._jobs.empty():
-                # Guards against getting stuck waiting for self._mutex when
-                # thread is waiting for self._jobs to not be empty.
+        def _push(self, job):
+            job._scheduler = self
+            job._queued = True
+            heapq.heappush(self._heap,
+                           (job.next_time, next(self._sequence), job))
+
+        def call_at(self, when, func, *args):
+            """Call ``func(*args)`` once, at ``when`` on the monotonic clock.
+
+            ``when`` is compared with ``time.monotonic()``, not ``time.time()``.
+            Like threaded callables, ``func`` is run on a worker thread unless
+            its ``thread`` attribute is False. Returns the ``Job``, whose
+            ``cancel`` method stops the call if it hasn't been made yet.
+
+            """
+            job = Willie.Job(None, func, next_time=when, args=args)
+            self.add_job(job)
+            return job
+
+        def call_later(self, delay, func, *args):
+            """Call ``func(*args)`` once, ``delay`` seconds from now.
+
+            See ``call_at``.
+
+            """
+            return self.call_at(time.monotonic() + delay, func, *args)
+
+        def store_job(self, when, func, args=(), interval=None, overlap=None,
+                      timeout=None, disable_after=None):
+            """Call ``func(bot, *args)`` at ``when``, even after a restart.
+
+            ``when`` is a Unix timestamp, as from ``time.time()``. If
+            ``interval`` is given, the job is then called every ``interval``
+            seconds until it is removed. The job is kept in the database, so
+            ``func`` must be a module-level function of a loaded module, and
+            ``args`` must be serializable to JSON. Runs missed while the bot
+            was down are made up with a single run.
+
+            ``overlap``, ``timeout`` and ``disable_after`` are as set by the
+            ``willie.module`` decorators of the same names, and default to
+            those set on ``func``.
+
+            Returns the job's ID, for ``remove_stored_job``.
+
+            """
+            if overlap is None:
+                overlap = getattr(func, 'overlap', None)
+            if timeout is None:
+                timeout = getattr(func, 'timeout', None)
+                disable_after = getattr(func, 'disable_after', None)
+            name = callable_name(func)
+            job_id = self.bot.db.add_job(name, when, interval, args, overlap,
+                                         timeout, disable_after)
+            if when <= time.time() + self.load_horizon:
+                with self._condition:
+                    if job_id not in self._stored:
+                        self._arm((job_id, name, when, interval, list(args),
+                                   overlap, timeout, disable_after))
+            return job_id
+
+        def remove_stored_job(self, job_id):
+            """Remove a job added with ``store_job``."""
+            with self._condition:
+                self.bot.db.delete_job(job_id)
+                job = self._stored.pop(job_id, None)
+            if job is not None:
+                job.cancel()
+
+        def load_stored_jobs(self):
+            """Load the stored jobs due within ``load_horizon`` seconds.
+
+            This is called when the bot starts, and then again before the
+            horizon is up, so that each job is loaded in time to be called,
+            and no earlier.
+
+            """
+            if self._loader is not None:
+                self._loader.cancel()
+            until = time.time() + self.load_horizon
+            # Rows are read and armed under the lock, so that a job can't be
+            # armed twice, or again after it was done.
+            with self._condition:
+                for row in self.bot.db.get_due_jobs(until):
+                    if row[0] not in self._stored:
+                        self._arm(row)
+            self._loader = self.call_later(self.load_horizon / 2,
+                                           self.load_stored_jobs)
+
+        def _resolve(self, name):
+            module_name, _, func_name = name.rpartition('.')
+            return getattr(sys.modules.get(module_name), func_name, None)
+
+        def _arm(self, row):
+            """Put a stored job on the heap. Call with the lock held."""
+            (job_id, name, when, interval, args,
+             overlap, timeout, disable_after) = row
+            func = self._resolve(name)
+            if func is None:
+                if job_id not in self._unresolved:
+                    LOGGER.warning('Stored job %d calls %s, which is not '
+                                   'loaded; leaving it for now.',
+                                   job_id, name)
+                    self._unresolved.add(job_id)
                 return
-            with self._mutex:
-                self._cleared = True
-                self._jobs = PriorityQueue()
+            self._unresolved.discard(job_id)
+            now = time.time()
+            missed = 0
+            if interval and when + interval <= now:
+                # Make up for the runs missed while the bot was down with
+                # one run, now.
+                missed = int((now - when) // interval)
+                when += missed * interval
+            job = Willie.Job(interval, func,
+                             next_time=time.monotonic() + when - now,
+                             args=(self.bot,) + tuple(args))
+            job.stored_id = job_id
+            job.stored_time = when
+            if overlap is not None:
+                job.overlap = overlap
+            if timeout is not None:
+                job.timeout = timeout
+                job.disable_after = disable_after
+            if missed:
+                job.skipped += missed
+                self.bot.stats.record_job_skipped(job.name, missed)
+            self._stored[job_id] = job
+            self.add_job(job)
+
+        def _stored_job_done(self, job):
+            """Remove a stored one-shot job, or move a recurring one on.
+
+            This is called once a run has finished, so that a job is never
+            lost to a crash in the middle of it.
+
+            """
+            job_id = job.stored_id
+            unload = False
+            with self._condition:
+                if job.interval is None:
+                    self.bot.db.delete_job(job_id)
+                    unload = True
+                else:
+                    now = time.time()
+                    when = job.stored_time + job.interval
+                    if when < now:
+                        # The scheduler counts the runs this skips.
+                        when += (int((now - when) // job.interval) + 1) * \
+                            job.interval
+                    job.stored_time = when
+                    self.bot.db.set_job_time(job_id, when)
+                    # A job due beyond the horizon waits on disk until the
+                    # loader picks it up again.
+                    unload = when > now + self.load_horizon
+                if unload and self._stored.get(job_id) is job:
+                    del self._stored[job_id]
+            if unload and job.interval is not None:
+                job.cancel()
+
+        def _cancel(self, job):
+            with self._condition:
+                if not job._queued:
+                    return
+                self._cancelled += 1
+                if self._cancelled > len(self._heap) // 2:
+                    # Don't let cancelled jobs pile up in the heap.
+                    self._remove(lambda job: job.cancelled)
+                self._condition.notify()
+
+        def _remove(self, condition):
+            keep = []
+            for entry in self._heap:
+                if condition(entry[2]):
+                    entry[2]._queued = False
+                else:
+                    keep.append(entry)
+            heapq.heapify(keep)
+            self._heap = keep
+            self._cancelled = 0
+
+        def clear_jobs(self):
+            """Remove the interval jobs, so that they can be bound again.
+
+            Jobs added with ``call_later``, ``call_at`` or ``store_job`` are
+            kept.
+
+            """
+            with self._condition:
+                self._generation += 1
+                self._remove(lambda job: job.cancelled or
+                             job.interval is not None and job.stored_id is None)
+                # Stored jobs are kept, but call the reloaded functions.
+                for job in self._stored.values():
+                    job.func = self._resolve(callable_name(job.func)) or \
+                        job.func
+                self._condition.notify()
+
+        def stop(self):
+            """Stop the thread, once any job it is calling returns."""
+            with self._condition:
+                self._running = False
+                self._condition.notify()
 
         def run(self):
-            """Run forever."""
-            while True:
+            """Run until stopped."""
+            while self._running:
                 try:
                     self._do_next_job()
                 except Exception:
@@ -177,50 +506,180 @@ class Willie(irc.Bot):
 
         def _do_next_job(self):
             """Wait until there is a job and do it."""
-            with self._mutex:
-                # Wait until the next job should be executed.
-                # This has to be a loop, because signals stop time.sleep().
+            with self._condition:
                 while True:
-                    job = self._jobs.peek()
-                    difference = job.next_time - time.time()
-                    duration = min(difference, self.min_reaction_time)
-                    if duration <= 0:
+                    if not self._running:
+                        return
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    next_time, _, job = self._heap[0]
+                    if job.cancelled:
+                        heapq.heappop(self._heap)
+                        job._queued = False
+                        self._cancelled -= 1
+                        continue
+                    delay = next_time - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        job._queued = False
                         break
-                    with released(self._mutex):
-                        time.sleep(duration)
-
-                self._cleared = False
-                job = self._jobs.get()
-                with released(self._mutex):
-                    if job.func.thread:
-                        t = threading.Thread(
-                            target=self._call, args=(job.func,)
-                        )
-                        t.start()
-                    else:
-                        self._call(job.func)
-                    job.next()
+                    self._condition.wait(delay)
+                generation = self._generation
+
+            if self._claim(job):
+                self._dispatch(job, job.next_time)
+
+            if job.interval is None:
+                return
+            skipped = job.skipped
+            job.next()
+            if job.skipped > skipped:
+                LOGGER.warning('%s fell behind; skipped %d runs.',
+                               job.name, job.skipped - skipped)
+                self.bot.stats.record_job_skipped(job.name,
+                                                  job.skipped - skipped)
+            with self._condition:
                 # If jobs were cleared during the call, don't put an old job
                 # into the new job queue.
-                if not self._cleared:
-                    self._jobs.put(job)
+                if generation == self._generation and not job.cancelled:
+                    self._push(job)
+
+        def jobs(self):
+            """Return a list of the jobs waiting to be called, soonest first."""
+            with self._condition:
+                return [entry[2] for entry in sorted(self._heap)
+                        if not entry[2].cancelled]
+
+        def _dispatch(self, job, scheduled):
+            if getattr(job.func, 'thread', True):
+                self.bot.executor.submit(self._call, (job, scheduled),
+                                         getattr(job.func, 'priority',
+                                                 'medium'),
+                                         callable_name(job.func))
+            else:
+                self._call(job, scheduled)
+
+        def _claim(self, job):
+            """Decide whether to start a run of ``job`` now.
 
-        def _call(self, func):
-            """Wrapper for collecting errors from modules."""
+            Runs are counted from here, rather than from when they start on a
+            worker thread, so that one sitting in the executor's queue still
+            stops the next from starting under the job's overlap policy.
+
+            """
+            now = time.monotonic()
+            with self._condition:
+                if not job.running or job.overlap == 'allow':
+                    job.running += 1
+                    return True
+                overdue = (job.timeout is not None and not job.overran and
+                           job._run_started is not None and
+                           now - job._run_started > job.timeout)
+                if overdue:
+                    job.overran = True
+                if job.overlap == 'queue' and job.queued is None:
+                    job.queued = job.next_time
+                    queued = True
+                else:
+                    job.skipped += 1
+                    queued = False
+            if overdue:
+                self._overran(job, now - job._run_started)
+            if queued:
+                LOGGER.debug('%s is still running; queued the next run.',
+                             job.name)
+            else:
+                LOGGER.debug('%s is still running; skipped a run.', job.name)
+                self.bot.stats.record_job_skipped(job.name, 1)
+            return False
+
+        def _overran(self, job, duration):
+            """Log and count a run going over the job's timeout."""
+            job.overruns += 1
+            LOGGER.warning('%s has run for %s, over its %s timeout.',
+                           job.name, format_seconds(duration),
+                           format_seconds(job.timeout))
+            self.bot.stats.record_job_timeout(job.name)
+            if (job.disable_after is not None and
+                    job.overruns >= job.disable_after and
+                    not job.cancelled):
+                LOGGER.error('Disabling %s after %d overruns in a row.',
+                             job.name, job.overruns)
+                job.cancel()
+
+        def _call(self, job, scheduled):
+            """Wrapper for collecting errors and timings from modules."""
             # Willie.bot.call is way too specialized to be used instead.
+            func = job.func
+            args = (self.bot,) if job.args is None else job.args
+            started = self._start(job, scheduled)
+            if asyncio.iscoroutinefunction(func):
+                self.bot.run_coroutine(self._call_async(job, args, started))
+                return
+            error = False
+            try:
+                func(*args)
+            except Exception:
+                error = True
+                self.bot.error()
+            self._finish(job, started, error)
+
+        async def _call_async(self, job, args, started):
+            error = False
             try:
-                func(self.bot)
+                await job.func(*args)
             except Exception:
+                error = True
                 self.bot.error()
+            self._finish(job, started, error)
+
+        def _start(self, job, scheduled):
+            started = time.monotonic()
+            with self._condition:
+                overlapping = job.running > 1
+                job.scheduled = scheduled
+                job.started = started
+                job.overran = False
+                job._run_started = started
+                if overlapping:
+                    job.overlaps += 1
+            self.bot.stats.record_job_start(job.name, started - scheduled,
+                                            overlapping)
+            return started
+
+        def _finish(self, job, started, error):
+            duration = time.monotonic() - started
+            with self._condition:
+                job.running -= 1
+                job.duration = duration
+                if not job.running:
+                    job._run_started = None
+                overran = (job.timeout is not None and
+                           duration > job.timeout and not job.overran)
+                if job.timeout is not None and duration <= job.timeout:
+                    job.overruns = 0
+                queued, job.queued = job.queued, None
+                requeue = queued is not None and not job.cancelled
+                if requeue:
+                    job.running += 1
+            self.bot.stats.record_run(callable_name(job.func), duration,
+                                      error)
+            self.bot.stats.record_job_run(job.name, duration, error)
+            if job.stored_id is not None:
+                self._stored_job_done(job)
+            if overran:
+                self._overran(job, duration)
+            if requeue:
+                self._dispatch(job, queued)
 
     class Job(object):
 
         """Hold information about when a function should be called next.
 
         Job is a simple structure that hold information about when a function
-        should be called next.
-        They can be put in a priority queue, in which case the Job that should
-        be executed next is returned.
+        should be called next, on the ``time.monotonic`` clock. Jobs without
+        an interval are called once.
 
         Calling the method next modifies the Job object for the next time it
         should be executed. Current time is used to decide when the job should
@@ -236,17 +695,83 @@ class Willie(irc.Bot):
         calling the same function too many times at once.
         """
 
-        def __init__(self, interval, func):
+        def __init__(self, interval, func, next_time=None, args=None):
             """Initialize Job.
 
             Args:
-                interval: number of seconds between calls to func
+                interval: number of seconds between calls to func, or None
+                    to call it once
                 func: function to be called
+                next_time: when to call func first, on the monotonic clock;
+                    by default, one interval from now
+                args: the arguments to call func with; by default, the bot
 
             """
-            self.next_time = time.time() + interval
+            if next_time is None:
+                next_time = time.monotonic() + (interval or 0)
+            self.next_time = next_time
             self.interval = interval
             self.func = func
+            self.args = args
+            self.cancelled = False
+            self._scheduler = None
+            self._queued = False
+            self.stored_id = None
+            """For a job kept in the database, its ID there."""
+            self.stored_time = None
+            """
+            For a job kept in the database, when its run is due, as a Unix
+            timestamp.
+            """
+
+            self.scheduled = None
+            """When the last run was due, on the monotonic clock."""
+            self.started = None
+            """When the last run actually started."""
+            self.duration = None
+            """How long the last run took, once it has finished."""
+            self.running = 0
+            """How many runs are going at the moment."""
+            self.skipped = 0
+            """
+            Runs given up on, because they fell ``max_catchup`` behind or
+            came due while an earlier run was still going.
+            """
+            self.overlaps = 0
+            """Runs which started while an earlier one was still going."""
+            self._run_started = None
+            self.queued = None
+            """When the run queued behind the current one was due, if any."""
+            self.overran = False
+            """Whether the last run has been counted as going over time."""
+            self.overruns = 0
+            """Runs in a row which went over ``timeout``."""
+
+            self.overlap = getattr(func, 'overlap', 'skip')
+            """
+            What to do when the job is due while a run is still going:
+            ``'skip'`` the new run, ``'queue'`` one run to start when the
+            current one finishes, or ``'allow'`` the runs to overlap.
+            """
+            self.timeout = getattr(func, 'timeout', None)
+            """Seconds after which a run is logged as going over time."""
+            self.disable_after = getattr(func, 'disable_after', None)
+            """Overruns in a row after which the job is cancelled, if any."""
+
+        @property
+        def name(self):
+            """The name the job's stats are kept under."""
+            if self.interval is None:
+                return '%s once' % callable_name(self.func)
+            return '%s every %ss' % (callable_name(self.func), self.interval)
+
+        def cancel(self):
+            """Stop the job from being called again."""
+            if self.cancelled:
+                return
+            self.cancelled = True
+            if self._scheduler is not None:
+                self._scheduler._cancel(self)
 
         def next(self):
             """Update self.next_time with the assumption func was just called.
@@ -255,19 +780,16 @@ class Willie(irc.Bot):
 
             """
             last_time = self.next_time
-            current_time = time.time()
+            current_time = time.monotonic()
             delta = last_time + self.interval - current_time
 
-            if last_time > current_time + self.interval:
-                # Clock appears to have moved backwards. Reset
-                # the timer to avoid waiting for the clock to
-                # catch up to whatever time it was previously.
-                self.next_time = current_time + self.interval
-            elif delta < 0 and abs(delta) > self.interval * self.max_catchup:
+            if delta < 0 and abs(delta) > self.interval * self.max_catchup:
                 # Execution of jobs is too far behind. Give up on
                 # trying to catch up and reset the time, so that
                 # will only be repeated a maximum of
                 # self.max_catchup times.
+                self.skipped += int(-delta // self.interval) - \
+                    self.max_catchup
                 self.next_time = current_time - \
                     self.interval * self.max_catchup
             else:
@@ -293,7 +815,8 @@ class Willie(irc.Bot):
                 <Job(2013-06-14 11:01:36.884000, 20s, <function upper at 0x02386BF0>)>
 
             """
-            iso_time = str(datetime.fromtimestamp(self.next_time))
+            when = time.time() + self.next_time - time.monotonic()
+            iso_time = str(datetime.fromtimestamp(when))
             return "<Job(%s, %ss, %s)>" % \
                 (iso_time, self.interval, self.func)
 
@@ -425,6 +948,7 @@ class Willie(irc.Bot):
                         (obj.__module__, e)
                     )
                 self.shutdown_methods.remove(obj)
+        self._build_dispatch_index()
 
     def sub(self, pattern):
         """Replace any of the following special directives in a function's rule expression:
@@ -444,9 +968,13 @@ class Willie(irc.Bot):
 
     def bind_commands(self):
         self.commands = {'high': {}, 'medium': {}, 'low': {}}
+        # Maps each bound regexp to the set of literal command words it can
+        # match, or to None if it has to be tried against every line.
+        self._regexp_words = {}
         self.scheduler.clear_jobs()
+        process_modules = set(self.config.core.get_list('process_modules'))
 
-        def bind(priority, regexp, func):
+        def bind(priority, regexp, func, command=None):
             # Function name is no longer used for anything, as far as I know,
             # but we're going to keep it around anyway.
             if not hasattr(func, 'name'):
@@ -488,7 +1016,16 @@ class Willie(irc.Bot):
                         self.doc[command] = (doc, example)
             self.commands[priority].setdefault(regexp, []).append(func)
 
+            words = self._literal_command_words(command)
+            if words is None:
+                self._regexp_words[regexp] = None
+            elif self._regexp_words.get(regexp, ()) is not None:
+                self._regexp_words.setdefault(regexp, set()).update(words)
+
         for func in self.callables:
+            # Formatted once here, rather than for every line dispatched.
+            func.stats_name = callable_name(func)
+
             if not hasattr(func, 'unblockable'):
                 func.unblockable = False
 
@@ -498,6 +1035,9 @@ class Willie(irc.Bot):
             if not hasattr(func, 'thread'):
                 func.thread = True
 
+            if not hasattr(func, 'process'):
+                func.process = func.__module__ in process_modules
+
             if not hasattr(func, 'event'):
                 func.event = ['PRIVMSG']
             else:
@@ -558,13 +1098,121 @@ class Willie(irc.Bot):
                 for command in func.commands:
                     prefix = self.config.core.prefix
                     regexp = get_command_regexp(prefix, command)
-                    bind(func.priority, regexp, func)
+                    bind(func.priority, regexp, func, command)
 
             if hasattr(func, 'interval'):
                 for interval in func.interval:
                     job = Willie.Job(interval, func)
                     self.scheduler.add_job(job)
 
+        max_rate = max([func.rate for func in self.callables] + [0])
+        for bot in self.networks:
+            bot.times.max_age = max_rate
+        self._build_dispatch_index()
+
+    _literal_command = re.compile(r'^[^\s\\.^$*+?{}\[\]()]+$')
+
+    @classmethod
+    def _literal_command_words(cls, command):
+        """Return the lower-cased words a command pattern can match.
+
+        ``None`` is returned if the pattern is not a plain word (or an
+        alternation of plain words), since such a pattern can only be found by
+        trying its regexp.
+
+        """
+        if command is None:
+            return None
+        words = command.split('|')
+        if not all(cls._literal_command.match(word) for word in words):
+            return None
+        return set(word.lower() for word in words)
+
+    def _build_dispatch_index(self):
+        """Build the lookup tables used by ``dispatch``.
+
+        Callables are first grouped by the events they handle, so that a line
+        is only matched against the rules of callables which could be called
+        for it. Callables with the ``*`` event are added to every event's
+        group, and also make up the group used for events no callable asks
+        for by name.
+
+        Within each group, regexps created from literal ``commands`` are
+        indexed by their command word, so that a line only has to be matched
+        against the regexps of the command it actually uses. Everything else
+        (rules, and commands which are themselves regular expressions) is kept
+        in a list which is scanned for every line. The position of each regexp
+        in ``self.commands`` is remembered, so candidates can be tried in the
+        same order as the full scan would have.
+
+        """
+        self._command_prefix = get_command_prefix_regexp(
+            self.config.core.prefix)
+        self._regexp_order = {}
+        events = set(['*'])
+        for priority in ('high', 'medium', 'low'):
+            for regexp, funcs in iteritems(self.commands[priority]):
+                self._regexp_order[regexp] = len(self._regexp_order)
+                for func in funcs:
+                    events.update(func.event)
+
+        self._dispatch_table = self._build_dispatch_table(events)
+        self._unblockable_table = self._build_dispatch_table(
+            events, lambda func: func.unblockable)
+
+    def _build_dispatch_table(self, events, include=None):
+        """Build the per-event lookup tables for ``_build_dispatch_index``.
+
+        If ``include`` is given, only callables for which it returns True are
+        put in the tables.
+
+        """
+        dispatch_table = {}
+        for event in events:
+            table = {}
+            for priority in ('high', 'medium', 'low'):
+                indexed = {}
+                unindexed = []
+                bound = {}
+                for regexp, funcs in iteritems(self.commands[priority]):
+                    funcs = [func for func in funcs
+                             if (event in func.event or '*' in func.event) and
+                             (include is None or include(func))]
+                    if not funcs:
+                        continue
+                    bound[regexp] = funcs
+                    words = self._regexp_words.get(regexp)
+                    if words is None:
+                        unindexed.append(regexp)
+                        continue
+                    for word in words:
+                        indexed.setdefault(word, []).append(regexp)
+                table[priority] = (indexed, unindexed, bound)
+            dispatch_table[event] = table
+        return dispatch_table
+
+    def _candidates(self, event, priority, text, blocked=False):
+        """Return the regexps and callables which may be triggered by a line.
+
+        The result is a list of ``(regexp, funcs)`` tuples, for the callables
+        of the given priority which handle ``event`` and whose regexp could
+        match ``text``. If ``blocked`` is True, only unblockable callables are
+        included.
+
+        """
+        dispatch_table = (self._unblockable_table if blocked
+                          else self._dispatch_table)
+        table = dispatch_table.get(event) or dispatch_table['*']
+        indexed, unindexed, bound = table[priority]
+        regexps = unindexed
+        word = self._command_prefix.match(text)
+        if word:
+            found = indexed.get(word.group(1).lower())
+            if found:
+                regexps = sorted(found + unindexed,
+                                 key=self._regexp_order.get)
+        return [(regexp, bound[regexp]) for regexp in regexps]
+
     class WillieWrapper(object):
         def __init__(self, willie, trigger):
             # The custom __setattr__ for this class sets the attribute on the
@@ -579,7 +1227,7 @@ class Willie(irc.Bot):
             return list(self.__dict__) + classattrs + dir(self._bot)
 
         def say(self, string, max_messages=1):
-            self._bot.msg(self._trigger.sender, string, max_messages)
+            return self._bot.msg(self._trigger.sender, string, max_messages)
 
         def reply(self, string, notice=False):
             if isinstance(string, str) and not py3:
@@ -590,7 +1238,7 @@ class Willie(irc.Bot):
                     self._trigger.sender
                 )
             else:
-                self._bot.msg(
+                return self._bot.msg(
                     self._trigger.sender,
                     '%s: %s' % (self._trigger.nick, string)
                 )
@@ -598,7 +1246,7 @@ class Willie(irc.Bot):
         def action(self, string, recipient=None):
             if recipient is None:
                 recipient = self._trigger.sender
-            self._bot.msg(recipient, '\001ACTION %s\001' % string)
+            return self._bot.msg(recipient, '\001ACTION %s\001' % string)
 
         def notice(self, string, recipient=None):
             if recipient is None:
@@ -611,33 +1259,87 @@ class Willie(irc.Bot):
         def __setattr__(self, attr, value):
             return setattr(self._bot, attr, value)
 
-    def call(self, func, willie, trigger):
-        nick = trigger.nick
-        if nick not in self.times:
-            self.times[nick] = dict()
+    def _rate_limited(self, func, trigger):
+        """Return True if the trigger's nick has to wait to use func again."""
+        used = self.times.setdefault(trigger.nick, dict())
 
         if not trigger.admin and \
                 not func.unblockable and \
                 func.rate > 0 and \
-                func in self.times[nick]:
-            timediff = time.time() - self.times[nick][func]
+                func in used:
+            timediff = time.time() - used[func]
             if timediff < func.rate:
-                self.times[nick][func] = time.time()
+                used[func] = time.time()
                 LOGGER.info(
                     "%s prevented from using %s in %s: %d < %d",
                     trigger.nick, func.__name__, trigger.sender, timediff,
                     func.rate
                 )
-                return
+                return True
+        return False
+
+    def _record_use(self, func, trigger, exit_code):
+        if exit_code != module.NOLIMIT:
+            self.times.setdefault(trigger.nick, dict())[func] = time.time()
+
+    def call(self, func, willie, trigger):
+        if self._rate_limited(func, trigger):
+            return
 
+        error = False
+        start = time.time()
         try:
             exit_code = func(willie, trigger)
         except Exception:
             exit_code = None
+            error = True
             self.error(trigger)
+        self.stats.record_run(func.stats_name, time.time() - start, error)
 
-        if exit_code != module.NOLIMIT:
-            self.times[nick][func] = time.time()
+        self._record_use(func, trigger, exit_code)
+
+    def call_in_process(self, func, willie, trigger):
+        """Like ``call``, but runs the callable in a worker process.
+
+        This waits for the process to finish, so it is run on a worker thread.
+
+        """
+        if self._rate_limited(func, trigger):
+            return
+
+        error = False
+        start = time.time()
+        try:
+            exit_code = self.processes.call(func, willie, trigger)
+        except Exception:
+            exit_code = None
+            error = True
+            self.error(trigger)
+        self.stats.record_run(func.stats_name, time.time() - start, error)
+
+        self._record_use(func, trigger, exit_code)
+
+    async def call_async(self, func, willie, trigger):
+        """Like ``call``, but for callables defined with ``async def``.
+
+        These are run on the event loop, rather than on a worker thread, so
+        they must not block.
+
+        """
+        if self._rate_limited(func, trigger):
+            return
+
+        error = False
+        start = time.time()
+        try:
+            exit_code = await func(willie, trigger)
+        except Exception:
+            exit_code = None
+            error = True
+            self.error(trigger)
+        self.stats.record_run(func.stats_name, time.time() - start, error)
+
+        self._record_use(func, trigger, exit_code)
 
     def limit(self, trigger, func):
         if trigger.sender and not trigger.sender.is_nick():
@@ -647,83 +1349,136 @@ class Willie(irc.Bot):
                     return True
         return False
 
+    def route(self, recipient):
+        """Return the shard which should talk to ``recipient``.
+
+        That's the first shard in the channel, or failing that the one it was
+        given to in the config. Anything else, like a private message, stays
+        with this bot.
+
+        """
+        if len(self.shards) < 2 or not recipient:
+            return self
+        recipient = Identifier(recipient)
+        if recipient.is_nick():
+            return self
+        for shard in self.shards:
+            if recipient in shard.channels:
+                return shard
+        for shard in self.shards:
+            if recipient in shard.config.core.get_list('channels'):
+                return shard
+        return self
+
+    def msg(self, recipient, text, max_messages=1):
+        """Send a PRIVMSG to a user or channel.
+
+        See ``irc.Bot.msg``. When the bot is sharded, a message to a channel
+        goes out through the shard which is in it.
+
+        """
+        return irc.Bot.msg(self.route(recipient), recipient, text,
+                           max_messages)
+
+    def handles(self, pretrigger):
+        """Return whether this bot should dispatch ``pretrigger``.
+
+        When shards share a channel, only the one ``route`` picks dispatches
+        the messages to it. Everything else, like JOINs and MODEs, updates
+        the state each shard keeps, so every shard gets it; and so does
+        anything the shard itself did.
+
+        """
+        if len(self.shards) < 2:
+            return True
+        if pretrigger.event not in ('PRIVMSG', 'NOTICE'):
+            return True
+        if pretrigger.nick == self.nick:
+            return True
+        return self.route(pretrigger.sender) is self
+
     def dispatch(self, pretrigger):
+        if not self.handles(pretrigger):
+            # Another shard is in the channel too, and it has this line.
+            return
         args = pretrigger.args
         event, args, text = pretrigger.event, args, args[-1]
 
-        if self.config.core.nick_blocks or self.config.core.host_blocks:
-            nick_blocked = self._nick_blocked(pretrigger.nick)
-            host_blocked = self._host_blocked(pretrigger.host)
-        else:
-            nick_blocked = host_blocked = None
+        nick_blocked = host_blocked = blocked = False
+        if self._blocklist:
+            nick_blocked = self._blocklist.nick_blocked(pretrigger.nick)
+            host_blocked = self._blocklist.host_blocked(pretrigger.host)
+            if nick_blocked or host_blocked:
+                access = AccessMatcher.for_config(self.config)
+                blocked = not access.check(pretrigger.nick,
+                                           pretrigger.host)[1]
 
-        list_of_blocked_functions = []
-        for priority in ('high', 'medium', 'low'):
-            items = self.commands[priority].items()
+        if blocked:
+            if nick_blocked and host_blocked:
+                block_type = 'both'
+            elif nick_blocked:
+                block_type = 'nick'
+            else:
+                block_type = 'host'
+            LOGGER.info(
+                "[%s]%s is blocked; only trying unblockable callables.",
+                block_type,
+                pretrigger.nick
+            )
 
-            for regexp, funcs in items:
+        timings = []
+        for priority in ('high', 'medium', 'low'):
+            for regexp, funcs in self._candidates(event, priority, text,
+                                                  blocked):
+                start = time.perf_counter()
                 match = regexp.match(text)
+                elapsed = time.perf_counter() - start
+                timings.extend((func.stats_name, elapsed) for func in funcs)
                 if not match:
                     continue
-                trigger = Trigger(self.config, pretrigger, match)
+                trigger = Trigger(self.config, pretrigger, match,
+                                  self.network)
                 wrapper = self.WillieWrapper(self, trigger)
 
                 for func in funcs:
-                    if (not trigger.admin and
-                            not func.unblockable and
-                            (nick_blocked or host_blocked)):
-                        function_name = "%s.%s" % (
-                            func.__module__, func.__name__
-                        )
-                        list_of_blocked_functions.append(function_name)
-                        continue
-
-                    if event not in func.event:
-                        continue
                     if self.limit(trigger, func):
                         continue
-                    if func.thread:
+                    if asyncio.iscoroutinefunction(func):
+                        self.run_coroutine(
+                            self.call_async(func, wrapper, trigger))
+                    elif func.process:
+                        targs = (func, wrapper, trigger)
+                        self.executor.submit(self.call_in_process, targs,
+                                             func.priority, func.stats_name,
+                                             block=False)
+                    elif func.thread:
                         targs = (func, wrapper, trigger)
-                        t = threading.Thread(target=self.call, args=targs)
-                        t.start()
+                        self.executor.submit(self.call, targs, func.priority,
+                                             func.stats_name, block=False)
                     else:
                         self.call(func, wrapper, trigger)
+        self.stats.record_matches(timings)
 
-        if list_of_blocked_functions:
-            if nick_blocked and host_blocked:
-                block_type = 'both'
-            elif nick_blocked:
-                block_type = 'nick'
-            else:
-                block_type = 'host'
-            LOGGER.info(
-                "[%s]%s prevented from using %s.",
-                block_type,
-                trigger.nick,
-                ', '.join(list_of_blocked_functions)
-            )
+    def rebuild_blocklist(self):
+        """Recompile the blocklist from ``nick_blocks`` and ``host_blocks``.
+
+        This must be called after changing either option for the change to
+        take effect. The lists of every network which reads the same
+        configuration are recompiled too, since it may have been shared.
+
+        """
+        config = getattr(self.config, '_config', self.config)
+        for bot in self.networks:
+            if getattr(bot.config, '_config', bot.config) is config:
+                bot._blocklist = tools.BlockList(
+                    bot.config.core.get_list('nick_blocks'),
+                    bot.config.core.get_list('host_blocks'))
 
     def _host_blocked(self, host):
-        bad_masks = self.config.core.get_list('host_blocks')
-        for bad_mask in bad_masks:
-            bad_mask = bad_mask.strip()
-            if not bad_mask:
-                continue
-            if (re.match(bad_mask + '$', host, re.IGNORECASE) or
-                    bad_mask == host):
-                return True
-        return False
+        return self._blocklist.host_blocked(host)
 
     def _nick_blocked(self, nick):
-        bad_nicks = self.config.core.get_list('nick_blocks')
-        for bad_nick in bad_nicks:
-            bad_nick = bad_nick.strip()
-            if not bad_nick:
-                continue
-            if (re.match(bad_nick + '$', nick, re.IGNORECASE) or
-                    Identifier(bad_nick) == nick):
-                return True
-        return False
+        return self._blocklist.nick_blocked(nick)
 
     @deprecated_5
     def debug(self, tag, text, level):
@@ -767,7 +1522,17 @@ class Willie(irc.Bot):
         else:
             return False
 
+    def reset_connection_state(self):
+        irc.Bot.reset_connection_state(self)
+        self.privileges = dict()
+        self.server_capabilities = set()
+        self.enabled_capabilities = set()
+
     def _shutdown(self):
+        self.scheduler.stop()
+        self.executor.shutdown()
+        for pool in self._process_pools.values():
+            pool.shutdown()
         stderr(
             'Calling shutdown for %d modules.' % (len(self.shutdown_methods),)
         )
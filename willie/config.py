@@ -80,6 +80,9 @@ class Config(object):
 
         """
         self.path = path
+        self.version = 0
+        """Incremented whenever an option is set through a section, so that
+        anything worked out from the options can tell when to redo it."""
 
         self.parser = ConfigParser.RawConfigParser(allow_no_value=True)
         self.get = self.parser.get
@@ -123,9 +126,30 @@ class Config(object):
         if not self.has_option('core', 'owner'):
             raise ConfigurationError(
                 'Bot owner not configured, expected option `owner` in [core] section.')
-        if not self.has_option('core', 'host'):
+        if not self.networks and not self.has_option('core', 'host'):
             raise ConfigurationError(
                 'IRC server address not configured, expected option `host` in [core] section.')
+        for network in self.networks:
+            if not (self.has_option('core', 'host') or
+                    self.has_option('network:' + network, 'host')):
+                raise ConfigurationError(
+                    'IRC server address not configured for network %s, '
+                    'expected option `host` in [network:%s] section.'
+                    % (network, network))
+
+    @property
+    def networks(self):
+        """The names of the networks configured with ``[network:NAME]``.
+
+        If there are any, Willie connects to each of them, using a
+        ``NetworkConfig`` for each. Module ``setup`` functions and interval
+        jobs are only given the first network's bot; the others are in its
+        ``networks`` list.
+
+        """
+        return [section[len('network:'):]
+                for section in self.parser.sections()
+                if section.startswith('network:')]
 
     def save(self):
         """Save all changes to the config file."""
@@ -156,6 +180,7 @@ class Config(object):
             if type(value) is list:
                 value = ','.join(value)
             self._parent.parser.set(self._name, name, value)
+            self._parent.version += 1
 
         def get_list(self, name):
             value = getattr(self, name)
@@ -163,8 +188,60 @@ class Config(object):
                 return []
             if isinstance(value, basestring):
                 value = value.split(',')
-                # Keep the split value, so we don't have to keep doing this
-                setattr(self, name, value)
+                # Keep the split value, so we don't have to keep doing this.
+                # It is the same option, so the parser is left alone.
+                object.__setattr__(self, name, value)
+            return value
+
+    class NetworkSection(object):
+        """The ``core`` section, as seen from one network or connection.
+
+        Options set in the ``[network:NAME]`` section, if there is one, take
+        the place of the same options in ``[core]``, and ``overrides`` (which
+        are never saved) take the place of both. Setting an option changes
+        whichever of those it was read from.
+
+        """
+        def __init__(self, core, parent, network=None, overrides=None):
+            object.__setattr__(self, '_core', core)
+            object.__setattr__(self, '_parent', parent)
+            object.__setattr__(self, '_overrides', dict(overrides or {}))
+            if network:
+                name = 'network:' + network
+                section = Config.ConfigSection(
+                    name, parent.parser.items(name), parent)
+            else:
+                section = None
+            object.__setattr__(self, '_network', section)
+
+        def _source(self, name):
+            if name in self._overrides:
+                return None
+            if self._network is not None and name in self._network.__dict__:
+                return self._network
+            return self._core
+
+        def __getattr__(self, name):
+            source = self._source(name)
+            if source is None:
+                return self._overrides[name]
+            return getattr(source, name)
+
+        def __setattr__(self, name, value):
+            source = self._source(name)
+            if source is None:
+                self._overrides[name] = value
+                self._parent.version += 1
+            else:
+                setattr(source, name, value)
+
+        def get_list(self, name):
+            source = self._source(name)
+            if source is not None:
+                return source.get_list(name)
+            value = self._overrides[name]
+            if isinstance(value, basestring):
+                value = value.split(',')
             return value
 
     def __getattr__(self, name):
@@ -380,6 +457,55 @@ class Config(object):
         return modules
 
 
+class NetworkConfig(object):
+    """The configuration for one connection, when there are several.
+
+    This behaves like the ``Config`` it wraps, except that ``core`` (and the
+    backwards compatible core attributes) see the options in the network's
+    ``[network:NAME]`` section, and then any keyword arguments given, in
+    place of those in ``[core]``. ``network`` is the name of the network, or
+    None if there are no network sections, and ``shard`` the nick of the
+    connection, or None if the network isn't sharded.
+
+    """
+    def __init__(self, config, network=None, shard=None, **overrides):
+        object.__setattr__(self, '_config', config)
+        object.__setattr__(self, 'network', network)
+        object.__setattr__(self, 'shard', shard)
+        object.__setattr__(self, 'core', Config.NetworkSection(
+            config.core, config, network, overrides))
+
+    def __getattr__(self, name):
+        if self.core._source(name) is not self.core._core:
+            return getattr(self.core, name)
+        return getattr(self._config, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            # Private state, such as caches, belongs to this connection.
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._config, name, value)
+
+
+def shard_configs(config, network=None):
+    """Return a ``NetworkConfig`` for each connection to a network.
+
+    Usually there is just one. If ``shard_nicks`` lists more than one nick,
+    there is a connection for each, and the channels are dealt out between
+    them in turn.
+
+    """
+    base = NetworkConfig(config, network)
+    nicks = base.core.get_list('shard_nicks')
+    if len(nicks) < 2:
+        return [base]
+    channels = base.core.get_list('channels')
+    return [NetworkConfig(config, network, shard=nick, nick=nick,
+                          channels=channels[i::len(nicks)])
+            for i, nick in enumerate(nicks)]
+
+
 def check_home_dir(homedir, create=True):
     """Check to see if the home directory exists, and optionally try to create it if not."""
     if os.path.isdir(homedir):
@@ -19,6 +19,7 @@ from __future__ import unicode_literals
 import re
 import time
 import willie
+from willie.stats import format_seconds
 from willie.tools import Identifier, iteritems
 import base64
 from willie.logger import get_logger
@@ -26,6 +27,14 @@ from willie.logger import get_logger
 LOGGER = get_logger(__name__)
 
 
+def setup(bot):
+    # Netjoins and netsplits come as one batch, rather than line by line. If
+    # it was already requested (by us, before a reload, or by some other
+    # module), or prohibited, we shouldn't request it again.
+    if 'batch' not in bot._cap_reqs:
+        bot.cap_req('coretasks', 'batch', None)
+
+
 @willie.module.event('001', '251')
 @willie.module.rule('.*')
 @willie.module.thread(False)
@@ -75,44 +84,70 @@ def startup(bot, trigger):
         modes = 'B'
     bot.write(('MODE ', '%s +%s' % (bot.nick, modes)))
 
-    bot.memory['retry_join'] = dict()
+    # Channels are joined at the end of the MOTD, by which time we know the
+    # server's limits. Just in case it never gets there, don't wait forever.
+    bot.join_channels_later(10)
 
-    if bot.config.has_option('core', 'throttle_join'):
-        throttle_rate = int(bot.config.core.throttle_join)
-        channels_joined = 0
-        for channel in bot.config.core.get_list('channels'):
-            channels_joined += 1
-            if not channels_joined % throttle_rate:
-                time.sleep(1)
-            bot.join(channel)
-    else:
-        for channel in bot.config.core.get_list('channels'):
-            bot.join(channel)
+
+@willie.module.event('005')
+@willie.module.rule('.*')
+@willie.module.priority('high')
+@willie.module.thread(False)
+@willie.module.unblockable
+def track_isupport(bot, trigger):
+    """Record the features and limits the server advertises."""
+    # The last argument is the "are supported by this server" text
+    for token in trigger.args[1:-1]:
+        if token.startswith('-'):
+            bot.isupport.pop(token[1:], None)
+            continue
+        name, _, value = token.partition('=')
+        if name == 'TARGMAX':
+            limits = {}
+            for item in value.split(','):
+                command, _, limit = item.partition(':')
+                limits[command.upper()] = int(limit) if limit else None
+            value = limits
+        bot.isupport[name] = value or None
+
+
+@willie.module.event('376', '422')
+@willie.module.rule('.*')
+@willie.module.thread(False)
+@willie.module.unblockable
+def end_of_motd(bot, trigger):
+    """Join the configured channels once the server has said hello."""
+    join_channels(bot)
+
+
+def join_channels(bot):
+    if bot.join_progress is not None or not bot.connection_registered:
+        return
+    bot.join_channels(bot.config.core.get_list('channels'))
 
 
 @willie.module.event('477')
 @willie.module.rule('.*')
 @willie.module.priority('high')
+@willie.module.thread(False)
 def retry_join(bot, trigger):
     """Give NickServer enough time to identify on a +R channel.
 
     Give NickServ enough time to identify, and retry rejoining an
-    identified-only (+R) channel. Maximum of ten rejoin attempts.
+    identified-only (+R) channel, waiting longer each time. Maximum of
+    ``join_retry_attempts`` (ten) rejoin attempts.
 
     """
-    channel = trigger.args[1]
-    if channel in bot.memory['retry_join'].keys():
-        bot.memory['retry_join'][channel] += 1
-        if bot.memory['retry_join'][channel] > 10:
-            LOGGER.warning('Failed to join %s after 10 attempts.', channel)
-            return
-    else:
-        bot.memory['retry_join'][channel] = 0
-        bot.join(channel)
-        return
+    # The retries are kept, and their timers run, on the event loop, so
+    # that's where this has to happen.
+    bot.loop.call_soon_threadsafe(_retry_join, bot, trigger.args[1])
+
 
-    time.sleep(6)
-    bot.join(channel)
+def _retry_join(bot, channel):
+    if not bot.retry_join(channel):
+        LOGGER.warning('Failed to join %s after %d attempts.',
+                       channel, bot.join_retry_attempts)
+        record_join(bot, channel, joined=False)
 
 #Functions to maintain a list of chanops in all of willie's channels.
 
@@ -322,12 +357,32 @@ def track_kick(bot, trigger):
 @willie.module.thread(False)
 @willie.module.unblockable
 def track_join(bot, trigger):
-    if trigger.nick == bot.nick and trigger.sender not in bot.channels:
-        bot.channels.append(trigger.sender)
-        bot.privileges[trigger.sender] = dict()
+    if trigger.nick == bot.nick:
+        if trigger.sender not in bot.channels:
+            bot.channels.append(trigger.sender)
+            bot.privileges[trigger.sender] = dict()
+        bot.cancel_join_retry(trigger.sender)
+        record_join(bot, trigger.sender)
     bot.privileges[trigger.sender][trigger.nick] = 0
 
 
+@willie.module.event('403', '405', '471', '473', '474', '475', '476')
+@willie.module.rule('.*')
+@willie.module.priority('high')
+@willie.module.thread(False)
+@willie.module.unblockable
+def track_join_failure(bot, trigger):
+    """Count channels we couldn't join towards the join progress."""
+    LOGGER.warning('Could not join %s: %s', trigger.args[1], trigger)
+    record_join(bot, trigger.args[1], joined=False)
+
+
+def record_join(bot, channel, joined=True):
+    progress = bot.join_progress
+    if progress is not None and progress.answered(channel, joined):
+        LOGGER.info('Finished joining channels: %s', progress)
+
+
 @willie.module.rule('.*')
 @willie.module.event('QUIT')
 @willie.module.priority('high')
@@ -339,6 +394,32 @@ def track_quit(bot, trigger):
             del chanprivs[trigger.nick]
 
 
+@willie.module.rule('.*')
+@willie.module.event('BATCH')
+@willie.module.priority('high')
+@willie.module.thread(False)
+@willie.module.unblockable
+def track_batch(bot, trigger):
+    """Apply the JOINs and QUITs in a netjoin or netsplit all at once."""
+    if trigger.batch is None:
+        return
+    joined = {}
+    quit = set()
+    for line in trigger.batch.lines:
+        if line.event == 'JOIN':
+            joined.setdefault(line.sender, []).append(line.nick)
+        elif line.event == 'QUIT':
+            quit.add(line.nick)
+    for channel, nicks in iteritems(joined):
+        # Nobody else can join a channel before we have
+        if channel in bot.privileges:
+            bot.privileges[channel].update(dict.fromkeys(nicks, 0))
+    if quit:
+        for chanprivs in bot.privileges.values():
+            for nick in quit.intersection(chanprivs):
+                del chanprivs[nick]
+
+
 @willie.module.rule('.*')
 @willie.module.event('CAP')
 @willie.module.thread(False)
@@ -359,10 +440,15 @@ def recieve_cap_list(bot, trigger):
                 if req[0] and req[2]:
                     # Call it.
                     req[2](bot, req[0] + trigger)
-    # Server is acknowledinge SASL for us.
-    elif (trigger.args[0] == bot.nick and trigger.args[1] == 'ACK' and
-          'sasl' in trigger.args[2]):
-        recieve_cap_ack_sasl(bot)
+    elif trigger.args[1] == 'ACK':
+        for cap in trigger.args[2].split():
+            if cap.startswith('-'):
+                bot.enabled_capabilities.discard(cap[1:])
+            else:
+                bot.enabled_capabilities.add(cap.lstrip('~='))
+        # Server is acknowledinge SASL for us.
+        if trigger.args[0] == bot.nick and 'sasl' in trigger.args[2]:
+            recieve_cap_ack_sasl(bot)
 
 
 def recieve_cap_ls_reply(bot, trigger):
@@ -493,9 +579,11 @@ def blocks(bot, trigger):
             nicks.append(text[3])
             bot.config.core.nick_blocks = nicks
             bot.config.save()
+            bot.rebuild_blocklist()
         elif text[2] == "hostmask":
             masks.append(text[3].lower())
             bot.config.core.host_blocks = masks
+            bot.rebuild_blocklist()
         else:
             bot.reply(STRINGS['invalid'] % ("adding"))
             return
@@ -510,6 +598,7 @@ def blocks(bot, trigger):
             nicks.remove(Identifier(text[3]))
             bot.config.core.nick_blocks = nicks
             bot.config.save()
+            bot.rebuild_blocklist()
             bot.reply(STRINGS['success_del'] % (text[3]))
         elif text[2] == "hostmask":
             mask = text[3].lower()
@@ -519,9 +608,95 @@ def blocks(bot, trigger):
             masks.remove(mask)
             bot.config.core.host_blocks = masks
             bot.config.save()
+            bot.rebuild_blocklist()
             bot.reply(STRINGS['success_del'] % (text[3]))
         else:
             bot.reply(STRINGS['invalid'] % ("deleting"))
             return
     else:
         bot.reply(STRINGS['huh'])
+
+
+@willie.module.commands('stats')
+@willie.module.priority('low')
+@willie.module.unblockable
+def stats(bot, trigger):
+    """Show where Willie is spending its time.
+
+    With no arguments, lists the callables which have spent the longest
+    running, the worker queue depths and the size of the bot's caches.
+    Given a callable's module.function name, shows its match, queue wait and
+    run times.
+
+    """
+    if not trigger.admin:
+        return
+
+    name = trigger.group(3)
+    if name:
+        if name not in bot.stats:
+            bot.reply('No stats recorded for %s.' % name)
+            return
+        for line in bot.stats[name].report():
+            bot.say(line.strip())
+        return
+
+    depths = bot.executor.depths()
+    bot.say('Worker queue: %d high, %d medium, %d low, %d deferred, '
+            '%d dropped' % (depths['high'], depths['medium'], depths['low'],
+                            depths['deferred'], bot.executor.dropped))
+    gauges = bot.stats.read_gauges()
+    if gauges:
+        bot.say(', '.join('%s: %s' % gauge for gauge in gauges))
+    for callable_stats in bot.stats.top(5):
+        if not callable_stats.run.count:
+            continue
+        bot.say('%s: %d calls, %d errors, run %s' % (
+            callable_stats.name, callable_stats.run.count,
+            callable_stats.errors, callable_stats.run.summary()))
+
+
+@willie.module.commands('jobs')
+@willie.module.priority('low')
+@willie.module.unblockable
+def jobs(bot, trigger):
+    """Show how well Willie's scheduled jobs are keeping to time.
+
+    With no arguments, lists the jobs which have started latest, with how
+    late they started, how long they ran, and how many of their runs were
+    skipped, overlapped an earlier run or went over their timeout. Given the
+    start of a job's name, shows the full report for the jobs it matches.
+
+    """
+    if not trigger.admin:
+        return
+
+    name = trigger.group(2)
+    if name:
+        found = [job_stats for job_name, job_stats
+                 in sorted(bot.stats.jobs.items())
+                 if job_name.startswith(name.strip())]
+        if not found:
+            bot.reply('No stats recorded for %s.' % name)
+            return
+        for job_stats in found[:3]:
+            for line in job_stats.report():
+                bot.say(line.strip())
+        return
+
+    waiting = bot.scheduler.jobs()
+    if waiting:
+        due = max(waiting[0].next_time - time.monotonic(), 0)
+        bot.say('%d jobs scheduled; next is %s, due in %s.' % (
+            len(waiting), waiting[0].name, format_seconds(due)))
+    else:
+        bot.say('No jobs scheduled.')
+    for job_stats in bot.stats.top_jobs(5):
+        bot.say('%s: %d runs, drift p95 %s max %s, run p95 %s, '
+                '%d skipped, %d overlapping, %d timed out' % (
+                    job_stats.name, job_stats.drift.count,
+                    format_seconds(job_stats.drift.percentile(95)),
+                    format_seconds(job_stats.drift.max),
+                    format_seconds(job_stats.run.percentile(95)),
+                    job_stats.skipped, job_stats.overlapping,
+                    job_stats.timeouts))
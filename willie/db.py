@@ -35,6 +35,7 @@ class WillieDB(object):
         if self.filename is None:
             self.filename = os.path.splitext(config.filename)[0] + '.db'
         self._create()
+        self._create_jobs()
 
     def connect(self):
         """Return a raw database connection object."""
@@ -82,6 +83,24 @@ class WillieDB(object):
             'PRIMARY KEY (channel, key))'
         )
 
+    def _create_jobs(self):
+        """Create the table of stored jobs, if it isn't there yet.
+
+        This is separate from ``_create`` so that databases created before
+        the table existed get it too.
+
+        """
+        self.execute(
+            'CREATE TABLE IF NOT EXISTS scheduled_jobs '
+            '(job_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'function STRING, next_time REAL, interval REAL, args STRING, '
+            'overlap STRING, timeout REAL, disable_after INTEGER)'
+        )
+        self.execute(
+            'CREATE INDEX IF NOT EXISTS scheduled_jobs_next_time '
+            'ON scheduled_jobs (next_time)'
+        )
+
     def get_uri(self):
         """Returns a URL for the database, usable to connect with SQLAlchemy.
         """
@@ -211,6 +230,55 @@ class WillieDB(object):
             result = result[0]
         return _deserialize(result)
 
+    # JOB FUNCTIONS
+
+    def add_job(self, function, next_time, interval=None, args=(),
+                overlap=None, timeout=None, disable_after=None):
+        """Store a job, and return its ID.
+
+        ``function`` is the ``module.function`` name of the function to call,
+        ``next_time`` when to call it, as a Unix timestamp, and ``interval``
+        the seconds between calls for a recurring job. ``args`` must be
+        serializable to JSON. ``overlap``, ``timeout`` and ``disable_after``
+        are the job's overlap policy and time limit, if it has them.
+
+        """
+        args = json.dumps(list(args), ensure_ascii=False)
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                'INSERT INTO scheduled_jobs '
+                '(function, next_time, interval, args, overlap, timeout, '
+                'disable_after) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [function, next_time, interval, args, overlap, timeout,
+                 disable_after]
+            )
+            return cur.lastrowid
+
+    def get_due_jobs(self, until):
+        """Return the stored jobs due by ``until``, soonest first.
+
+        Each is a tuple of its ID, function name, next time, interval, a list
+        of its arguments, overlap policy, timeout and ``disable_after``.
+
+        """
+        rows = self.execute(
+            'SELECT job_id, function, next_time, interval, args, overlap, '
+            'timeout, disable_after FROM scheduled_jobs '
+            'WHERE next_time <= ? ORDER BY next_time',
+            [until]
+        ).fetchall()
+        return [row[:4] + (json.loads(row[4]),) + row[5:] for row in rows]
+
+    def set_job_time(self, job_id, next_time):
+        """Set when a stored job is next due."""
+        self.execute('UPDATE scheduled_jobs SET next_time = ? WHERE job_id = ?',
+                     [next_time, job_id])
+
+    def delete_job(self, job_id):
+        """Remove a stored job."""
+        self.execute('DELETE FROM scheduled_jobs WHERE job_id = ?', [job_id])
+
     # NICK AND CHANNEL FUNCTIONS
 
     def get_nick_or_channel_value(self, name, key):
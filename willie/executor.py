@@ -0,0 +1,254 @@
+# coding=utf8
+"""
+executor.py - Willie callable executor
+Licensed under the Eiffel Forum License 2.
+
+http://willie.dftba.net/
+
+Threaded callables (and interval jobs) are run on a fixed pool of worker
+threads, rather than on a new thread each. Work waits in a bounded queue until
+a worker is free; what happens when that queue is full is decided by the
+overflow policy, one of:
+
+drop
+    The queued item with the lowest priority is thrown away to make room. If
+    everything queued has a higher priority than the new item, the new item
+    is thrown away instead. This is the default.
+block
+    The caller waits until there is room in the queue. Callers which must not
+    wait, like the event loop, get the ``drop`` policy instead.
+reject
+    The new item is thrown away.
+
+Every item thrown away is logged.
+
+Each priority has a queue of its own, and workers always take from the most
+urgent non-empty one, so a backlog of slow low-priority work cannot hold up
+the high-priority callables which keep the bot's state up to date. When the
+backlog passes ``low_threshold`` items, new low-priority work is either set
+aside until the backlog falls below it again (the ``defer`` policy) or thrown
+away (``drop``).
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+from willie.logger import get_logger
+
+LOGGER = get_logger()
+
+PRIORITIES = ('high', 'medium', 'low')
+"""The priorities work can be submitted with, from most to least urgent."""
+
+OVERFLOW_POLICIES = ('block', 'drop', 'reject')
+
+LOW_PRIORITY_POLICIES = ('defer', 'drop')
+
+
+class WorkItem(object):
+    """A function waiting in a ``WorkerPool``'s queue."""
+    def __init__(self, func, args, priority, name=None):
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.rank = PRIORITIES.index(priority)
+        self.name = name or getattr(func, '__name__', repr(func))
+        self.queued = time.time()
+
+    def __str__(self):
+        return '%s (%s priority)' % (self.name, self.priority)
+
+
+class WorkerPool(object):
+    """A fixed number of threads running functions from a bounded queue.
+
+    ``size`` is the number of worker threads, ``max_queue`` the number of
+    items which may be waiting for a worker, and ``overflow`` one of the
+    policies described above. If ``low_threshold`` is given, ``low_policy``
+    decides what happens to low-priority work while the backlog is longer.
+
+    If a ``StatsRegistry`` is given as ``stats``, the time each item spends
+    waiting is recorded under the name it was submitted with.
+
+    """
+    def __init__(self, size=10, max_queue=1000, overflow='drop',
+                 low_threshold=None, low_policy='defer', stats=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %r; expected one of %s'
+                             % (overflow, ', '.join(OVERFLOW_POLICIES)))
+        if low_policy not in LOW_PRIORITY_POLICIES:
+            raise ValueError('Unknown low priority policy %r; expected one of '
+                             '%s' % (low_policy,
+                                     ', '.join(LOW_PRIORITY_POLICIES)))
+        if low_threshold is not None and low_threshold < 1:
+            raise ValueError('The low priority threshold must be at least 1, '
+                             'not %r' % low_threshold)
+        self.size = size
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.low_threshold = low_threshold
+        self.low_policy = low_policy
+        self.stats = stats
+        self.dropped = 0
+        """The number of items thrown away because the queue was full."""
+        self._queues = dict((priority, collections.deque())
+                            for priority in PRIORITIES)
+        self._deferred = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._workers = []
+        self._running = True
+        for i in range(size):
+            worker = threading.Thread(target=self._work,
+                                      name='WorkerPool-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @classmethod
+    def from_config(cls, config, stats=None):
+        """Create a pool from the ``worker_*`` options in ``[core]``."""
+        low_threshold = config.worker_low_threshold
+        return cls(
+            size=int(config.worker_threads or 10),
+            max_queue=int(config.worker_queue or 1000),
+            overflow=config.worker_overflow or 'drop',
+            low_threshold=int(low_threshold) if low_threshold else None,
+            low_policy=config.worker_low_policy or 'defer',
+            stats=stats,
+        )
+
+    def _len(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def qsize(self):
+        """Return the number of items waiting for a worker."""
+        with self._lock:
+            return self._len()
+
+    def depths(self):
+        """Return a dict of the number of waiting items for each priority.
+
+        Deferred low-priority work is counted under ``'deferred'``.
+
+        """
+        with self._lock:
+            depths = dict((priority, len(queue))
+                          for priority, queue in self._queues.items())
+            depths['deferred'] = len(self._deferred)
+            return depths
+
+    def submit(self, func, args=(), priority='medium', name=None,
+               block=True):
+        """Queue ``func(*args)`` to be run by a worker.
+
+        ``name`` is used in log messages and stats; it defaults to the name of
+        ``func``. Returns True if the function was queued (or deferred), and
+        False if it, or nothing, was thrown away because the queue was full.
+
+        Callers which must never wait, like the event loop, pass False for
+        ``block``; under the ``block`` policy, they get ``drop`` instead.
+
+        """
+        item = WorkItem(func, args, priority, name)
+        with self._lock:
+            if (priority == 'low' and self.low_threshold is not None and
+                    self._len() >= self.low_threshold):
+                if (self.low_policy == 'drop' or
+                        len(self._deferred) >= self.max_queue):
+                    self._discard(item)
+                    return False
+                self._deferred.append(item)
+                return True
+            if self._len() >= self.max_queue:
+                overflow = self.overflow
+                if overflow == 'block' and not block:
+                    overflow = 'drop'
+                if overflow == 'block':
+                    while self._len() >= self.max_queue and self._running:
+                        self._not_full.wait()
+                elif overflow == 'drop':
+                    victim = self._lowest_priority()
+                    if victim.rank < item.rank:
+                        victim = item
+                    self._discard(victim)
+                    if victim is item:
+                        return False
+                    self._queues[victim.priority].pop()
+                else:
+                    self._discard(item)
+                    return False
+            if not self._running:
+                return False
+            self._queues[priority].append(item)
+            self._not_empty.notify()
+        return True
+
+    def _lowest_priority(self):
+        """Return the most recently queued of the lowest priority items."""
+        for priority in reversed(PRIORITIES):
+            if self._queues[priority]:
+                return self._queues[priority][-1]
+
+    def _discard(self, item):
+        self.dropped += 1
+        LOGGER.warning('Worker queue full (%d waiting), dropped %s.',
+                       self._len(), item)
+
+    def _next(self):
+        with self._lock:
+            while self._running:
+                if not self._len():
+                    # Nothing else will bring deferred work back if the
+                    # queues drained without it.
+                    self._release_deferred()
+                if self._len():
+                    break
+                self._not_empty.wait()
+            if not self._running:
+                return None
+            for priority in PRIORITIES:
+                if self._queues[priority]:
+                    item = self._queues[priority].popleft()
+                    break
+            self._release_deferred()
+            self._not_full.notify()
+            return item
+
+    def _release_deferred(self):
+        """Bring deferred work back once the backlog has gone down."""
+        low = self._queues['low']
+        while self._deferred and self._len() < self.low_threshold:
+            low.append(self._deferred.popleft())
+            self._not_empty.notify()
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            if self.stats is not None:
+                self.stats.record_wait(item.name, time.time() - item.queued)
+            try:
+                item.func(*item.args)
+            except Exception:
+                LOGGER.exception('Uncaught exception in worker running %s',
+                                 item)
+
+    def shutdown(self):
+        """Stop the workers once they finish what they are running.
+
+        Anything still waiting in the queue is thrown away.
+
+        """
+        with self._lock:
+            self._running = False
+            for queue in self._queues.values():
+                queue.clear()
+            self._deferred.clear()
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
@@ -20,34 +20,243 @@ import sys
 import re
 import time
 import socket
-import asyncore
-import asynchat
+import asyncio
+import collections
 import os
 import codecs
+import random
+import concurrent.futures
 import traceback
-from willie.tools import stderr, Identifier
-from willie.trigger import PreTrigger, Trigger
+from willie.logger import RawLogWriter, get_logger
+from willie.outbound import OutboundQueue
+from willie.tools import stderr, Identifier, ExpiringDict
+from willie.trigger import Batch, PreTrigger, Trigger
 try:
-    import select
     import ssl
     has_ssl = True
 except ImportError:
     # no SSL support
     has_ssl = False
-if has_ssl:
-    if not hasattr(ssl, 'match_hostname'):
-        # Attempt to import ssl_match_hostname from python-backports
-        import backports.ssl_match_hostname
-        ssl.match_hostname = backports.ssl_match_hostname.match_hostname
-        ssl.CertificateError = backports.ssl_match_hostname.CertificateError
-import errno
 import threading
 from datetime import datetime
+
+LOGGER = get_logger(__name__)
+
 if sys.version_info.major >= 3:
     unicode = str
 
 
-class Bot(asynchat.async_chat):
+def split_channels(channels):
+    """Return ``(name, key)`` for each of ``channels`` which isn't blank.
+
+    Each entry is a channel name, optionally followed by a space and its key,
+    as in the ``channels`` option; the key is ``''`` if there isn't one.
+
+    """
+    split = []
+    for entry in channels:
+        name, _, key = entry.strip().partition(' ')
+        if name:
+            split.append((name, key.strip()))
+    return split
+
+
+def pack_joins(channels, max_targets=None, max_length=510):
+    """Pack ``channels`` into the arguments of as few JOIN lines as possible.
+
+    Each of ``channels`` is a channel name, optionally followed by a space and
+    its key. Returns a list of ``(channels, keys)`` tuples, each a list, for
+    lines of no more than ``max_targets`` channels and ``max_length`` bytes.
+    Channels with keys come first, since the server matches keys to channels
+    in order.
+
+    """
+    keyed = []
+    unkeyed = []
+    for name, key in split_channels(channels):
+        (keyed if key else unkeyed).append((name, key))
+
+    lines = []
+    names, keys = [], []
+    length = 0
+    for name, key in keyed + unkeyed:
+        # One byte for the comma (or space) before each name or key
+        extra = len(name.encode('utf-8')) + 1
+        if key:
+            extra += len(key.encode('utf-8')) + 1
+        full = max_targets and len(names) >= max_targets
+        if names and (full or length + extra > max_length):
+            lines.append((names, keys))
+            names, keys = [], []
+            length = 0
+        if not names:
+            length = len('JOIN')
+        names.append(name)
+        if key:
+            keys.append(key)
+        length += extra
+    if names:
+        lines.append((names, keys))
+    return lines
+
+
+class JoinProgress(object):
+    """How far the bot has got through joining its channels.
+
+    ``sent`` is the number of channels JOINs have been sent for so far, out
+    of ``total``; ``joined`` and ``failed`` count the server's answers.
+
+    """
+    def __init__(self, channels):
+        self.waiting = set(Identifier(name)
+                           for name, _ in split_channels(channels))
+        self.total = len(self.waiting)
+        self.sent = 0
+        self.joined = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    def answered(self, channel, joined=True):
+        """Record the server's answer to joining ``channel``.
+
+        Returns True if this was the last channel we were waiting for.
+
+        """
+        channel = Identifier(channel)
+        if channel not in self.waiting:
+            return False
+        self.waiting.discard(channel)
+        if joined:
+            self.joined += 1
+        else:
+            self.failed += 1
+        if not self.waiting:
+            self.finished = time.monotonic()
+            return True
+        return False
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def __str__(self):
+        text = '%d/%d joined' % (self.joined, self.total)
+        if self.failed:
+            text += ', %d failed' % self.failed
+        if self.sent < self.total:
+            text += ', %d/%d sent' % (self.sent, self.total)
+        return '%s in %.1fs' % (text, self.elapsed())
+
+
+class IrcProtocol(getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)):
+    """Hands the events of an IRC server connection over to a ``Bot``.
+
+    Data is read straight into the bot's receive buffer where asyncio allows
+    it (Python 3.7 and later), and copied into it otherwise.
+
+    """
+    def __init__(self, bot):
+        self.bot = bot
+
+    def connection_made(self, transport):
+        self.bot.transport = transport
+        self.bot.handle_connect()
+
+    def get_buffer(self, sizehint):
+        return self.bot.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        try:
+            self.bot.buffer_updated(nbytes)
+        except Exception:
+            self.bot.handle_error()
+
+    def data_received(self, data):
+        try:
+            self.bot.handle_read(data)
+        except Exception:
+            self.bot.handle_error()
+
+    def connection_lost(self, exc):
+        self.bot.handle_disconnect(exc)
+
+    def pause_writing(self):
+        self.bot.pause_writing()
+
+    def resume_writing(self):
+        self.bot.resume_writing()
+
+
+def run_networks(bots, delay):
+    """Keep each bot connected to its own network, all on one event loop.
+
+    Returns once every bot has quit (or, if ``delay`` is not an int, been
+    disconnected).
+
+    """
+    loop = asyncio.new_event_loop()
+    for bot in bots:
+        bot.loop = loop
+        bot._loop_thread = threading.current_thread()
+    connections = [loop.create_task(bot.stay_connected(delay))
+                   for bot in bots]
+    try:
+        loop.run_until_complete(asyncio.wait(connections))
+        for connection in connections:
+            # Raise anything that went wrong.
+            connection.result()
+    except KeyboardInterrupt:
+        print('KeyboardInterrupt')
+        for bot in bots:
+            bot.quit('KeyboardInterrupt')
+        for bot in bots:
+            bot._wait_for_close()
+        for connection in connections:
+            connection.cancel()
+        loop.run_until_complete(asyncio.wait(connections))
+    finally:
+        loop.close()
+        for bot in bots:
+            bot.loop = None
+            bot._loop_thread = None
+        for bot in bots:
+            bot._close_raw_log()
+            bot._wait_for_raw_logs()
+
+
+class Bot(object):
+    flood_window = 120
+    """Seconds over which repeated messages count towards loop detection."""
+    recv_buffer_size = 16 * 1024
+    """
+    Size of the buffer lines are read into. Anything longer than this without
+    a line break is thrown away.
+    """
+    output_buffer_limit = 64 * 1024
+    """
+    Bytes which may wait in the output buffer before threads calling ``write``
+    are made to wait for it to be flushed.
+    """
+    batch_types = ('netjoin', 'netsplit')
+    """
+    Types of IRCv3 batch whose lines are held back until the batch ends, and
+    then dispatched as a single ``BATCH`` event.
+    """
+    max_batches = 16
+    """Batches which may be held open at once; any more are not held."""
+    join_retry_delay = 6
+    """Seconds before the first retry of a channel we need to identify for."""
+    join_retry_max_delay = 300
+    """The longest wait between retries; the delay doubles up to this."""
+    join_retry_attempts = 10
+    """How many times to retry joining a channel before giving up."""
+    join_retry_channels = 256
+    """Channels to keep retry state for; the oldest are forgotten first."""
+
     def __init__(self, config):
         ca_certs = '/etc/pki/tls/cert.pem'
         if config.ca_certs is not None:
@@ -61,9 +270,66 @@ class Bot(asynchat.async_chat):
         if config.log_raw is None:
             # Default is to log raw data, can be disabled in config
             config.log_raw = True
-        asynchat.async_chat.__init__(self)
-        self.set_terminator(b'\n')
         self.buffer = ''
+        """The line currently being handled."""
+        self._recv_buffer = bytearray(self.recv_buffer_size)
+        self._recv_view = memoryview(self._recv_buffer)
+        self._recv_used = 0
+        self._recv_discarding = False
+        self._batches = {}
+        self._was_registered = False
+        self._join_timer = None
+        self._join_fallback = None
+        self.join_retries = ExpiringDict(self.join_retry_max_delay * 2,
+                                         self.join_retry_channels,
+                                         on_expire=self._join_retry_expired)
+        """
+        An ``ExpiringDict`` of channels we're waiting to retry joining, to
+        the number of attempts so far, the channel's key (or None) and the
+        timer for the next attempt.
+        """
+        self.join_progress = None
+        """
+        The ``JoinProgress`` of the last ``join_channels`` on this connection,
+        or None.
+        """
+        self.isupport = {}
+        """
+        The features and limits the server advertised in RPL_ISUPPORT (005).
+        Values are strings, or None for flags; ``TARGMAX`` is a dict of
+        commands to their limit (None when there isn't one).
+        """
+
+        self.loop = None
+        """The asyncio event loop the connection is running on."""
+        self._loop_thread = None
+        # The loop only keeps weak references to tasks, so running coroutines
+        # are kept here until they finish.
+        self._tasks = set()
+        self.transport = None
+        """The asyncio transport of the current connection, if any."""
+        self.network = None
+        """The name of the network, when connected to several."""
+        self.shard = None
+        """The nick of this connection, when the network is sharded."""
+        self.connected = False
+        self.connecting = False
+        self._disconnected = None
+        self._output = []
+        self._output_size = 0
+        self._output_ready = threading.Condition()
+        self._flush_scheduled = False
+        self._writing_paused = False
+        self._keepalive_timer = None
+        self._last_received = None
+        self._last_ping = None
+        self._ping_sent = None
+        self._ping_token = None
+        self._pings = 0
+        self.lag = None
+        """Seconds between our last PING and the server's PONG, if measured."""
+        self.lag_average = None
+        """A moving average of ``lag``."""
 
         self.nick = Identifier(config.nick)
         """Willie's current ``Identifier``. Changing this while Willie is running is
@@ -76,12 +342,30 @@ class Bot(asynchat.async_chat):
         self.channels = []
         """The list of channels Willie is currently in."""
 
-        self.stack = {}
+        self.stack = ExpiringDict(
+            self.flood_window, int(config.flood_history_size or 10000))
+        """
+        An ``ExpiringDict`` of the last few messages sent to each recipient,
+        for flood control and loop detection. Recipients are forgotten once
+        nothing has been sent to them for ``flood_window`` seconds.
+        """
         self.ca_certs = ca_certs
         self.hasquit = False
 
         self.sending = threading.RLock()
+        self.outbound = OutboundQueue(
+            self.write, self.call_in_loop,
+            burst=float(config.flood_burst or 1),
+            rate=float(config.flood_refill_rate or 1))
+        """
+        The ``OutboundQueue`` which paces the messages sent by ``msg``, with a
+        token bucket for each recipient.
+        """
         self.writing_lock = threading.Lock()
+        self._raw_log = None
+        self._raw_log_lock = threading.Lock()
+        # Closed logs still writing out, or compressing, in the background
+        self._closed_raw_logs = []
         self.raw = None
 
         # Right now, only accounting for two op levels.
@@ -109,14 +393,33 @@ class Bot(asynchat.async_chat):
         """ Set to True when a server has accepted the client connection and
         messages can be sent and received. """
 
-        # Work around bot.connecting missing in Python older than 2.7.4
-        if not hasattr(self, "connecting"):
-            self.connecting = False
-
     def log_raw(self, line, prefix):
-        """Log raw line to the raw log."""
+        """Log raw line to the raw log.
+
+        The line is handed to a ``RawLogWriter``, which writes it on another
+        thread; the writer is started on the first line logged.
+
+        """
         if not self.config.core.log_raw:
             return
+        if self._raw_log is None:
+            with self._raw_log_lock:
+                if self._raw_log is None:
+                    self._raw_log = self._open_raw_log()
+        self._raw_log.write(prefix, line)
+
+    @property
+    def connection_name(self):
+        """The network and shard this connection is for, or None.
+
+        This tells apart the logs and stats of each connection, when there
+        are several.
+
+        """
+        return '.'.join(name for name in (self.network, self.shard)
+                        if name) or None
+
+    def _open_raw_log(self):
         if not self.config.core.logdir:
             self.config.core.logdir = os.path.join(self.config.core.homedir, 'logs')
         if not os.path.isdir(self.config.core.logdir):
@@ -127,13 +430,36 @@ class Bot(asynchat.async_chat):
                 stderr('%s %s' % (str(e.__class__), str(e)))
                 stderr('Please fix this and then run Willie again.')
                 os._exit(1)
-        f = codecs.open(os.path.join(self.config.core.logdir, 'raw.log'), 'a', encoding='utf-8')
-        f.write(prefix + unicode(time.time()) + "\t")
-        temp = line.replace('\n', '')
+        if self.connection_name:
+            # Each shard rotates its own log, so they can't share one.
+            filename = 'raw.%s.log' % self.connection_name
+        else:
+            filename = 'raw.log'
+        filename = os.path.join(self.config.core.logdir, filename)
+        return RawLogWriter.from_config(self.config.core, filename)
+
+    def _close_raw_log(self):
+        """Close the raw log without waiting for it to be written out.
 
-        f.write(temp)
-        f.write("\n")
-        f.close()
+        This is called on the event loop, which every connection shares, so
+        the writer finishes in the background; ``_wait_for_raw_logs`` waits
+        for it before the bot exits.
+
+        """
+        with self._raw_log_lock:
+            raw_log, self._raw_log = self._raw_log, None
+            if raw_log is None:
+                return
+            self._closed_raw_logs = [log for log in self._closed_raw_logs
+                                     if log.alive()]
+            self._closed_raw_logs.append(raw_log)
+        raw_log.close(wait=False)
+
+    def _wait_for_raw_logs(self, timeout=5):
+        with self._raw_log_lock:
+            closed, self._closed_raw_logs = self._closed_raw_logs, []
+        for raw_log in closed:
+            raw_log.join(timeout)
 
     def safe(self, string):
         """Remove newlines from a string."""
@@ -167,6 +493,7 @@ class Bot(asynchat.async_chat):
         args = [self.safe(arg) for arg in args]
         if text is not None:
             text = self.safe(text)
+        self._wait_for_output_room()
         try:
             self.writing_lock.acquire()  # Blocking lock, can't send two things at a time
 
@@ -191,31 +518,228 @@ class Bot(asynchat.async_chat):
         finally:
             self.writing_lock.release()
 
-    def run(self, host, port=6667):
+    def send(self, data):
+        """Queue raw bytes to be sent to the server, from any thread.
+
+        Everything sent during one pass of the event loop is gathered in the
+        output buffer, and handed to the transport in a single write.
+
+        """
+        if self.loop is None:
+            # Not running, so there's nothing to send it to.
+            return
+        with self._output_ready:
+            self._output.append(data)
+            self._output_size += len(data)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        if threading.current_thread() is self._loop_thread:
+            self.loop.call_soon(self._flush)
+        else:
+            self.call_in_loop(self._flush)
+
+    def _flush(self):
+        """Write the output buffer to the transport. Called on the loop."""
+        with self._output_ready:
+            self._flush_scheduled = False
+            if self._writing_paused or not self._output:
+                # resume_writing will flush once the transport catches up.
+                return
+            data = b''.join(self._output)
+            self._output = []
+            self._output_size = 0
+            self._output_ready.notify_all()
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def _wait_for_output_room(self):
+        """Block until the output buffer is below ``output_buffer_limit``.
+
+        This is how a thread sending a flood of lines is slowed down to the
+        pace of the connection. The loop thread never waits, since it is the
+        one which empties the buffer.
+
+        """
+        if threading.current_thread() is self._loop_thread:
+            return
+        with self._output_ready:
+            while (self._output_size >= self.output_buffer_limit and
+                    self.transport is not None):
+                self._output_ready.wait(1)
+
+    def pause_writing(self):
+        """Called when the transport's own buffer is too full."""
+        with self._output_ready:
+            self._writing_paused = True
+
+    def resume_writing(self):
+        """Called when the transport's buffer has drained again."""
+        with self._output_ready:
+            self._writing_paused = False
+        self._flush()
+
+    def _clear_output(self):
+        with self._output_ready:
+            self._output = []
+            self._output_size = 0
+            self._flush_scheduled = False
+            self._writing_paused = False
+            self._output_ready.notify_all()
+
+    def call_in_loop(self, func, *args):
+        """Call ``func(*args)`` on the event loop's thread.
+
+        If this is called from the loop's thread, the function is called right
+        away; otherwise it is called as soon as the loop gets to it. If the bot
+        is not running, the call is dropped.
+
+        """
+        if threading.current_thread() is self._loop_thread:
+            func(*args)
+        elif self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(func, *args)
+            except RuntimeError:
+                # The loop has been closed since we looked.
+                pass
+
+    def run_coroutine(self, coro):
+        """Schedule a coroutine to run on the event loop from any thread.
+
+        If the bot is not running, the coroutine is closed without being run
+        and None is returned.
+
+        """
+        if self.loop is None:
+            coro.close()
+            return None
+        if threading.current_thread() is self._loop_thread:
+            return self._start_task(coro)
+        return asyncio.run_coroutine_threadsafe(self._run_task(coro),
+                                                self.loop)
+
+    def _start_task(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    async def _run_task(self, coro):
+        return await self._start_task(coro)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.error('Unhandled exception in coroutine',
+                         exc_info=task.exception())
+
+    async def stay_connected(self, delay):
+        """Connect to the configured server, reconnecting until we quit.
+
+        ``delay`` is how many seconds to wait before reconnecting; if it is
+        not an int, we don't. A connection which was registered and lasted at
+        least ``delay`` seconds is retried without waiting.
+
+        """
+        host = self.config.core.host
+        port = int(self.config.core.port)
+        while True:
+            started = time.monotonic()
+            try:
+                await self.initiate_connect(host, port)
+            except socket.error as e:
+                stderr('Connection error: %s' % e)
+            if (self.hasquit or self.config.exit_on_error or
+                    not isinstance(delay, int)):
+                break
+            if self._was_registered and time.monotonic() - started >= delay:
+                # We were in business for a while, so it's most likely just
+                # this connection which dropped; try again straight away.
+                # Anything flakier than that waits, as usual.
+                stderr('Warning: Disconnected from %s. Reconnecting...'
+                       % (self.network or host))
+                continue
+            stderr('Warning: Disconnected from %s. Reconnecting in %s '
+                   'seconds...' % (self.network or host, delay))
+            await asyncio.sleep(delay)
+
+    def reset_connection_state(self):
+        """Forget everything learned from the server on the last connection.
+
+        This is called before each connection, so that reconnecting needs
+        nothing more than a new socket; modules, the database and the rest
+        stay as they are.
+
+        """
+        self._clear_output()
+        self._recv_used = 0
+        self._recv_discarding = False
+        self._batches.clear()
+        self._was_registered = False
+        self._stop_joining()
+        self.join_progress = None
+        self.isupport = {}
+        self.nick = Identifier(self.config.core.nick)
+        self.channels = []
+        self.ops = dict()
+        self.halfplus = dict()
+        self.voices = dict()
+        self.connection_registered = False
+
+    def _shutdown(self):
+        """Called once the bot is done with its last connection."""
+        pass
+
+    def _wait_for_close(self, timeout=5):
+        """Run the loop until the server hangs up, or ``timeout`` runs out."""
+        if self._disconnected is None or self._disconnected.done():
+            return
         try:
-            self.initiate_connect(host, port)
-        except socket.error as e:
-            stderr('Connection error: %s' % e)
-            self.hasquit = True
+            self.loop.run_until_complete(
+                asyncio.wait_for(asyncio.shield(self._disconnected), timeout))
+        except (asyncio.TimeoutError, KeyboardInterrupt):
+            if self.transport is not None:
+                self.transport.abort()
+
+    def _ssl_context(self):
+        if not self.config.core.verify_ssl:
+            # PROTOCOL_TLS_CLIENT is new in Python 3.6.
+            context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT',
+                                             ssl.PROTOCOL_SSLv23))
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif os.path.isfile(self.ca_certs):
+            context = ssl.create_default_context(cafile=self.ca_certs)
+        else:
+            context = ssl.create_default_context()
+        return context
 
-    def initiate_connect(self, host, port):
+    async def initiate_connect(self, host, port):
         stderr('Connecting to %s:%s...' % (host, port))
+        self.reset_connection_state()
         source_address = ((self.config.core.bind_host, 0)
                           if self.config.core.bind_host else None)
-        self.set_socket(socket.create_connection((host, port),
-                        source_address=source_address))
+        context = None
         if self.config.core.use_ssl and has_ssl:
-            self.send = self._ssl_send
-            self.recv = self._ssl_recv
+            context = self._ssl_context()
         elif not has_ssl and self.config.core.use_ssl:
             stderr('SSL is not avilable on your system, attempting connection '
                    'without it')
-        self.connect((host, port))
+        self._disconnected = self.loop.create_future()
+        self.connecting = True
         try:
-            asyncore.loop()
-        except KeyboardInterrupt:
-            print('KeyboardInterrupt')
-            self.quit('KeyboardInterrupt')
+            await self.loop.create_connection(
+                lambda: IrcProtocol(self), host, port, ssl=context,
+                server_hostname=host if context else None,
+                local_addr=source_address)
+        except ssl.CertificateError:
+            stderr("Invalid certficate, hostname mismatch!")
+            os.unlink(self.config.pid_file_path)
+            os._exit(1)
+        finally:
+            self.connecting = False
+        await self._disconnected
 
     def quit(self, message):
         """Disconnect from IRC and close the bot."""
@@ -230,15 +754,34 @@ class Bot(asynchat.async_chat):
         # quit might still want to do something before main thread quits.
 
     def handle_close(self):
-        self.connection_registered = False
+        """Close the connection to the server.
 
-        self._shutdown()
+        Anything already written is sent first. This may be called from any
+        thread; ``handle_disconnect`` is called once the connection is gone.
+
+        """
+        def close():
+            if self.transport is not None:
+                self.transport.close()
+        self.call_in_loop(close)
+
+    def handle_disconnect(self, exc=None):
+        """Called on the loop once the connection to the server is gone."""
+        self.connected = False
+        self.transport = None
+        self._was_registered = self.connection_registered
+        self.connection_registered = False
+        self._stop_keepalive()
+        self._stop_joining()
+        self.outbound.clear()
+        self._clear_output()
+        self._close_raw_log()
         stderr('Closed!')
 
-        # This will eventually call asyncore dispatchers close method, which
-        # will release the main thread. This should be called last to avoid
+        # This releases the main thread, so it should be called last to avoid
         # race conditions.
-        self.close()
+        if self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(exc)
 
     def part(self, channel, msg=None):
         """Part a channel."""
@@ -257,25 +800,138 @@ class Bot(asynchat.async_chat):
         else:
             self.write(['JOIN', channel, password])
 
+    def join_channels(self, channels):
+        """Join ``channels``, with as few JOIN lines as the server allows.
+
+        The channels are packed into lines within the server's TARGMAX and
+        LINELEN limits. If ``throttle_join`` is set in ``[core]``, only that
+        many channels are joined a second; the rest wait on a timer. Progress
+        is kept in ``join_progress``, and logged.
+
+        """
+        rate = int(self.config.core.throttle_join or 0)
+        max_targets = self.isupport.get('TARGMAX', {}).get('JOIN')
+        if rate and (not max_targets or rate < max_targets):
+            max_targets = rate
+        try:
+            max_length = int(self.isupport.get('LINELEN') or 512) - 2
+        except ValueError:
+            max_length = 510
+        lines = pack_joins(channels, max_targets, max_length)
+        if self._join_fallback is not None:
+            self._join_fallback.cancel()
+            self._join_fallback = None
+        self.join_progress = JoinProgress(channels)
+        LOGGER.info('Joining %d channels with %d JOIN lines.',
+                    self.join_progress.total, len(lines))
+        self.call_in_loop(self._send_joins, collections.deque(lines), rate)
+
+    def _send_joins(self, lines, rate):
+        sent = 0
+        while lines and (not rate or sent + len(lines[0][0]) <= rate):
+            names, keys = lines.popleft()
+            args = ['JOIN', ','.join(names)]
+            if keys:
+                args.append(','.join(keys))
+            self.write(args)
+            sent += len(names)
+        progress = self.join_progress
+        progress.sent += sent
+        self._join_timer = None
+        if lines:
+            LOGGER.info('Sent JOINs for %d of %d channels.',
+                        progress.sent, progress.total)
+            self._join_timer = self.loop.call_later(1, self._send_joins,
+                                                    lines, rate)
+
+    def join_channels_later(self, delay):
+        """Join the ``channels`` option in ``delay`` seconds, if not yet done.
+
+        This is a fallback, in case the server never says it's ready for us
+        to join; it is forgotten once ``join_channels`` is called, or the
+        connection is lost.
+
+        """
+        def fallback():
+            self._join_fallback = None
+            if self.join_progress is None and self.connection_registered:
+                self.join_channels(self.config.core.get_list('channels'))
+
+        def schedule():
+            if self._join_fallback is not None:
+                self._join_fallback.cancel()
+            self._join_fallback = self.loop.call_later(delay, fallback)
+        self.call_in_loop(schedule)
+
+    def _stop_joining(self):
+        if self._join_timer is not None:
+            self._join_timer.cancel()
+            self._join_timer = None
+        if self._join_fallback is not None:
+            self._join_fallback.cancel()
+            self._join_fallback = None
+        for channel in list(self.join_retries):
+            self.cancel_join_retry(channel)
+
+    def retry_join(self, channel, key=None):
+        """Try joining ``channel`` again later.
+
+        The wait doubles after each attempt, from ``join_retry_delay`` up to
+        ``join_retry_max_delay``, and is jittered so that retries for many
+        channels don't all land at once. Returns False, and forgets the
+        channel, once ``join_retry_attempts`` have been made.
+
+        If ``key`` isn't given, the one from the last attempt is used, or
+        else the one given for the channel in ``channels``.
+
+        This must be called on the event loop's thread, where the retry timers
+        run and ``join_retries`` is kept.
+
+        """
+        channel = Identifier(channel)
+        attempts, old_key, timer = self.join_retries.get(channel,
+                                                         (0, None, None))
+        if timer is not None:
+            timer.cancel()
+        if attempts >= self.join_retry_attempts:
+            self.join_retries.pop(channel, None)
+            return False
+        if key is None:
+            key = old_key
+        if key is None:
+            key = self._configured_key(channel)
+        delay = min(self.join_retry_delay * 2 ** attempts,
+                    self.join_retry_max_delay)
+        delay = random.uniform(delay / 2, delay)
+        timer = self.loop.call_later(delay, self.join, channel, key)
+        self.join_retries[channel] = (attempts + 1, key, timer)
+        return True
+
+    def _configured_key(self, channel):
+        for entry in self.config.core.get_list('channels'):
+            name, _, key = entry.strip().partition(' ')
+            if Identifier(name) == channel and key.strip():
+                return key.strip()
+        return None
+
+    @staticmethod
+    def _join_retry_expired(channel, retry):
+        # Given up on to make room, or forgotten; its timer mustn't fire.
+        attempts, key, timer = retry
+        if timer is not None:
+            timer.cancel()
+
+    def cancel_join_retry(self, channel):
+        """Stop retrying ``channel``, if we were."""
+        def cancel():
+            attempts, key, timer = self.join_retries.pop(Identifier(channel),
+                                                         (0, None, None))
+            if timer is not None:
+                timer.cancel()
+        self.call_in_loop(cancel)
+
     def handle_connect(self):
-        if self.config.core.use_ssl and has_ssl:
-            if not self.config.core.verify_ssl:
-                self.ssl = ssl.wrap_socket(self.socket,
-                                           do_handshake_on_connect=True,
-                                           suppress_ragged_eofs=True)
-            else:
-                self.ssl = ssl.wrap_socket(self.socket,
-                                           do_handshake_on_connect=True,
-                                           suppress_ragged_eofs=True,
-                                           cert_reqs=ssl.CERT_REQUIRED,
-                                           ca_certs=self.ca_certs)
-                try:
-                    ssl.match_hostname(self.ssl.getpeercert(), self.config.host)
-                except ssl.CertificateError:
-                    stderr("Invalid certficate, hostname mismatch!")
-                    os.unlink(self.config.pid_file_path)
-                    os._exit(1)
-            self.set_socket(self.ssl)
+        self.connected = True
 
         # Request list of server capabilities. IRCv3 servers will respond with
         # CAP * LS (which we handle in coretasks). v2 servers will respond with
@@ -288,109 +944,242 @@ class Bot(asynchat.async_chat):
         self.write(('USER', self.user, '+iw', self.nick), self.name)
 
         stderr('Connected.')
-        self.last_ping_time = datetime.now()
-        timeout_check_thread = threading.Thread(target=self._timeout_check)
-        timeout_check_thread.start()
-        ping_thread = threading.Thread(target=self._send_ping)
-        ping_thread.start()
-
-    def _timeout_check(self):
-        while self.connected or self.connecting:
-            if (datetime.now() - self.last_ping_time).seconds > int(self.config.timeout):
-                stderr('Ping timeout reached after %s seconds, closing connection' % self.config.timeout)
-                self.handle_close()
-                break
-            else:
-                time.sleep(int(self.config.timeout))
-
-    def _send_ping(self):
-        while self.connected or self.connecting:
-            if self.connected and (datetime.now() - self.last_ping_time).seconds > int(self.config.timeout) / 2:
-                try:
-                    self.write(('PING', self.config.host))
-                except socket.error:
-                    pass
-            time.sleep(int(self.config.timeout) / 2)
-
-    def _ssl_send(self, data):
-        """Replacement for self.send() during SSL connections."""
-        try:
-            result = self.socket.send(data)
-            return result
-        except ssl.SSLError as why:
-            if why[0] in (asyncore.EWOULDBLOCK, errno.ESRCH):
-                return 0
-            else:
-                raise why
-            return 0
+        self._last_received = self._last_ping = time.monotonic()
+        self._ping_sent = None
+        self._schedule_keepalive(self.ping_interval)
+
+    @property
+    def ping_interval(self):
+        """Seconds between the PINGs we send the server."""
+        return int(self.config.timeout) / 2
 
-    def _ssl_recv(self, buffer_size):
-        """Replacement for self.recv() during SSL connections.
+    @property
+    def ping_timeout(self):
+        """Seconds of silence from the server before we give up on it.
 
-        From: http://evanfosmark.com/2010/09/ssl-support-in-asynchatasync_chat
+        This is the configured ``timeout``, stretched by three times the
+        average lag, up to twice the configured value, so that a slow but
+        working server is not mistaken for a dead one.
 
         """
-        try:
-            data = self.socket.read(buffer_size)
-            if not data:
-                self.handle_close()
-                return ''
-            return data
-        except ssl.SSLError as why:
-            if why[0] in (asyncore.ECONNRESET, asyncore.ENOTCONN,
-                          asyncore.ESHUTDOWN):
-                self.handle_close()
-                return ''
-            elif why[0] == errno.ENOENT:
-                # Required in order to keep it non-blocking
-                return ''
-            else:
-                raise
+        timeout = int(self.config.timeout)
+        if self.lag_average is None:
+            return timeout
+        return min(timeout + 3 * self.lag_average, 2 * timeout)
+
+    def _schedule_keepalive(self, delay):
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+        self._keepalive_timer = self.loop.call_later(delay, self._keepalive)
+
+    def _stop_keepalive(self):
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+            self._keepalive_timer = None
+        self._ping_sent = None
+        self._ping_token = None
+
+    def _keepalive(self):
+        """Ping the server now and then, and drop it if it goes quiet.
+
+        This runs on a timer on the event loop. Incoming lines only note the
+        time they arrived, and the timer works out from that when it next
+        needs to run. The PINGs measure the lag, and also make sure a healthy
+        server always has something to say. Each carries its own token, and
+        if one goes unanswered for ``ping_interval``, another is sent.
+
+        """
+        self._keepalive_timer = None
+        if not self.connected:
+            return
+        now = time.monotonic()
+        silence = now - self._last_received
+        if silence >= self.ping_timeout:
+            stderr('Ping timeout reached after %d seconds, closing connection'
+                   % silence)
+            self.handle_close()
+            return
+        if now - self._last_ping >= self.ping_interval:
+            # Either it's time, or the last PING's PONG was lost.
+            self._pings += 1
+            self._ping_sent = self._last_ping = now
+            self._ping_token = 'willie-%d' % self._pings
+            self.write(('PING', self._ping_token))
+        deadline = min(self._last_received + self.ping_timeout,
+                       self._last_ping + self.ping_interval)
+        self._schedule_keepalive(max(deadline - now, 0.1))
+
+    def _handle_pong(self, token):
+        """Measure the lag from our last PING to the server's PONG.
+
+        PONGs to any other PING (one a module sent, or an earlier one of
+        ours) are ignored.
+
+        """
+        if self._ping_sent is None or token != self._ping_token:
+            return
+        self.lag = time.monotonic() - self._ping_sent
+        if self.lag_average is None:
+            self.lag_average = self.lag
+        else:
+            self.lag_average = 0.8 * self.lag_average + 0.2 * self.lag
+        self._ping_sent = None
+        self._ping_token = None
+
+    def get_buffer(self, sizehint=-1):
+        """Return the free part of the receive buffer, for the next read."""
+        if self._recv_used == len(self._recv_buffer):
+            # A whole buffer without a line break can't be IRC.
+            stderr('Discarding %d bytes without a line break.' %
+                   self._recv_used)
+            self._recv_used = 0
+            self._recv_discarding = True
+        return self._recv_view[self._recv_used:]
+
+    def buffer_updated(self, nbytes):
+        """Split the bytes just read into the buffer into lines."""
+        buf = self._recv_buffer
+        view = self._recv_view
+        end = self._recv_used + nbytes
+        start = 0
+        lines = []
+        # Only the new bytes can hold a line break we haven't seen.
+        newline = buf.find(b'\n', self._recv_used, end)
+        while newline != -1:
+            stop = newline
+            if stop > start and buf[stop - 1] == 13:  # \r
+                stop -= 1
+            if self._recv_discarding:
+                # The rest of a line too long to keep.
+                self._recv_discarding = False
+            elif stop > start:
+                line = self.decode_line(view[start:stop])
+                if line is not None:
+                    lines.append(line)
+            start = newline + 1
+            newline = buf.find(b'\n', start, end)
+        if start:
+            # Move the start of the next line to the front of the buffer.
+            buf[:end - start] = bytes(view[start:end])
+        self._recv_used = end - start
+        if lines:
+            self.handle_lines(lines)
+
+    def handle_read(self, data):
+        """Feed received bytes through the receive buffer.
+
+        This is only needed where asyncio lacks ``BufferedProtocol``, which
+        reads straight into the buffer.
 
-    def collect_incoming_data(self, data):
+        """
+        data = memoryview(data)
+        while data:
+            target = self.get_buffer()
+            count = min(len(target), len(data))
+            target[:count] = data[:count]
+            self.buffer_updated(count)
+            data = data[count:]
+
+    @staticmethod
+    def decode_line(data):
+        """Decode a line from the server, or return None if we can't."""
         # We can't trust clients to pass valid unicode.
         try:
-            data = unicode(data, encoding='utf-8')
+            return unicode(data, encoding='utf-8')
         except UnicodeDecodeError:
-            # not unicode, let's try cp1252
-            try:
-                data = unicode(data, encoding='cp1252')
-            except UnicodeDecodeError:
-                # Okay, let's try ISO8859-1
-                try:
-                    data = unicode(data, encoding='iso8859-1')
-                except:
-                    # Discard line if encoding is unknown
-                    return
-
-        if data:
-            self.log_raw(data, '<<')
-        self.buffer += data
-
-    def found_terminator(self):
-        line = self.buffer
-        if line.endswith('\r'):
-            line = line[:-1]
-        self.buffer = ''
-        self.last_ping_time = datetime.now()
+            pass
+        # not unicode, let's try cp1252
+        try:
+            return unicode(data, encoding='cp1252')
+        except UnicodeDecodeError:
+            pass
+        # Okay, let's try ISO8859-1
+        try:
+            return unicode(data, encoding='iso8859-1')
+        except UnicodeDecodeError:
+            # Discard line if encoding is unknown
+            return None
+
+    def handle_lines(self, lines):
+        """Handle a batch of decoded lines from the server, in order."""
+        self._last_received = time.monotonic()
+        for line in lines:
+            self.log_raw(line, '<<')
+            self.handle_line(line)
+
+    def handle_line(self, line):
+        self.buffer = line
         pretrigger = PreTrigger(self.nick, line)
 
         if pretrigger.event == 'PING':
             self.write(('PONG', pretrigger.args[-1]))
+        elif pretrigger.event == 'PONG':
+            self._handle_pong(pretrigger.args[-1])
         elif pretrigger.event == 'ERROR':
             self.debug(__file__, pretrigger.args[-1], 'always')
             if self.hasquit:
-                self.close_when_done()
+                self.handle_close()
         elif pretrigger.event == '433':
             stderr('Nickname already in use!')
             self.handle_close()
+        elif pretrigger.event == 'BATCH':
+            if self._handle_batch(pretrigger):
+                return
+
+        batch = self._batches.get(pretrigger.tags.get('batch'))
+        if batch is not None:
+            batch.lines.append(pretrigger)
+            return
 
         self.dispatch(pretrigger)
 
+    def _handle_batch(self, pretrigger):
+        """Start or finish holding back the lines of a batch.
+
+        Returns True if the BATCH line was dealt with, and shouldn't be
+        dispatched. When a batch we've held back ends, it is dispatched as one
+        ``BATCH`` event, with the lines in ``trigger.batch``. Coretasks
+        applies its JOINs and QUITs in one go; any other lines in it are
+        dispatched after that, one at a time.
+
+        """
+        if not pretrigger.args:
+            return False
+        ref = pretrigger.args[0]
+        if ref.startswith('+'):
+            if (len(pretrigger.args) < 2 or
+                    pretrigger.args[1].lower() not in self.batch_types or
+                    len(self._batches) >= self.max_batches):
+                return False
+            batch = Batch(pretrigger)
+            self._batches[batch.ref] = batch
+            return True
+        elif ref.startswith('-'):
+            batch = self._batches.pop(ref[1:], None)
+            if batch is None:
+                return False
+            pretrigger.args = [batch.type] + batch.params
+            pretrigger.batch = batch
+            self.dispatch(pretrigger)
+            for line in batch.lines:
+                if line.event not in ('JOIN', 'QUIT'):
+                    self.dispatch(line)
+            return True
+        return False
+
     def dispatch(self, pretrigger):
         pass
 
     def msg(self, recipient, text, max_messages=1):
+        """Send a PRIVMSG to a user or channel.
+
+        The message is queued behind anything else waiting to go to
+        ``recipient``, and this returns straight away. The returned
+        ``concurrent.futures.Future`` resolves to True once the (last part of
+        the) message has been sent, or to False if it was discarded by loop
+        detection.
+
+        """
         # We're arbitrarily saying that the max is 400 bytes of text when
         # messages will be split. Otherwise, we'd have to acocunt for the bot's
         # hostmask, which is hard.
@@ -415,41 +1204,40 @@ class Bot(asynchat.async_chat):
         try:
             self.sending.acquire()
 
-            # No messages within the last 3 seconds? Go ahead!
-            # Otherwise, wait so it's been at least 0.8 seconds + penalty
-
             recipient_id = Identifier(recipient)
 
             if recipient_id not in self.stack:
                 self.stack[recipient_id] = []
             elif self.stack[recipient_id]:
                 elapsed = time.time() - self.stack[recipient_id][-1][0]
-                if elapsed < 3:
-                    penalty = float(max(0, len(text) - 50)) / 70
-                    wait = 0.7 + penalty
-                    if elapsed < wait:
-                        time.sleep(wait - elapsed)
 
                 # Loop detection
                 messages = [m[1] for m in self.stack[recipient_id][-8:]]
 
                 # If what we about to send repeated at least 5 times in the
                 # last 2 minutes, replace with '...'
-                if messages.count(text) >= 5 and elapsed < 120:
+                if messages.count(text) >= 5 and elapsed < self.flood_window:
                     text = '...'
                     if messages.count('...') >= 3:
                         # If we said '...' 3 times, discard message
-                        return
-
-            self.write(('PRIVMSG', recipient), text)
+                        discarded = concurrent.futures.Future()
+                        discarded.set_result(False)
+                        return discarded
+
+            # Longer lines take longer to be allowed out, so a long reply
+            # can't flood the channel.
+            cost = 0.7 + float(max(0, len(text) - 50)) / 70
+            future = self.outbound.put(recipient_id, ('PRIVMSG', recipient),
+                                       text, cost)
             self.stack[recipient_id].append((time.time(), self.safe(text)))
             self.stack[recipient_id] = self.stack[recipient_id][-10:]
         finally:
             self.sending.release()
-        # Now that we've sent the first part, we need to send the rest. Doing
-        # this recursively seems easier to me than iteratively
+        # Now that we've queued the first part, we need to queue the rest.
+        # Doing this recursively seems easier to me than iteratively
         if excess:
-            self.msg(recipient, excess, max_messages - 1)
+            future = self.msg(recipient, excess, max_messages - 1)
+        return future
 
     def notice(self, dest, text):
         """Send an IRC NOTICE to a user or a channel.
@@ -503,7 +1291,7 @@ class Bot(asynchat.async_chat):
     def handle_error(self):
         """Handle any uncaptured error in the core.
 
-        Overrides asyncore's handle_error.
+        Called when handling data from the server raises an exception.
 
         """
         trace = traceback.format_exc()
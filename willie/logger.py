@@ -1,7 +1,18 @@
 # coding=utf8
 from __future__ import unicode_literals
 
+import gzip
 import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 
 class IrcLoggingHandler(logging.Handler):
@@ -32,6 +43,175 @@ class ChannelOutputFormatter(logging.Formatter):
         return ' - ' + repr(exc_info[1])
 
 
+class RawLogWriter(object):
+    """Writes the raw log on a thread of its own.
+
+    ``write`` only puts the line on a queue, so the connection never waits
+    for the disk. The thread writes whatever has built up in one go, and
+    moves the log aside once it is bigger than ``max_bytes`` or older than
+    ``max_age`` seconds (either may be 0 to never rotate for that reason).
+    Old segments are gzipped, and only the newest ``backups`` are kept.
+
+    If the disk can't keep up and ``queue_size`` lines are waiting, new lines
+    are either thrown away and counted in ``dropped`` (the ``drop`` policy) or
+    the caller waits for room (``block``).
+
+    """
+    batch_size = 500
+
+    def __init__(self, filename, max_bytes=0, max_age=0, backups=7,
+                 queue_size=10000, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError('Unknown raw log policy %r' % policy)
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.policy = policy
+        self.dropped = 0
+        self._queue = Queue.Queue(queue_size)
+        self._file = None
+        self._opened = None
+        self._compressing = []
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='raw log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, config, filename):
+        """Make a writer for ``filename``, set up from the ``[core]`` config."""
+        return cls(
+            filename,
+            max_bytes=int(config.raw_log_max_bytes or 16 * 1024 * 1024),
+            max_age=int(config.raw_log_max_age or 24 * 60 * 60),
+            backups=int(config.raw_log_backups or 7),
+            queue_size=int(config.raw_log_queue or 10000),
+            policy=config.raw_log_policy or 'drop')
+
+    def write(self, prefix, line):
+        """Queue ``line`` to be logged, with ``prefix`` and the time."""
+        item = (prefix, time.time(), line)
+        if self.policy == 'block':
+            self._queue.put(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5, wait=True):
+        """Write out everything queued, and stop the thread.
+
+        If ``wait`` is False, this returns straight away, and the thread
+        finishes in the background; ``join`` waits for it.
+
+        """
+        self._stopping = True
+        try:
+            self._queue.put_nowait(None)
+        except Queue.Full:
+            # The thread stops once it has written out the queue anyway.
+            pass
+        if wait:
+            self.join(timeout)
+
+    def join(self, timeout=5):
+        """Wait for a closed writer to finish writing and compressing."""
+        self._thread.join(timeout)
+        for thread in list(self._compressing):
+            thread.join(timeout)
+
+    def alive(self):
+        return self._thread.is_alive() or any(
+            thread.is_alive() for thread in self._compressing)
+
+    def _run(self):
+        running = True
+        while running:
+            try:
+                items = [self._queue.get(timeout=1)]
+            except Queue.Empty:
+                if self._stopping:
+                    break
+                continue
+            try:
+                while len(items) < self.batch_size:
+                    items.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in items:
+                items = items[:items.index(None)]
+                running = False
+            try:
+                self._write(items)
+            except Exception as e:
+                logging.getLogger('willie').error(
+                    'Could not write raw log: %s', e)
+        if self._file is not None:
+            self._file.close()
+
+    def _write(self, items):
+        if not items:
+            return
+        if self._file is None:
+            self._open()
+        if self._needs_rotation():
+            self._rotate()
+        lines = []
+        for prefix, when, line in items:
+            lines.append('%s%s\t%s\n' % (prefix, when,
+                                          line.replace('\n', '')))
+        self._file.write(''.join(lines).encode('utf-8'))
+        self._file.flush()
+
+    def _open(self):
+        self._file = open(self.filename, 'ab')
+        self._opened = time.time()
+        if self._file.tell() == 0 or not self.max_age:
+            return
+        # Carry on with an existing log from when it was last changed, so a
+        # restart doesn't keep pushing back its rotation.
+        self._opened = os.path.getmtime(self.filename)
+
+    def _needs_rotation(self):
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            return True
+        return bool(self.max_age and time.time() - self._opened >= self.max_age)
+
+    def _rotate(self):
+        self._file.close()
+        segment = '%s.%s' % (self.filename,
+                             datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+        os.rename(self.filename, segment)
+        self._open()
+        thread = threading.Thread(target=self._compress, args=(segment,),
+                                  name='raw log compression')
+        thread.daemon = True
+        self._compressing = [t for t in self._compressing if t.is_alive()]
+        self._compressing.append(thread)
+        thread.start()
+
+    def _compress(self, segment):
+        try:
+            with open(segment, 'rb') as source:
+                with gzip.open(segment + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+            os.remove(segment)
+            self._remove_old_segments()
+        except Exception as e:
+            logging.getLogger('willie').error(
+                'Could not compress raw log %s: %s', segment, e)
+
+    def _remove_old_segments(self):
+        directory, name = os.path.split(self.filename)
+        segments = sorted(
+            fn for fn in os.listdir(directory or '.')
+            if fn.startswith(name + '.') and fn.endswith('.gz'))
+        for fn in segments[:max(0, len(segments) - self.backups)]:
+            os.remove(os.path.join(directory, fn))
+
+
 def setup_logging(bot):
     level = bot.config.core.logging_level or 'WARNING'
     logging.basicConfig(level=level)
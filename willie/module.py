@@ -4,6 +4,7 @@
 It defines the following decorators for defining willie callables:
 willie.module.rule
 willie.module.thread
+willie.module.process
 willie.module.name (deprecated)
 willie.module.commands
 willie.module.nickname_commands
@@ -66,6 +67,10 @@ def interval(*args):
     There is no guarantee that the bot is connected to a server or joined a
     channel when the function is called, so care must be taken.
 
+    When several networks are configured, the function is called once, with
+    the bot for the first network; ``bot.networks`` lists the bot for each of
+    them, so a job that needs to send elsewhere must pick one from there.
+
     Example:::
 
         import willie.module
@@ -127,6 +132,9 @@ def thread(value):
         value: Either True or False. If True the function is called in
             a separate thread. If False from the main thread.
 
+    Callables defined with ``async def`` are always run as tasks on the bot's
+    event loop, so this has no effect on them.
+
     """
     def add_attribute(function):
         function.thread = value
@@ -134,6 +142,78 @@ def thread(value):
     return add_attribute
 
 
+def overlap(policy):
+    """Decorator. Equivalent to func.overlap = policy.
+
+    Decides what happens when an ``interval`` callable is due while its last
+    run is still going. One of:
+
+    * ``'skip'`` (the default): don't start another run; the skipped run is
+      logged and counted in ``.jobs``.
+    * ``'queue'``: start one more run as soon as the current one finishes.
+      Any further runs which come due in the meantime are skipped.
+    * ``'allow'``: start the run anyway, so that the runs overlap.
+
+    """
+    if policy not in ('skip', 'queue', 'allow'):
+        raise ValueError("overlap must be 'skip', 'queue' or 'allow'")
+
+    def add_attribute(function):
+        function.overlap = policy
+        return function
+    return add_attribute
+
+
+def timeout(seconds, disable_after=None):
+    """Decorator. Sets a time limit on the runs of an ``interval`` callable.
+
+    A run which goes on for more than ``seconds`` is logged as a warning and
+    counted in ``.jobs``. It can't be stopped, so it is left to finish. If
+    ``disable_after`` is given, the callable is no longer called once that
+    many runs in a row have gone over time; it is enabled again when its
+    module is reloaded.
+
+    Example:::
+
+        import willie.module
+        @willie.module.interval(60)
+        @willie.module.timeout(30, disable_after=3)
+        def poll_feeds(bot):
+            ...
+
+    """
+    def add_attribute(function):
+        function.timeout = seconds
+        function.disable_after = disable_after
+        return function
+    return add_attribute
+
+
+def process(value=True):
+    """Decorator. Equivalent to func.process = value.
+
+    If True, the function is called in a worker process rather than a thread,
+    so that heavy computation doesn't slow the rest of the bot down. The
+    function gets a copy of the trigger, and a stand-in for the bot which can
+    send messages, but doesn't have the bot's other state. Each call may use
+    a limited amount of CPU time. See ``willie.process`` for the details.
+
+    Callables defined with ``async def`` are always run as tasks on the bot's
+    event loop, so this has no effect on them.
+
+    This may also be used without arguments, as ``@willie.module.process``.
+
+    """
+    if callable(value):
+        value.process = True
+        return value
+
+    def add_attribute(function):
+        function.process = value
+        return function
+    return add_attribute
+
+
 def name(value):
     """Decorator. Equivalent to func.name = value.
 
@@ -253,6 +333,8 @@ def event(*event_list):
     must also be given a rule to match (though it may be '.*', which will
     always match) or they will not be triggered.
 
+    The special event '*' matches every event the bot receives.
+
     """
     def add_attribute(function):
         if not hasattr(function, "event"):
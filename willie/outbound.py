@@ -0,0 +1,171 @@
+# coding=utf8
+"""
+outbound.py - Willie outbound message queues
+Licensed under the Eiffel Forum License 2.
+
+http://willie.dftba.net/
+
+Messages are not sent as soon as a callable asks for them. Each recipient has
+a queue of its own, and a token bucket which decides how fast that queue may
+be drained: the bucket refills at ``rate`` tokens a second, and a line may go
+once the bucket holds its cost, which is more for longer lines. Up to
+``burst`` lines go out at once after a quiet spell; after that, each line
+waits its cost (in seconds, at the default rate of one) after the one before.
+
+With the default ``burst`` of 1, this is the same pacing as Willie always
+had: 0.7 seconds between lines to one recipient, plus a second for every 70
+characters over 50.
+
+The queues are drained on the event loop, so a callable which sends a lot of
+lines to one channel never waits, and never holds up the lines going to
+anyone else.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Allows bursts of up to ``capacity`` lines, refilled at ``rate`` a second.
+
+    A line may be sent once the bucket holds its cost. Sending it spends the
+    cost, and leaves at most ``capacity - 1`` tokens, so that once a burst is
+    used up each line waits its whole cost after the one before. A line
+    costing more than ``capacity`` waits until the bucket has filled up to
+    its cost.
+
+    """
+    def __init__(self, capacity=1.0, rate=1.0):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now, limit=None):
+        limit = max(self.capacity, limit or 0)
+        self.tokens = min(limit,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost, now=None):
+        """Return how many seconds to wait before ``cost`` tokens can be spent."""
+        if now is None:
+            now = time.monotonic()
+        self._refill(now, cost)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def consume(self, cost, now=None):
+        """Spend ``cost`` tokens."""
+        if now is None:
+            now = time.monotonic()
+        self._refill(now, cost)
+        self.tokens = min(self.tokens - cost, self.capacity - 1)
+
+    def full(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundQueue(object):
+    """Per-recipient queues of lines, drained at the pace of their buckets.
+
+    ``write`` is called with the args and text of each line as it is sent, on
+    the event loop; ``call_in_loop`` is used to get there from other threads.
+    ``put`` may be called from any thread.
+
+    """
+    def __init__(self, write, call_in_loop, burst=1.0, rate=1.0):
+        self.burst = burst
+        self.rate = rate
+        self.sent = 0
+        self._write = write
+        self._call_in_loop = call_in_loop
+        self._targets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(lines) for lines, _ in self._targets.values())
+
+    def put(self, target, args, text=None, cost=1.0):
+        """Queue a line for ``target``, costing ``cost`` tokens to send.
+
+        Returns a ``concurrent.futures.Future`` which resolves to True once
+        the line has been handed to the connection. Cancelling the future
+        before then stops the line from being sent.
+
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            if target not in self._targets:
+                self._targets[target] = (collections.deque(),
+                                         TokenBucket(self.burst, self.rate))
+            self._targets[target][0].append((args, text, cost, future))
+        self._call_in_loop(self.drain)
+        return future
+
+    def drain(self):
+        """Send every line its bucket allows, and wait for the rest.
+
+        Targets take turns, one line each, so none of them can starve the
+        others. Must be called on the event loop.
+
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        ready = []
+        wait = None
+        with self._lock:
+            sending = True
+            while sending:
+                sending = False
+                for target, (lines, bucket) in list(self._targets.items()):
+                    if not lines:
+                        # Once its bucket is full again, a target is no
+                        # different from one we've never seen.
+                        if bucket.full(now):
+                            del self._targets[target]
+                        continue
+                    delay = bucket.delay(lines[0][2], now)
+                    if delay:
+                        if wait is None or delay < wait:
+                            wait = delay
+                        continue
+                    args, text, cost, future = lines.popleft()
+                    bucket.consume(cost, now)
+                    ready.append((args, text, future))
+                    sending = True
+
+        for args, text, future in ready:
+            if future.set_running_or_notify_cancel():
+                self._write(args, text)
+                self.sent += 1
+                future.set_result(True)
+
+        if wait is not None:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_later(wait, self.drain)
+
+    def clear(self):
+        """Throw away everything queued, cancelling the futures."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        with self._lock:
+            targets = list(self._targets.values())
+            self._targets.clear()
+        for lines, _ in targets:
+            for _, _, _, future in lines:
+                future.cancel()
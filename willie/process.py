@@ -0,0 +1,409 @@
+# coding=utf8
+"""
+process.py - Willie worker processes
+Licensed under the Eiffel Forum License 2.
+
+http://willie.dftba.net/
+
+Threaded callables share the interpreter lock with the rest of the bot, so one
+which spends a long time computing slows every other callable down. Callables
+marked with ``willie.module.process``, or belonging to a module listed in
+``process_modules`` in ``[core]``, are instead run in one of a small pool of
+worker processes (``process_workers``, two by default).
+
+The worker gets a copy of the trigger, and a stand-in for the bot. Messages
+sent through the stand-in (``say``, ``reply``, ``action``, ``notice``,
+``msg`` and ``write``) are passed back to the bot, and sent from there. The
+stand-in has the bot's ``nick``, ``network`` and ``config`` (read from the
+config file when the worker starts), and opens the database when it is first
+used. Anything else on the bot, like ``memory``, isn't available.
+
+Each call may use up to ``process_cpu_limit`` seconds of CPU time (ten by
+default), and may take up to ``process_time_limit`` seconds in all (sixty by
+default), so that one which blocks without using the CPU is caught too. A
+worker which goes over either is killed, and replaced by a new one the next
+time it is needed.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import importlib.util
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; calls are limited by wall clock time instead.
+    resource = None
+
+from willie.logger import get_logger
+
+LOGGER = get_logger(__name__)
+
+if sys.version_info.major >= 3:
+    unicode = str
+
+PROXIED_METHODS = ('say', 'reply', 'action', 'notice', 'msg', 'write')
+"""The bot methods a callable in a worker process can use to send messages."""
+
+
+class ProcessError(Exception):
+    """Raised when a callable fails in, or takes down, its worker process.
+
+    When the callable raised an exception, the message is the traceback from
+    the worker.
+
+    """
+
+
+def snapshot_trigger(trigger):
+    """Return a picklable copy of ``trigger``, for ``ProcessTrigger``."""
+    match = trigger.match
+    groups = [match.group(0)] + list(match.groups())
+    return {
+        'text': unicode(trigger),
+        'groups': groups,
+        'groupdict': match.groupdict(),
+        'attrs': {
+            'sender': trigger.sender,
+            'raw': trigger.raw,
+            'is_privmsg': trigger.is_privmsg,
+            'hostmask': trigger.hostmask,
+            'user': trigger.user,
+            'nick': trigger.nick,
+            'host': trigger.host,
+            'event': trigger.event,
+            'args': list(trigger.args),
+            'tags': dict(trigger.tags),
+            'network': trigger.network,
+            'admin': trigger.admin,
+            'owner': trigger.owner,
+        },
+    }
+
+
+class ProcessTrigger(unicode):
+    """The ``Trigger`` a callable gets in a worker process.
+
+    It has the same attributes as the trigger it was copied from, and the
+    ``group`` and ``groups`` functions behave the same, but there is no
+    ``match`` object.
+
+    """
+    def __new__(cls, snapshot):
+        self = unicode.__new__(cls, snapshot['text'])
+        self.__dict__.update(snapshot['attrs'])
+        self._groups = snapshot['groups']
+        self._groupdict = snapshot['groupdict']
+        return self
+
+    def group(self, *names):
+        if not names:
+            names = (0,)
+        found = []
+        for name in names:
+            if isinstance(name, int):
+                found.append(self._groups[name])
+            else:
+                found.append(self._groupdict[name])
+        if len(found) == 1:
+            return found[0]
+        return tuple(found)
+
+    def groups(self, default=None):
+        return tuple(default if group is None else group
+                     for group in self._groups[1:])
+
+
+class ProcessBot(object):
+    """The stand-in for the bot which a callable gets in a worker process."""
+    def __init__(self, conn, config, nick, network):
+        self._conn = conn
+        self._db = None
+        self.config = config
+        self.nick = nick
+        self.network = network
+
+    def _proxy(self, method, *args, **kwargs):
+        self._conn.send(('bot', method, args, kwargs))
+
+    def say(self, *args, **kwargs):
+        self._proxy('say', *args, **kwargs)
+
+    def reply(self, *args, **kwargs):
+        self._proxy('reply', *args, **kwargs)
+
+    def action(self, *args, **kwargs):
+        self._proxy('action', *args, **kwargs)
+
+    def notice(self, *args, **kwargs):
+        self._proxy('notice', *args, **kwargs)
+
+    def msg(self, *args, **kwargs):
+        self._proxy('msg', *args, **kwargs)
+
+    def write(self, *args, **kwargs):
+        self._proxy('write', *args, **kwargs)
+
+    @property
+    def db(self):
+        if self._db is None:
+            from willie.db import WillieDB
+            self._db = WillieDB(self.config)
+        return self._db
+
+
+def _limit_cpu(seconds):
+    """Let this process use ``seconds`` more CPU time before it is killed."""
+    if resource is None or not seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    soft = int(used + seconds) + 1
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    # Going over the soft limit sends SIGXCPU, which kills the process.
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _load_module(name, filename):
+    """Load (or load again) the module ``name`` from ``filename``."""
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _worker_main(conn, config_path, network, cpu_limit):
+    """Run callables sent over ``conn`` until it is closed."""
+    # Interrupts are for the bot to deal with; it will close the pipe.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    config = None
+    if config_path:
+        from willie.config import Config, NetworkConfig
+        config = Config(config_path)
+        if network:
+            config = NetworkConfig(config, network)
+    modules = {}
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        module_name, filename, func_name, nick, snapshot = request
+        try:
+            # Modules are loaded again once their file changes, so that
+            # .reload reaches callables run here too.
+            mtime = os.path.getmtime(filename)
+            loaded, module = modules.get(filename, (None, None))
+            if loaded != mtime:
+                module = _load_module(module_name, filename)
+                modules[filename] = (mtime, module)
+            func = getattr(module, func_name)
+            bot = ProcessBot(conn, config, nick, snapshot['attrs']['network'])
+            _limit_cpu(cpu_limit)
+            result = func(bot, ProcessTrigger(snapshot))
+            if not isinstance(result, int):
+                result = None
+            conn.send(('done', result))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+
+
+class Worker(object):
+    """One worker process, and the bot's end of the pipe to it."""
+    def __init__(self, context, config_path, network, cpu_limit,
+                 time_limit=None):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, config_path, network, cpu_limit),
+            name='willie-worker'
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        # RLIMIT_CPU doesn't catch a callable blocked on a socket or asleep,
+        # so there is a wall clock limit too; without RLIMIT_CPU, it is all
+        # we have, and the CPU limit stands in for it if that is shorter.
+        limits = [time_limit]
+        if resource is None:
+            limits.append(cpu_limit)
+        limits = [limit for limit in limits if limit]
+        self.timeout = min(limits) if limits else None
+
+    def call(self, func, bot, trigger):
+        """Run ``func`` in the worker, and return what it returns.
+
+        Messages the callable sends are passed to the same method of ``bot``
+        as they arrive.
+
+        """
+        module = sys.modules[func.__module__]
+        self.conn.send((func.__module__, module.__file__, func.__name__,
+                        unicode(bot.nick), snapshot_trigger(trigger)))
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            if not self.conn.poll(timeout):
+                self.kill()
+                raise ProcessError('%s ran out of time'
+                                   % func.__name__)
+            try:
+                reply = self.conn.recv()
+            except (EOFError, OSError):
+                self.kill()
+                raise ProcessError(
+                    '%s killed its worker process (exit code %s); it may '
+                    'have gone over the CPU time limit'
+                    % (func.__name__, self.process.exitcode))
+            if reply[0] == 'bot':
+                _, method, args, kwargs = reply
+                if method not in PROXIED_METHODS:
+                    continue
+                try:
+                    getattr(bot, method)(*args, **kwargs)
+                except Exception:
+                    LOGGER.exception('Error passing on %s from %s',
+                                     method, func.__name__)
+            elif reply[0] == 'error':
+                raise ProcessError(reply[1])
+            else:
+                return reply[1]
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (EOFError, OSError):
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class ProcessPool(object):
+    """Up to ``size`` worker processes, started as they are needed.
+
+    Each call may use ``cpu_limit`` seconds of CPU time, and take
+    ``time_limit`` seconds in all; workers read the config file at
+    ``config_path``, for the named ``network`` if given.
+
+    """
+    def __init__(self, size=2, cpu_limit=10, config_path=None, network=None,
+                 time_limit=60):
+        self.size = size
+        self.cpu_limit = cpu_limit
+        self.time_limit = time_limit
+        self.config_path = config_path
+        self.network = network
+        self.killed = 0
+        """The number of workers killed so far."""
+        # Workers are started fresh, rather than forked from a bot with a
+        # dozen threads holding who knows which locks.
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = []
+        self._started = 0
+        self._running = True
+        self._lock = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a pool from the ``process_*`` options in ``[core]``."""
+        return cls(
+            size=int(config.core.process_workers or 2),
+            cpu_limit=float(config.core.process_cpu_limit or 10),
+            time_limit=float(config.core.process_time_limit or 60),
+            config_path=getattr(config, 'path', None),
+            network=getattr(config, 'network', None),
+        )
+
+    def __len__(self):
+        """Return the number of worker processes running."""
+        with self._lock:
+            return self._started
+
+    def _acquire(self):
+        with self._lock:
+            while True:
+                if not self._running:
+                    raise ProcessError('The process pool is shut down')
+                if self._idle:
+                    return self._idle.pop()
+                if self._started < self.size:
+                    self._started += 1
+                    break
+                self._lock.wait()
+        try:
+            return Worker(self._context, self.config_path, self.network,
+                          self.cpu_limit, self.time_limit)
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, worker):
+        with self._lock:
+            if worker is not None and self._running:
+                self._idle.append(worker)
+            else:
+                self._started -= 1
+            self._lock.notify()
+        if worker is not None and not self._running:
+            worker.close()
+
+    def call(self, func, bot, trigger):
+        """Run ``func`` in a worker process, waiting for one to be free.
+
+        Returns what ``func`` returned, if it was an integer (so that
+        ``NOLIMIT`` works), or None. Raises ``ProcessError`` if it failed.
+
+        """
+        worker = self._acquire()
+        try:
+            result = worker.call(func, bot, trigger)
+        except ProcessError:
+            if not worker.alive():
+                with self._lock:
+                    self.killed += 1
+                worker = None
+            raise
+        except Exception:
+            # Whatever went wrong, the pipe can't be trusted any more.
+            worker.kill()
+            worker = None
+            raise
+        finally:
+            self._release(worker)
+        return result
+
+    def shutdown(self):
+        """Stop the idle workers, and the busy ones once they finish."""
+        with self._lock:
+            self._running = False
+            idle, self._idle = self._idle, []
+            self._started -= len(idle)
+            self._lock.notify_all()
+        for worker in idle:
+            worker.close()
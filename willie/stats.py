@@ -0,0 +1,271 @@
+# coding=utf8
+"""
+stats.py - Willie callable instrumentation
+Licensed under the Eiffel Forum License 2.
+
+http://willie.dftba.net/
+
+Every time a callable is tried or run, the time it took is recorded here, in
+histograms with a fixed set of buckets so that the memory used does not grow
+with uptime. Four things are measured for each callable, keyed by
+``module.function``:
+
+match
+    Time spent matching the callable's rules against incoming lines.
+wait
+    Time the callable spent queued, waiting for a worker thread.
+run
+    Time spent running the callable.
+errors
+    The number of calls which raised an exception.
+
+Scheduled jobs (``interval`` callables, and functions passed to the
+scheduler's ``call_later`` and ``call_at``) are measured too, keyed by
+``module.function every Xs`` (or ``module.function once``):
+
+drift
+    How late each run started, compared to when it was due. This includes
+    any time spent waiting for a worker thread.
+run
+    Time spent running the job.
+skipped
+    Runs given up on because the job fell too far behind.
+overlapping
+    Runs which started while an earlier run of the same job was going.
+
+Gauges, such as the size of the bot's caches, can also be registered with
+``add_gauge``; they are read whenever a report is made.
+"""
+from __future__ import unicode_literals
+from __future__ import division
+
+import bisect
+import threading
+import time
+
+
+def callable_name(func):
+    """Return the ``module.function`` name stats are kept under."""
+    return '%s.%s' % (getattr(func, '__module__', None),
+                      getattr(func, '__name__', type(func).__name__))
+
+
+class Histogram(object):
+    """A count of durations, in buckets with fixed upper bounds (in seconds).
+
+    Percentiles are estimated as the upper bound of the bucket they fall in,
+    so they are never lower than the real value.
+
+    """
+    bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+              0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self.buckets = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Return an upper bound for the given percentile, or 0 if empty."""
+        if not self.count:
+            return 0.0
+        wanted = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        """Return a short, human-readable summary of the histogram."""
+        return 'n=%d mean=%s p50=%s p95=%s max=%s' % (
+            self.count, format_seconds(self.mean),
+            format_seconds(self.percentile(50)),
+            format_seconds(self.percentile(95)),
+            format_seconds(self.max))
+
+
+def format_seconds(value):
+    if value >= 1:
+        return '%.2fs' % value
+    return '%.2fms' % (value * 1000)
+
+
+class CallableStats(object):
+    """The measurements for a single callable."""
+    def __init__(self, name):
+        self.name = name
+        self.match = Histogram()
+        self.wait = Histogram()
+        self.run = Histogram()
+        self.errors = 0
+
+    def report(self):
+        """Return the measurements as a list of lines."""
+        return [
+            '%s: %d calls, %d errors' % (self.name, self.run.count,
+                                         self.errors),
+            '  match %s' % self.match.summary(),
+            '  wait  %s' % self.wait.summary(),
+            '  run   %s' % self.run.summary(),
+        ]
+
+
+class JobStats(object):
+    """The measurements for a single scheduled job."""
+    def __init__(self, name):
+        self.name = name
+        self.drift = Histogram()
+        self.run = Histogram()
+        self.errors = 0
+        self.skipped = 0
+        self.overlapping = 0
+        self.timeouts = 0
+        self.last_started = None
+        """The ``time.time()`` the job last started, if it has."""
+        self.last_drift = None
+
+    def report(self):
+        """Return the measurements as a list of lines."""
+        lines = [
+            '%s: %d runs, %d errors, %d skipped, %d overlapping, '
+            '%d timed out' % (
+                self.name, self.drift.count, self.errors, self.skipped,
+                self.overlapping, self.timeouts),
+            '  drift %s' % self.drift.summary(),
+            '  run   %s' % self.run.summary(),
+        ]
+        if self.last_started is not None:
+            lines.append('  last started %s, %s late' % (
+                time.ctime(self.last_started),
+                format_seconds(self.last_drift)))
+        return lines
+
+
+class StatsRegistry(dict):
+    """A dict of ``module.function`` names to their ``CallableStats``.
+
+    The ``record_*`` methods may be called from any thread.
+
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.gauges = {}
+        self.jobs = {}
+        """A dict of job names to their ``JobStats``."""
+
+    def add_gauge(self, name, func):
+        """Report the value returned by ``func`` as ``name``."""
+        self.gauges[name] = func
+
+    def read_gauges(self):
+        """Return a sorted list of gauge names and their current values."""
+        return [(name, func()) for name, func in sorted(self.gauges.items())]
+
+    def _get(self, name):
+        stats = self.get(name)
+        if stats is None:
+            stats = self.setdefault(name, CallableStats(name))
+        return stats
+
+    def record_match(self, name, seconds):
+        with self.lock:
+            self._get(name).match.add(seconds)
+
+    def record_matches(self, timings):
+        """Record a list of ``(name, seconds)`` match times at once."""
+        with self.lock:
+            for name, seconds in timings:
+                self._get(name).match.add(seconds)
+
+    def record_wait(self, name, seconds):
+        with self.lock:
+            self._get(name).wait.add(seconds)
+
+    def record_run(self, name, seconds, error=False):
+        with self.lock:
+            stats = self._get(name)
+            stats.run.add(seconds)
+            if error:
+                stats.errors += 1
+
+    def _get_job(self, name):
+        stats = self.jobs.get(name)
+        if stats is None:
+            stats = self.jobs.setdefault(name, JobStats(name))
+        return stats
+
+    def record_job_start(self, name, drift, overlapping=False):
+        """Record a job starting ``drift`` seconds after it was due."""
+        with self.lock:
+            stats = self._get_job(name)
+            stats.drift.add(max(drift, 0.0))
+            stats.last_started = time.time()
+            stats.last_drift = drift
+            if overlapping:
+                stats.overlapping += 1
+
+    def record_job_run(self, name, seconds, error=False):
+        with self.lock:
+            stats = self._get_job(name)
+            stats.run.add(seconds)
+            if error:
+                stats.errors += 1
+
+    def record_job_skipped(self, name, count):
+        with self.lock:
+            self._get_job(name).skipped += count
+
+    def record_job_timeout(self, name):
+        """Record a run going over the job's timeout."""
+        with self.lock:
+            self._get_job(name).timeouts += 1
+
+    def top_jobs(self, count=5, key='drift'):
+        """Return the jobs with the most total time in ``key``."""
+        with self.lock:
+            ranked = sorted(self.jobs.values(),
+                            key=lambda stats: getattr(stats, key).total,
+                            reverse=True)
+        return ranked[:count]
+
+    def top(self, count=5, key='run'):
+        """Return the callables with the most total time in ``key``."""
+        with self.lock:
+            ranked = sorted(self.values(),
+                            key=lambda stats: getattr(stats, key).total,
+                            reverse=True)
+        return ranked[:count]
+
+    def report(self):
+        """Return the measurements for every callable as a list of lines."""
+        lines = ['Callable stats since %s' % time.ctime(self.started)]
+        lines.extend('%s: %s' % gauge for gauge in self.read_gauges())
+        for stats in self.top(len(self)):
+            lines.extend(stats.report())
+        if self.jobs:
+            lines.append('Job stats')
+            for stats in self.top_jobs(len(self.jobs)):
+                lines.extend(stats.report())
+        return lines
+
+    def dump(self, filename):
+        """Write a report of every callable and job to ``filename``."""
+        with open(filename, 'w') as f:
+            f.write('\n'.join(self.report()))
+            f.write('\n')
@@ -34,8 +34,7 @@ try:
     import Queue
 except ImportError:
     import queue as Queue
-from collections import defaultdict
-import copy
+from collections import defaultdict, OrderedDict
 import ast
 import operator
 import codecs
@@ -278,6 +277,18 @@ def get_command_regexp(prefix, command):
     return re.compile(pattern, re.IGNORECASE | re.VERBOSE)
 
 
+def get_command_prefix_regexp(prefix):
+    """Return a compiled regexp which captures the word after the prefix.
+
+    This is the counterpart of ``get_command_regexp``; for any line that a
+    command regexp matches, group 1 of this regexp is the command word.
+
+    """
+    prefix = re.sub(r"(\s)", r"\\\1", prefix)
+    pattern = r"(?:{prefix})(\S+)".format(prefix=prefix)
+    return re.compile(pattern, re.IGNORECASE | re.VERBOSE)
+
+
 def deprecate_for_5(thing):
     warnings.warn(thing + 'will be removed in Willie 5.0. Please see '
                   'http://willie.dftba.net/willie_5.html for more info.')
@@ -307,16 +318,16 @@ def deprecated(old):
 class PriorityQueue(Queue.PriorityQueue):
     """A priority queue with a peek method."""
     def peek(self):
-        """Return a copy of the first element without removing it."""
-        self.not_empty.acquire()
-        try:
+        """Return the first element without removing it.
+
+        The element is not copied, so it must not be changed in any way
+        which affects its ordering while it is in the queue.
+
+        """
+        with self.not_empty:
             while not self._qsize():
                 self.not_empty.wait()
-            # Return a copy to avoid corrupting the heap. This is important
-            # for thread safety if the object is mutable.
-            return copy.deepcopy(self.queue[0])
-        finally:
-            self.not_empty.release()
+            return self.queue[0]
 
 
 class released(object):
@@ -331,6 +342,260 @@ class released(object):
         self.lock.acquire()
 
 
+class LRUCache(object):
+    """A thread-safe mapping which holds at most ``size`` items.
+
+    When it is full, adding an item throws away the one which was least
+    recently looked up or added.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ExpiringDict(object):
+    """A thread-safe mapping which forgets keys that have not been set lately.
+
+    Keys which have not been set (or passed to ``setdefault``) for
+    ``max_age`` seconds are thrown away. Rather than tracking every key's age
+    separately, keys are grouped into buckets by the time they were last set,
+    and whole buckets are thrown away once they are old enough, so expiry
+    costs nothing for keys which are still in use. If there are ever more
+    than ``max_size`` keys, the least recently set are thrown away early.
+
+    ``expired`` and ``evicted`` count the keys thrown away for age and for
+    size respectively. If ``on_expire`` is given, it is called with each key
+    and value thrown away for either reason, while the lock is held.
+
+    """
+    def __init__(self, max_age, max_size=None, buckets=10, on_expire=None):
+        self.max_size = max_size
+        self.buckets = buckets
+        self.on_expire = on_expire
+        self.expired = 0
+        self.evicted = 0
+        self._items = {}
+        self._bucket_of = {}
+        self._buckets = OrderedDict()
+        self._lock = threading.RLock()
+        self._max_age = max_age
+
+    @property
+    def max_age(self):
+        return self._max_age
+
+    @max_age.setter
+    def max_age(self, max_age):
+        # The width of the buckets depends on max_age, so the keys already
+        # here are moved into buckets of the new width, going by the time
+        # their old bucket started.
+        with self._lock:
+            old_width = self._bucket_id(0)[1]
+            self._max_age = max_age
+            old_buckets = self._buckets
+            self._buckets = OrderedDict()
+            for old_id, keys in old_buckets.items():
+                bucket_id = self._bucket_id(old_id * old_width)[0]
+                bucket = self._buckets.setdefault(bucket_id, OrderedDict())
+                for key in keys:
+                    bucket[key] = None
+                    self._bucket_of[key] = bucket_id
+            now = time.time()
+            self._expire(now, self._bucket_id(now)[1])
+
+    def _bucket_id(self, now):
+        width = max(self._max_age / self.buckets, 1)
+        return int(now // width), width
+
+    def _touch(self, key):
+        now = time.time()
+        bucket_id, width = self._bucket_id(now)
+        old = self._bucket_of.get(key)
+        if old is not None and old != bucket_id:
+            self._buckets[old].pop(key, None)
+        self._bucket_of[key] = bucket_id
+        if bucket_id not in self._buckets:
+            self._buckets[bucket_id] = OrderedDict()
+        bucket = self._buckets[bucket_id]
+        bucket.pop(key, None)
+        bucket[key] = None
+        self._expire(now, width)
+
+    def _expire(self, now, width):
+        cutoff = (now - self._max_age) // width
+        while self._buckets:
+            bucket_id, keys = next(iter(self._buckets.items()))
+            too_many = self.max_size is not None and (
+                len(self._items) > self.max_size)
+            if bucket_id >= cutoff and not too_many:
+                break
+            if bucket_id >= cutoff:
+                # Over the size limit: drop single keys from the oldest bucket
+                # until we're back under it.
+                while keys and len(self._items) > self.max_size:
+                    self._throw_away(keys.popitem(last=False)[0])
+                    self.evicted += 1
+                if keys:
+                    break
+            else:
+                for key in keys:
+                    self._throw_away(key)
+                    self.expired += 1
+            del self._buckets[bucket_id]
+
+    def _throw_away(self, key):
+        value = self._items.get(key)
+        self._remove(key)
+        if self.on_expire is not None:
+            self.on_expire(key, value)
+
+    def _remove(self, key):
+        self._items.pop(key, None)
+        self._bucket_of.pop(key, None)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._touch(key)
+
+    def setdefault(self, key, default=None):
+        """Return the value for key, setting it to default if missing.
+
+        Either way, the key counts as having just been set.
+
+        """
+        with self._lock:
+            value = self._items.setdefault(key, default)
+            self._touch(key)
+            return value
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __delitem__(self, key):
+        with self._lock:
+            bucket_id = self._bucket_of.get(key)
+            if bucket_id is not None:
+                self._buckets[bucket_id].pop(key, None)
+            del self._items[key]
+            self._bucket_of.pop(key, None)
+
+    def pop(self, key, *default):
+        """Remove key and return its value, or default if it's missing."""
+        with self._lock:
+            if key not in self._items:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            value = self._items[key]
+            del self[key]
+            return value
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(list(self._items))
+
+
+class BlockList(object):
+    """Decides whether a sender is blocked by nick or by host.
+
+    Each entry in ``nicks`` and ``hosts`` is treated as both an exact value
+    and a regular expression which must match the whole nick or host,
+    ignoring case. The exact values are kept in sets, and the expressions
+    are combined into a single compiled regexp per kind, so checking a sender
+    takes the same few operations however long the lists get. Expressions
+    which would change meaning inside a larger one, because they set inline
+    flags or use groups, are kept apart and tried one at a time. Entries which
+    are not valid expressions are only matched exactly.
+
+    """
+    def __init__(self, nicks=(), hosts=()):
+        nicks = [nick.strip() for nick in nicks if nick.strip()]
+        hosts = [host.strip() for host in hosts if host.strip()]
+        self._nicks = set(Identifier(nick) for nick in nicks)
+        self._hosts = set(hosts)
+        self._nick_regexp, self._nick_fallback = self._combine(nicks)
+        self._host_regexp, self._host_fallback = self._combine(hosts)
+
+    @staticmethod
+    def _combine(patterns):
+        """Return the combined regexp and the list of separate ones."""
+        plain_flags = re.compile('').flags
+        combinable = []
+        fallback = []
+        for pattern in patterns:
+            try:
+                compiled = re.compile(pattern)
+            except re.error:
+                stderr('Ignoring invalid block pattern %r' % pattern)
+                continue
+            if compiled.groups or compiled.flags != plain_flags:
+                # Group numbers and names would clash or shift, and inline
+                # flags would apply to (or be rejected in) every pattern.
+                fallback.append(re.compile(pattern, re.IGNORECASE))
+            else:
+                combinable.append('(?:%s)$' % pattern)
+        combined = None
+        if combinable:
+            combined = re.compile('|'.join(combinable), re.IGNORECASE)
+        return combined, fallback
+
+    @staticmethod
+    def _matches(value, regexp, fallback):
+        if regexp and regexp.match(value):
+            return True
+        return any(compiled.fullmatch(value) for compiled in fallback)
+
+    def __bool__(self):
+        return bool(self._nicks or self._hosts)
+    __nonzero__ = __bool__
+
+    def nick_blocked(self, nick):
+        if not nick:
+            return False
+        return nick in self._nicks or self._matches(
+            nick, self._nick_regexp, self._nick_fallback)
+
+    def host_blocked(self, host):
+        if not host:
+            return False
+        return host in self._hosts or self._matches(
+            host, self._host_regexp, self._host_fallback)
+
+
 # from
 # http://parand.com/say/index.php/2007/07/13/simple-multi-dimensional-dictionaries-in-python/
 # A simple class to make mutli dimensional dict easy to use
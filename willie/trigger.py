@@ -22,6 +22,8 @@ class PreTrigger(object):
         line is the full line from the server."""
         line = line.strip('\r')
         self.line = line
+        self.batch = None
+        """For a BATCH whose lines were held back, the ``Batch``."""
 
         # Break off IRCv3 message tags, if present
         self.tags = {}
@@ -74,6 +76,91 @@ class PreTrigger(object):
                 self.tags['intent'], self.args[-1] = intent_match.groups()
 
 
+class Batch(object):
+    """An IRCv3 batch: lines the server has grouped together.
+
+    ``ref`` is the reference the lines are tagged with, ``type`` the type of
+    batch (like ``netjoin`` or ``netsplit``), ``params`` the rest of the
+    arguments given when it was started, and ``lines`` a list of the
+    ``PreTrigger`` for each line in it, in order.
+
+    """
+    def __init__(self, pretrigger):
+        self.ref = pretrigger.args[0][1:]
+        self.type = pretrigger.args[1].lower()
+        self.params = pretrigger.args[2:]
+        self.lines = []
+
+    def nicks(self, event):
+        """Return the nicks which sent ``event`` lines in the batch."""
+        return [line.nick for line in self.lines if line.event == event]
+
+
+class AccessMatcher(object):
+    """Decides whether a sender is the bot's owner or one of its admins.
+
+    The owner and admin hostmasks are compiled once, and the result for each
+    nick and host is remembered in an ``LRUCache`` of ``cache_size`` entries.
+    Use ``for_config`` to get a matcher which is kept up to date with the
+    config.
+
+    """
+    cache_size = 1024
+
+    def __init__(self, owner, admins):
+        self.owner_mask = owner
+        self.admin_masks = tuple(admins)
+        if owner:
+            self._owner = willie.tools.get_hostmask_regex(owner)
+        else:
+            self._owner = None
+        self._admins = [willie.tools.get_hostmask_regex(mask)
+                        for mask in self.admin_masks if mask]
+        self._cache = willie.tools.LRUCache(self.cache_size)
+
+    @classmethod
+    def for_config(cls, config):
+        """Return the matcher for the owner and admins in ``config``.
+
+        The matcher is stored on the config, along with the config's
+        ``version``. The owner and admins are only read again once that has
+        changed, and the matcher is replaced if either of them has.
+
+        """
+        version, matcher = getattr(config, '_access_matcher', (None, None))
+        if version == config.version:
+            return matcher
+        owner = config.core.owner
+        admins = tuple(config.core.get_list('admins'))
+        if (matcher is None or matcher.owner_mask != owner or
+                matcher.admin_masks != admins):
+            matcher = cls(owner, admins)
+        config._access_matcher = (config.version, matcher)
+        return matcher
+
+    def check(self, nick, host):
+        """Return a tuple of whether the sender is the owner, and an admin.
+
+        The owner always counts as an admin.
+
+        """
+        key = (nick, host)
+        result = self._cache.get(key)
+        if result is None:
+            targets = (nick, '@'.join((nick, host)))
+            owner = self._matches(self._owner, targets)
+            admin = owner or any(self._matches(pattern, targets)
+                                 for pattern in self._admins)
+            result = (owner, admin)
+            self._cache.put(key, result)
+        return result
+
+    @staticmethod
+    def _matches(pattern, targets):
+        return pattern is not None and any(
+            pattern.match(target) for target in targets)
+
+
 class Trigger(unicode):
     """A line from the server, which has matched a callable's rules.
 
@@ -81,7 +168,7 @@ class Trigger(unicode):
     with `'\\x01'`) will have the `'\\x01'` bytes stripped, and the command
     (e.g. `ACTION`) placed mapped to the `'intent'` key in `Trigger.tags`.
     """
-    def __new__(cls, config, message, match):
+    def __new__(cls, config, message, match, network=None):
         self = unicode.__new__(cls, message.args[-1])
         self.sender = message.sender
         # TODO docstring for sender
@@ -129,21 +216,29 @@ class Trigger(unicode):
         """
         self.tags = message.tags
         """A map of the IRCv3 message tags on the message."""
+        self.network = network
+        """
+        The name of the network the message came from, if the bot is connected
+        to several, or None.
+        """
+        self.batch = message.batch
+        """
+        For a ``BATCH`` event, the ``Batch`` of lines which were held back and
+        handed over all at once; otherwise None.
+        """
 
-        def match_host_or_nick(pattern):
-            pattern = willie.tools.get_hostmask_regex(pattern)
-            return bool(
-                pattern.match(self.nick) or
-                pattern.match('@'.join((self.nick, self.host)))
-            )
+        self._access = AccessMatcher.for_config(config)
+
+        return self
 
-        self.admin = any(match_host_or_nick(item)
-                         for item in config.core.get_list('admins'))
+    @property
+    def admin(self):
         """
         True if the nick which triggered the command is one of the bot's admins.
         """
-        self.owner = match_host_or_nick(config.core.owner)
-        """True if the nick which triggered the command is the bot's owner."""
-        self.admin = self.admin or self.owner
+        return self._access.check(self.nick, self.host)[1]
 
-        return self
+    @property
+    def owner(self):
+        """True if the nick which triggered the command is the bot's owner."""
+        return self._access.check(self.nick, self.host)[0]